@@ -16,14 +16,23 @@
 ##
 
 import argparse
+import cProfile
+import hashlib
+import json
 import sys
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 import os
 from datetime import datetime
 import subprocess
 import dateutil
 import dateutil.tz
 import re
+import shutil
+import tempfile
 from mercurial import hg, ui, commands
+from mercurial.node import nullrev
 # We use gitpython for the repository branch. I was hoping to use it for
 # more, but unfortunately gitpython doesn't seem to want
 # to set dates on commits, so we revert to calling git directly for that.
@@ -36,87 +45,361 @@ LATEST_REV_FILE = "last_m_c_import_rev.txt"
 DEFAULT_SOURCE_REPO = "http://hg.mozilla.org/mozilla-central/"
 DEFAULT_SOURCE_CLONE = "../mozilla-central"
 DEFAULT_SOURCE_BRANCH = "default"
+DEFAULT_PREFETCH_WORKERS = 4
+# In megabytes.
+DEFAULT_PREFETCH_BUDGET = 64
+DEFAULT_CHECKPOINT_INTERVAL = 50
+# Kept in the .git directory, so it doesn't dirty the working tree.
+IMPORT_JOURNAL_FILE = "loop_import_journal"
+DEFAULT_TARGET_JOBS = 4
+# Kept in the .git directory, alongside the journal.
+TARGET_WORKTREES_DIR = "loop_import_worktrees"
+
+class Metrics(object):
+    """
+    Records wall time and counts for each phase of an import, plus general
+    counters, so that slow runs can be diagnosed and graphed over time.
+    Phases may nest, e.g. "readHgData" happens within "import".
+    """
 
-
-# Is this interesting to Loop?
-def interestingFilename(filename):
-    return (filename.startswith("browser/extensions/loop/standalone") or
-            filename.startswith("browser/extensions/loop/content/shared") or
-            filename.startswith("browser/extensions/loop/test/standalone") or
-            filename.startswith("browser/extensions/loop/test/shared"))
-
-
-def isIndexFile(filename):
-    return filename == "browser/extensions/loop/standalone/content/index.html"
-
-
-# This is how we map files from mozilla-central to loop-client repo
-def updatePathsFor(filename):
-    filename = filename.replace("browser/extensions/loop/standalone/", "")
-    filename = filename.replace("browser/extensions/loop/content/shared/",
-                                "content/shared/")
-    filename = filename.replace("browser/extensions/loop/test/standalone/",
-                                "test/standalone/")
-    filename = filename.replace("browser/extensions/loop/test/shared/",
-                                "test/shared/")
-    return filename
-
-
-def preserveLocaleData(filename, fileData):
+    def __init__(self):
+        self.startTime = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.targets = {}
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        return MetricsPhase(self, name)
+
+    def addPhaseTime(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "count": 0})
+            phase["seconds"] += seconds
+            phase["count"] += 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def addTarget(self, name, targetMetrics):
+        with self.lock:
+            self.targets[name] = targetMetrics
+
+    def toJSON(self):
+        with self.lock:
+            result = {
+                "startTime": self.startTime,
+                "totalSeconds": time.time() - self.startTime,
+                "phases": self.phases,
+                "counters": self.counters,
+            }
+            if self.targets:
+                result["targets"] = self.targets
+            return result
+
+    def write(self, filename):
+        outFile = open(filename, "w")
+        json.dump(self.toJSON(), outFile, indent=2, sort_keys=True)
+        outFile.write("\n")
+        outFile.close()
+
+
+class MetricsPhase(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.metrics.addPhaseTime(self.name, time.time() - self.start)
+
+
+metrics = Metrics()
+
+
+# Used to find the locales list in index.html, and to replace it.
+LOCALES_META_RE = re.compile(r"""
+  <meta                          # Match tag name
+    \s*                          # Any number of spaces
+    name=(["'])locales\1.*?      # Match name="locales" (either kind of quote)
+    \s*                          # Any number of spaces
+    content=(["'])               # Match content attribute
+      (.*?)                      # The locale information we want
+      \2.*?                      # End quote of content attribute
+    \s*                          # Any number of spaces
+   />
+""", re.MULTILINE | re.DOTALL | re.VERBOSE)
+
+
+def preserveLocaleData(oldFileData, fileData):
     """
     Preserves locale data for an index file.
 
     Keyword arguments:
-    filename -- the filename of the original file
+    oldFileData -- the content of the file currently in the repo
     fileData -- the new file data being written
     """
-    oldFile = open(filename, "r")
-    oldFileData = oldFile.read()
-    oldFile.close()
-
-    localeList = re.search(r"""
-      <meta                          # Match tag name
-        \s*                          # Any number of spaces
-        name=(["'])locales\1.*?      # Match name="locales" (either kind of quote)
-        \s*                          # Any number of spaces
-        content=(["'])               # Match content attribute
-          (.*?)                      # The locale information we want
-          \2.*?                      # End quote of content attribute
-        \s*                          # Any number of spaces
-       />
-    """, oldFileData, re.VERBOSE).group(3)
+    localeList = LOCALES_META_RE.search(oldFileData).group(3)
 
     # This will overwrite any other attributes, but we only expect these
     # so that should be fine.
-    newFileData = re.sub(r"""
-      <meta                        # Match tag name
-        \s*                        # Any number of spaces
-        name=(["'])locales\1.*?    # Match name="locales" (either kind of quote)
-        \s*                        # Any number of spaces
-        content=(["']).*?\2.*?     # Match content="<anything>" attribute
-        \s*                        # Any number of spaces
-       />
-    """,
+    return LOCALES_META_RE.sub(
         '<meta name="locales" content="' + "".join(localeList) + '" />',
-        fileData, 1, re.MULTILINE | re.DOTALL | re.VERBOSE)
-
-    return newFileData
+        fileData, 1)
 
 
-def testFileNeedsUpdatedPaths(filename):
-    return (filename == "test/standalone/index.html" or
-            filename == "test/shared/index.html")
+# Content transforms. Each is called with the translated (loop-client)
+# filename, the new file data and a function that returns the data
+# currently in the repo for that file, and returns the data to write.
+def keepLocaleList(filename, fileData, readExisting):
+    return preserveLocaleData(readExisting(), fileData)
 
 
-def updatePathsInTestFile(filename, fileData):
+def updatePathsInTestFile(filename, fileData, readExisting):
     print "Translating %s" % filename
     return fileData.replace('src="../../standalone/', 'src="../../')
 
-def stripPackageJson(fileData):
+
+def stripPackageJson(filename, fileData, readExisting):
     # This line we don't want - we don't use eslint in loop-client currently
     # and we don't want to move the source across.
     return fileData.replace('"eslint-plugin-mozilla": "../../../../testing/eslint-plugin-mozilla",', '')
 
+
+class ImportRule(object):
+    """
+    Maps a mozilla-central path to its loop-client location.
+
+    Keyword arguments:
+    source -- a directory prefix (ending in "/") or an exact file path
+    destination -- what source is replaced with in the loop-client path
+    transforms -- content transforms applied, in order, to the file data
+    """
+
+    def __init__(self, source, destination, transforms=()):
+        self.source = source
+        self.destination = destination
+        self.transforms = tuple(transforms)
+
+    def isPrefix(self):
+        return self.source.endswith("/")
+
+    def translatePath(self, filename):
+        return self.destination + filename[len(self.source):]
+
+    def transform(self, filename, fileData, readExisting):
+        for transform in self.transforms:
+            fileData = transform(filename, fileData, readExisting)
+        return fileData
+
+
+class ImportRules(object):
+    """
+    A set of ImportRules compiled into a single regular expression, so that
+    each file is classified and mapped with one match. Exact file rules and
+    longer prefixes take priority over the shorter prefixes containing them.
+    """
+
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: len(rule.source),
+                            reverse=True)
+        self.pattern = "|".join(
+            "(%s%s)" % (re.escape(rule.source), "" if rule.isPrefix() else "$")
+            for rule in self.rules)
+        self.matcher = re.compile(self.pattern)
+
+    def match(self, filename):
+        """
+        Returns the rule that applies to filename, or None if the file
+        isn't interesting to Loop.
+        """
+        match = self.matcher.match(filename)
+        if match is None:
+            return None
+        return self.rules[match.lastindex - 1]
+
+
+# This is how we map files from mozilla-central to loop-client repo
+IMPORT_RULES = ImportRules([
+    ImportRule("browser/extensions/loop/standalone/", ""),
+    # For the index file, we preserve the locale data in the file.
+    ImportRule("browser/extensions/loop/standalone/content/index.html",
+               "content/index.html", [keepLocaleList]),
+    ImportRule("browser/extensions/loop/standalone/package.json",
+               "package.json", [stripPackageJson]),
+    ImportRule("browser/extensions/loop/content/shared/", "content/shared/"),
+    ImportRule("browser/extensions/loop/test/standalone/", "test/standalone/"),
+    ImportRule("browser/extensions/loop/test/standalone/index.html",
+               "test/standalone/index.html",
+               [updatePathsInTestFile]),
+    ImportRule("browser/extensions/loop/test/shared/", "test/shared/"),
+    ImportRule("browser/extensions/loop/test/shared/index.html",
+               "test/shared/index.html",
+               [updatePathsInTestFile]),
+])
+
+
+def loopFilePaths(hgRepo):
+    """
+    Returns every path under the import rules that has ever had a filelog in
+    hgRepo, by listing the store (the fncache, for normal clones) rather than
+    reading any changesets or manifests.
+    """
+    paths = []
+    for entry in hgRepo.store.datafiles():
+        # Older mercurial yields (name, encoded, size), newer versions prefix
+        # that with the file type.
+        name = entry[-3]
+        if not name.startswith("data/") or not name.endswith(".i"):
+            continue
+        path = name[len("data/"):-len(".i")]
+        if IMPORT_RULES.match(path) is not None:
+            paths.append(path)
+    return paths
+
+
+def isAliased(hgRepo, filelog, path, headCtx, headAncestors, firstRev):
+    """
+    Returns True if path may have been changed in the history of headCtx, at
+    or after firstRev, by a changeset that its filelog doesn't link to.
+
+    A file revision only links to the first changeset that added it, so when
+    the same change lands on two branches (an uplift, say) the file revision
+    is shared, and is in the head's history without the changeset it links
+    to being so. Changing just a file's flags doesn't add a file revision at
+    all, but leaves the flags different from those of the changeset that the
+    file revision links to. Changing them along with the content looks the
+    same, so it's also reported.
+
+    Keyword arguments:
+    hgRepo -- the mercurial repository
+    filelog -- the filelog of path
+    path -- a path in headCtx
+    headCtx -- the head to check the history of
+    headAncestors -- the revisions of headCtx and its ancestors
+    firstRev -- the first revision number to consider
+    """
+    pending = [(filelog.rev(headCtx.filenode(path)), headCtx.flags(path))]
+    seen = set()
+    while pending:
+        fileRev, childFlags = pending.pop()
+        linkRev = filelog.linkrev(fileRev)
+        if linkRev not in headAncestors:
+            return True
+
+        flags = hgRepo[linkRev].flags(path)
+        if flags != childFlags:
+            return True
+
+        # Anything older reached the head through changesets before firstRev.
+        if linkRev < firstRev:
+            continue
+
+        for parentRev in filelog.parentrevs(fileRev):
+            if parentRev != nullrev and parentRev not in seen:
+                seen.add(parentRev)
+                pending.append((parentRev, flags))
+
+    return False
+
+
+def relevantRevisions(hgRepo, firstRev, headRevs=None):
+    """
+    Returns the non-merge revisions from firstRev onwards that touch files
+    that are interesting to Loop, in revision order.
+
+    The revisions are collected from the linkrevs of the Loop filelogs, so
+    the changelog isn't walked. That misses changes which don't add a file
+    revision of their own, so the changelog is still scanned, limited to the
+    affected paths, for:
+
+    - paths that were removed at some point within the range (they're
+      missing from a head they were in the history of, or were added again
+      later), from the first revision the removal could be in.
+    - paths that isAliased finds changes to in a head's history which their
+      filelogs don't link to, such as an uplift or a change of flags.
+
+    Some changes leave no trace in the filelogs or heads at all, so aren't
+    found: the same change landing on two branches that have since been
+    merged, a file that's removed and then added back with the same content
+    (as the backout of a removal does), flags that are changed back before
+    the file next changes, and a removal that a later merge undoes (a
+    modify/delete conflict resolved by keeping the file). hg's own filelog()
+    revset has the same limits.
+
+    Keyword arguments:
+    hgRepo -- the mercurial repository
+    firstRev -- the first revision number to consider
+    headRevs -- the heads whose history is imported (default: all of the
+                repository's heads)
+    """
+    if firstRev >= len(hgRepo):
+        return []
+
+    changelog = hgRepo.changelog
+    if headRevs is None:
+        headRevs = [changelog.rev(node) for node in hgRepo.heads()]
+    heads = []
+    for headRev in headRevs:
+        # Generated newest first.
+        ancestors = changelog.ancestors([headRev], inclusive=True)
+        baseRev = next((rev for rev in ancestors if rev < firstRev), None)
+        heads.append((hgRepo[headRev], ancestors,
+                      hgRepo[baseRev] if baseRev is not None else None))
+
+    revs = set()
+    scanPaths = []
+    scanStart = len(hgRepo)
+    for path in loopFilePaths(hgRepo):
+        filelog = hgRepo.file(path)
+        metrics.count("filelogsRead")
+        readded = False
+        pathRevs = []
+        for fileRev in filelog:
+            linkRev = filelog.linkrev(fileRev)
+            if linkRev < firstRev:
+                continue
+            pathRevs.append(linkRev)
+            if fileRev > 0 and filelog.parentrevs(fileRev) == (nullrev,
+                                                                nullrev):
+                readded = True
+        revs.update(pathRevs)
+
+        # Where to look for the path's removal from, if it was removed.
+        removalStarts = [firstRev] if readded else []
+        for headCtx, ancestors, baseCtx in heads:
+            if path in headCtx:
+                continue
+            if baseCtx is not None and path in baseCtx:
+                removalStarts.append(firstRev)
+            else:
+                removalStarts.extend(rev for rev in pathRevs
+                                     if rev in ancestors)
+
+        if removalStarts:
+            scanPaths.append(path)
+            scanStart = min(scanStart, min(removalStarts))
+        elif any(path in headCtx and
+                 isAliased(hgRepo, filelog, path, headCtx, ancestors,
+                           firstRev)
+                 for headCtx, ancestors, _ in heads):
+            metrics.count("aliasedPaths")
+            scanPaths.append(path)
+            scanStart = firstRev
+
+    if scanPaths:
+        metrics.count("changesetsScanned", len(hgRepo) - scanStart)
+        pattern = "re:(%s)$" % "|".join(re.escape(path)
+                                        for path in scanPaths)
+        revs.update(hgRepo.revs("%d: and file(%s)", scanStart, pattern))
+
+    return sorted(rev for rev in revs
+                  if changelog.parentrevs(rev)[1] == nullrev)
+
+
 def writeFile(filename, fileData):
     """
     Write a file out to disk
@@ -130,21 +413,28 @@ def writeFile(filename, fileData):
         os.makedirs(directory)
 
     outFile = open(filename, "w")
-    if testFileNeedsUpdatedPaths(filename):
-        outFile.write(updatePathsInTestFile(filename, fileData))
-    elif filename == "package.json":
-        outFile.write(stripPackageJson(fileData))
-    else:
-        outFile.write(fileData)
+    outFile.write(fileData)
     outFile.close()
 
 
+def readFile(filename):
+    inFile = open(filename, "r")
+    fileData = inFile.read()
+    inFile.close()
+    return fileData
+
+
 def deleteFile(filename):
     os.remove(filename)
 
 
+def spawn(cmd, **kwargs):
+    metrics.count("subprocessesSpawned")
+    return subprocess.Popen(cmd, **kwargs)
+
+
 def runCommand(cmd):
-    p = subprocess.Popen(cmd)
+    p = spawn(cmd)
     result = p.wait()
     if result != 0:
         print >> sys.stderr, "FAIL: Unable to run %s, exit code: %d" % (cmd, result)
@@ -159,162 +449,795 @@ def gitRemove(filename):
     runCommand(['git', 'rm', filename])
 
 
-# Deals with writing all parts of a cset to disk, updating the git index
-# as we go.
-def writeCset(cset):
-    print "%s %s" % (cset.hex(), cset.description())
+def gitCommitterIdent():
+    proc = spawn(['git', 'var', 'GIT_COMMITTER_IDENT'],
+                            stdout=subprocess.PIPE)
+    ident = proc.communicate()[0].strip()
+    if proc.returncode != 0:
+        print >> sys.stderr, "FAIL: Unable to determine the git committer identity"
+        sys.exit(proc.returncode)
+    return ident
+
+
+def gitRevParse(rev):
+    proc = spawn(['git', 'rev-parse', '--verify', '-q', rev],
+                            stdout=subprocess.PIPE)
+    sha = proc.communicate()[0].strip()
+    if proc.returncode != 0:
+        print >> sys.stderr, "FAIL: Unable to resolve git revision %s" % rev
+        sys.exit(proc.returncode)
+    return sha
+
+
+def gitShowFile(rev, filename):
+    proc = spawn(['git', 'show', '%s:%s' % (rev, filename)],
+                 stdout=subprocess.PIPE)
+    data = proc.communicate()[0]
+    if proc.returncode != 0:
+        print >> sys.stderr, "FAIL: Unable to read %s from %s" % (filename, rev)
+        sys.exit(proc.returncode)
+    return data
+
+
+def commitMessage(cset):
+    return "%s\nmozilla-central hg revision: %s" % (cset.description(),
+                                                   cset.hex())
+
 
+def cleanupCommitMessage(message):
+    """
+    Applies the same whitespace clean up that `git commit -m` does, so that
+    commits created via fast-import have identical messages.
+
+    Keyword arguments:
+    message -- the raw commit message
+    """
+    lines = []
+    for line in message.splitlines():
+        line = line.rstrip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+
+    while lines and not lines[-1]:
+        lines.pop()
+
+    return "\n".join(lines) + "\n"
+
+
+def formatAuthor(user):
+    """
+    Splits an hg user string into the "Name <email>" form git expects.
+    """
+    match = re.match(r"^(.*?)\s*<(.*)>\s*$", user)
+    if match:
+        return "%s <%s>" % (match.group(1), match.group(2))
+    return "%s <>" % user.strip()
+
+
+def formatRawDate(date):
+    """
+    Converts an hg (unixtime, offset) tuple into git's raw date format.
+    hg stores the offset in seconds west of UTC, git wants +/-HHMM east.
+    """
+    offset = -date[1]
+    sign = "+" if offset >= 0 else "-"
+    offset = abs(offset)
+    return "%d %s%02d%02d" % (int(date[0]), sign, offset // 3600,
+                              (offset % 3600) // 60)
+
+
+def localRawDate(timestamp):
+    """
+    Formats a unix time in git's raw date format, with the local timezone's
+    offset at that time, as `git commit` does.
+    """
+    if time.localtime(timestamp).tm_isdst > 0:
+        offset = time.altzone
+    else:
+        offset = time.timezone
+    return formatRawDate((timestamp, offset))
+
+
+def readCsetFiles(cset):
+    """
+    Reads the interesting files of a cset from hg.
+
+    Returns a list of (filename, rule, fileData) tuples in the cset's file
+    order, where fileData is None for deleted files.
+
+    Keyword arguments:
+    cset -- the hg changeset to read
+    """
+    files = []
     for filename in cset.files():
-        # Write the files
-        if interestingFilename(filename):
-            newFilename = updatePathsFor(filename)
-            try:
-                fileContext = cset[filename]
-            except:
-                # print "Deleting file %s" % (filename)
-                deleteFile(newFilename)
-                gitRemove(newFilename)
-            else:
+        rule = IMPORT_RULES.match(filename)
+        if rule is None:
+            continue
+
+        try:
+            fileContext = cset[filename]
+        except:
+            files.append((filename, rule, None))
+        else:
+            with metrics.phase("readHgData"):
                 fileData = fileContext.data()
+            files.append((filename, rule, fileData))
+
+    return files
 
-                # For the index file, we preserve the locale data in the file.
-                if isIndexFile(filename):
-                    fileData = preserveLocaleData(newFilename, fileData)
 
-                # print "Writing %s to %s" % (filename, newFilename)
-                writeFile(newFilename, fileData)
-                gitAdd(newFilename)
+def writeCset(cset, backend, files=None):
+    """
+    Deals with writing all parts of a cset via the backend, which takes
+    care of the git side of things.
+
+    Keyword arguments:
+    cset -- the hg changeset to write
+    backend -- a GitIndexBackend or GitFastImportBackend
+    files -- the result of readCsetFiles for the cset, if already read
+    """
+    print "%s %s" % (cset.hex(), cset.description())
+
+    if files is None:
+        files = readCsetFiles(cset)
+
+    for filename, rule, fileData in files:
+        # Write the files
+        newFilename = rule.translatePath(filename)
+        if fileData is None:
+            # print "Deleting file %s" % (filename)
+            with metrics.phase("writeFiles"):
+                if backend.removeFile(newFilename):
+                    metrics.count("filesDeleted")
+        else:
+            fileData = rule.transform(newFilename, fileData,
+                                      lambda: backend.readFile(newFilename))
+
+            # print "Writing %s to %s" % (filename, newFilename)
+            with metrics.phase("writeFiles"):
+                if backend.writeFile(newFilename, fileData):
+                    metrics.count("filesWritten")
+                    metrics.count("bytesWritten", len(fileData))
+
+
+class CsetPrefetcher(object):
+    """
+    Reads the files of upcoming csets on a pool of worker threads, so that
+    revlog decompression overlaps with writing and committing earlier csets.
+
+    Iterating yields (rev, files) in the original order of revs. Workers stop
+    taking new csets once byteBudget bytes of read-ahead data are waiting to
+    be consumed, except for the cset the consumer needs next.
+
+    Keyword arguments:
+    openRepo -- returns a new hg repository object; each worker has its own
+                as repository objects aren't safe to share between threads
+    revs -- the revisions to read, in commit order
+    workers -- the number of worker threads
+    byteBudget -- the maximum number of read-ahead bytes to hold
+    """
+
+    def __init__(self, openRepo, revs, workers, byteBudget):
+        self.revs = list(revs)
+        self.byteBudget = byteBudget
+        self.condition = threading.Condition()
+        # The index in revs of the next cset to hand to a worker.
+        self.nextIndex = 0
+        # The index in revs of the next cset the consumer needs.
+        self.consumeIndex = 0
+        self.results = {}
+        self.bufferedBytes = 0
+        self.error = None
+
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._worker, args=(openRepo,))
+            thread.daemon = True
+            thread.start()
+
+    def _takeIndex(self):
+        with self.condition:
+            while (self.error is None and
+                   self.nextIndex < len(self.revs) and
+                   self.nextIndex != self.consumeIndex and
+                   self.bufferedBytes >= self.byteBudget):
+                self.condition.wait()
+
+            if self.error is not None or self.nextIndex >= len(self.revs):
+                return None
+
+            self.nextIndex += 1
+            return self.nextIndex - 1
+
+    def _worker(self, openRepo):
+        try:
+            hgRepo = openRepo()
+            while True:
+                index = self._takeIndex()
+                if index is None:
+                    return
+
+                files = readCsetFiles(hgRepo[self.revs[index]])
+                size = sum(len(fileData) for _, _, fileData in files
+                           if fileData is not None)
+
+                with self.condition:
+                    self.results[index] = (files, size)
+                    self.bufferedBytes += size
+                    self.condition.notify_all()
+        except:
+            with self.condition:
+                self.error = sys.exc_info()
+                self.condition.notify_all()
+
+    def __iter__(self):
+        for index, rev in enumerate(self.revs):
+            with self.condition:
+                while index not in self.results and self.error is None:
+                    self.condition.wait()
+
+                if index not in self.results:
+                    raise self.error[0], self.error[1], self.error[2]
+
+                files, size = self.results.pop(index)
+                self.bufferedBytes -= size
+                self.consumeIndex = index + 1
+                self.condition.notify_all()
+
+            yield rev, files
 
 
 # Actually commits the cset
 def commitCset(cset):
-    commitMsg = "%s\nmozilla-central hg revision: %s" % (cset.description(),
-                                                         cset.hex())
     csetDate = datetime.fromtimestamp(cset.date()[0],
                                       dateutil.tz.tzoffset(None,
                                                            -cset.date()[1]))
-    runCommand(['git', 'commit', '-m', commitMsg, '--author=' + cset.user(),
-                '--date=' + str(csetDate)])
+    # Changesets may end up not changing anything here, e.g. if they only
+    # touch the locale list in index.html. Commit them anyway, so there's
+    # always one commit per changeset.
+    runCommand(['git', 'commit', '--allow-empty', '-m', commitMessage(cset),
+                '--author=' + cset.user(), '--date=' + str(csetDate)])
 
-def formatCommitMessageLine(line):
-    # Now do translations on the line.
 
+class ImportJournal(object):
+    """
+    A crash-safe record of the progress of an import, so that an interrupted
+    import can be resumed without rescanning or duplicating commits.
+
+    The first line records the git commit the import started from, and each
+    following line an hg revision together with the git commit it became,
+    appended and synced once that commit has landed. A partially written
+    last line is ignored.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.baseCommit = None
+        self.entries = []
+
+        if os.path.exists(filename):
+            inFile = open(filename, "r")
+            for line in inFile:
+                if not line.endswith("\n"):
+                    break
+                fields = line.split()
+                if fields[0] == "base":
+                    self.baseCommit = fields[1]
+                elif fields[0] == "rev":
+                    self.entries.append((fields[1], fields[2]))
+            inFile.close()
+
+    def exists(self):
+        return self.baseCommit is not None
+
+    def lastRevision(self):
+        return self.entries[-1][0] if self.entries else None
+
+    def lastCommit(self):
+        return self.entries[-1][1] if self.entries else self.baseCommit
+
+    def _append(self, line):
+        outFile = open(self.filename, "a")
+        outFile.write(line)
+        outFile.flush()
+        os.fsync(outFile.fileno())
+        outFile.close()
+
+    def start(self, baseCommit):
+        self.baseCommit = baseCommit
+        self.entries = []
+        outFile = open(self.filename, "w")
+        outFile.close()
+        self._append("base %s\n" % baseCommit)
+
+    def record(self, hgRevision, gitCommit):
+        self.entries.append((hgRevision, gitCommit))
+        self._append("rev %s %s\n" % (hgRevision, gitCommit))
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.baseCommit = None
+        self.entries = []
+
+
+HG_REVISION_RE = re.compile(r"^mozilla-central hg revision: ([0-9a-f]{40})$",
+                            re.MULTILINE)
+
+
+def recoverFromJournal(journal, gitRepo):
+    """
+    Brings the git repo back to a consistent state after an interrupted
+    import, so that it can carry on from the last commit in the journal.
+
+    Commits that landed after the last one in the journal, e.g. at a
+    fast-import checkpoint that was interrupted before the journal was
+    written, are recorded from the hg revision in their commit message.
+    """
+    commit = gitRepo.head.commit
+    finished = commit.message.startswith(
+        'update latest merged cset file and CHANGELOG')
+    if finished:
+        # The import had actually finished.
+        commit = commit.parents[0] if len(commit.parents) == 1 else None
+
+    # Walk back from HEAD to the last commit in the journal, collecting the
+    # commits that weren't recorded.
+    unrecorded = []
+    while commit is not None and commit.hexsha != journal.lastCommit():
+        match = HG_REVISION_RE.search(commit.message)
+        if len(commit.parents) != 1 or match is None:
+            commit = None
+            break
+        unrecorded.append((match.group(1), commit.hexsha))
+        commit = commit.parents[0]
+
+    if commit is None:
+        print >> sys.stderr, ("FAIL: HEAD doesn't match the interrupted "
+                              "import in %s, remove it to start again "
+                              "from %s" % (journal.filename, LATEST_REV_FILE))
+        sys.exit(1)
+
+    for hgRevision, gitCommit in reversed(unrecorded):
+        journal.record(hgRevision, gitCommit)
+
+    if finished:
+        journal.remove()
+
+    if gitRepo.is_dirty():
+        print "Discarding partially applied changeset from the interrupted import"
+        runCommand(['git', 'reset', '-q', '--hard', 'HEAD'])
+
+
+def gitBlobHash(fileData):
+    """
+    Returns the sha git would give a blob containing fileData.
+    """
+    return hashlib.sha1("blob %d\0%s" % (len(fileData), fileData)).hexdigest()
+
+
+def gitTreeEntries(commit):
+    """
+    Returns a dict of path -> (mode, blob sha) for every file in commit,
+    read with a single `git ls-tree`.
+    """
+    proc = spawn(['git', 'ls-tree', '-r', '-z', '--full-tree', commit],
+                 stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        print >> sys.stderr, "FAIL: Unable to list the files in %s" % commit
+        sys.exit(proc.returncode)
+
+    entries = {}
+    for entry in output.split("\0"):
+        if entry:
+            info, path = entry.split("\t", 1)
+            mode, kind, sha = info.split()
+            entries[path] = (mode, sha)
+    return entries
+
+
+class GitBackend(object):
+    """
+    Shared parts of the backends. Tracks the blob each path currently has
+    in git, so that writes and deletes which wouldn't change anything can be
+    skipped. writeFile and removeFile return False when they are skipped.
+    """
+
+    def __init__(self, headCommit, journal=None):
+        self.headCommit = headCommit
+        self.journal = journal
+        self.tree = gitTreeEntries(headCommit)
+
+    def readFile(self, filename):
+        return readFile(filename)
+
+    def isUnchanged(self, filename, fileData):
+        """
+        Returns True if filename already has fileData in git, otherwise
+        records the new content and returns False. Like writing the file to
+        the working tree does, the mode git has for the file is kept, and new
+        files are regular files.
+        """
+        sha = gitBlobHash(fileData)
+        existing = self.tree.get(filename)
+        if existing is not None and existing[1] == sha:
+            metrics.count("writesSkipped")
+            return True
+
+        self.tree[filename] = (existing[0] if existing else "100644", sha)
+        return False
+
+    def isMissing(self, filename):
+        """
+        Returns True if filename isn't in git, so there's nothing to delete,
+        otherwise records its deletion and returns False.
+        """
+        if filename not in self.tree:
+            metrics.count("deletesSkipped")
+            return True
+
+        del self.tree[filename]
+        return False
+
+
+class GitIndexBackend(GitBackend):
+    """
+    Applies changesets by writing each file to the working tree, running
+    `git add`/`git rm` per file and `git commit` per changeset.
+    """
+
+    def writeFile(self, filename, fileData):
+        if self.isUnchanged(filename, fileData):
+            return False
+
+        writeFile(filename, fileData)
+        gitAdd(filename)
+        return True
+
+    def removeFile(self, filename):
+        if self.isMissing(filename):
+            return False
+
+        deleteFile(filename)
+        gitRemove(filename)
+        return True
+
+    def commit(self, cset):
+        commitCset(cset)
+        if self.journal:
+            self.journal.record(cset.hex(), gitRevParse("HEAD"))
+
+    def finish(self):
+        pass
+
+
+class GitFastImportBackend(GitBackend):
+    """
+    Streams changesets into a single long-lived `git fast-import` process.
+
+    Nothing touches the working tree or index until finish() is called, at
+    which point they are moved forward to the new branch head in one go.
+    If there's a journal, the branch is checkpointed every
+    checkpointInterval commits and the commits recorded once they've landed.
+    """
+
+    def __init__(self, branch, headCommit, journal=None,
+                 checkpointInterval=DEFAULT_CHECKPOINT_INTERVAL):
+        super(GitFastImportBackend, self).__init__(headCommit, journal)
+        self.ref = "refs/heads/" + branch
+        self.checkpointInterval = checkpointInterval
+        # The identity is "Name <email> date". Like `git commit`, each
+        # commit gets the time it's made, unless GIT_COMMITTER_DATE fixes it.
+        ident = gitCommitterIdent().rsplit(" ", 2)
+        self.committer = ident[0]
+        self.committerDate = None
+        if os.environ.get("GIT_COMMITTER_DATE"):
+            self.committerDate = " ".join(ident[1:])
+        self.mark = 0
+        self.changes = []
+        # Commits that haven't been checkpointed yet, as (hg revision, mark).
+        self.uncheckpointed = []
+        # The latest content of every path written during this import, so
+        # that reads see earlier changesets. None means deleted.
+        self.pending = {}
+        self.proc = spawn(['git', 'fast-import', '--quiet', '--date-format=raw'],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.proc.stdin.write("feature get-mark\n")
+        # Without this, fast-import treats the end of its input as a normal
+        # finish and moves the branch forward, even if we were interrupted
+        # part way through a changeset.
+        self.proc.stdin.write("feature done\n")
+
+    def _writeData(self, data):
+        self.proc.stdin.write("data %d\n" % len(data))
+        self.proc.stdin.write(data)
+        self.proc.stdin.write("\n")
+
+    def readFile(self, filename):
+        if filename in self.pending:
+            if self.pending[filename] is None:
+                raise IOError("%s was deleted earlier in this import" % filename)
+            return self.pending[filename]
+        return readFile(filename)
+
+    def writeFile(self, filename, fileData):
+        if self.isUnchanged(filename, fileData):
+            return False
+
+        self.pending[filename] = fileData
+        self.changes.append((filename, fileData, self.tree[filename][0]))
+        return True
+
+    def removeFile(self, filename):
+        if self.isMissing(filename):
+            return False
+
+        self.pending[filename] = None
+        self.changes.append((filename, None, None))
+        return True
+
+    def commit(self, cset):
+        self.mark += 1
+        stream = self.proc.stdin
+        stream.write("commit %s\n" % self.ref)
+        stream.write("mark :%d\n" % self.mark)
+        stream.write("author %s %s\n" % (formatAuthor(cset.user()),
+                                         formatRawDate(cset.date())))
+        stream.write("committer %s %s\n" % (
+            self.committer, self.committerDate or localRawDate(time.time())))
+        self._writeData(cleanupCommitMessage(commitMessage(cset)))
+        if self.mark == 1:
+            stream.write("from %s\n" % self.headCommit)
+
+        for filename, fileData, mode in self.changes:
+            if fileData is None:
+                stream.write("D %s\n" % filename)
+            else:
+                stream.write("M %s inline %s\n" % (mode, filename))
+                self._writeData(fileData)
+        stream.write("\n")
+
+        self.changes = []
+
+        if self.journal:
+            self.uncheckpointed.append((cset.hex(), self.mark))
+            if len(self.uncheckpointed) >= self.checkpointInterval:
+                self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Makes fast-import write out everything so far and update the branch,
+        then records the new commits in the journal.
+        """
+        if not self.uncheckpointed:
+            return
+
+        stream = self.proc.stdin
+        stream.write("checkpoint\n\n")
+        for hgRevision, mark in self.uncheckpointed:
+            stream.write("get-mark :%d\n" % mark)
+        stream.flush()
+
+        # Commands are processed in order, so once the marks come back the
+        # checkpoint has completed.
+        for hgRevision, mark in self.uncheckpointed:
+            self.journal.record(hgRevision, self.proc.stdout.readline().strip())
+
+        self.uncheckpointed = []
+
+    def finish(self):
+        self.checkpoint()
+
+        self.proc.stdin.write("done\n")
+        self.proc.stdin.close()
+        result = self.proc.wait()
+        if result != 0:
+            print >> sys.stderr, "FAIL: git fast-import failed, exit code: %d" % result
+            sys.exit(result)
+
+        if self.mark == 0:
+            return
+
+        # Bring the index and working tree up to the new head.
+        runCommand(['git', 'read-tree', '-m', '-u', self.headCommit,
+                    gitRevParse(self.ref)])
+
+
+# Translations applied, in order, to each commit message line for the
+# CHANGELOG.
+CHANGELOG_LINE_RULES = [
     # First, strip off any review flags from the end of line.
-    line = re.sub(r"""
+    (re.compile(r"""
      \ *         # Match any number of spaces
      \[*         # Match none or more of `[`, don't worry about `]` - some commit messages do `[r=smith]`
      rs*         # Match r or rs
      \=.*        # Match = and the rest of the line.
-    """, "", line, 0, re.VERBOSE)
+    """, re.VERBOSE), ""),
 
     # Now change any ': ' to dashes - some people use "Bug 123456: ..."
-    line = re.sub(r": ", " - ", line)
+    (re.compile(r": "), " - "),
 
     # Next change any '123456-' to add a space either side of the dash.
     # Some people do 'Bug 123456-...'.
-    line = re.sub(r"\([0-9]]\)-", r"\1 - ", line)
+    (re.compile(r"\([0-9]]\)-"), r"\1 - "),
 
     # Now replace any commas at the end of the line with dots.
-    line = re.sub(r",$", ".", line)
+    (re.compile(r",$"), "."),
+]
+
+
+def formatCommitMessageLine(line):
+    # Now do translations on the line.
+    for regexp, replacement in CHANGELOG_LINE_RULES:
+        line = regexp.sub(replacement, line)
 
     # Finally insert '- ' at start of line for changelog formatting.
     return "- " + line
 
 
-def insertGitChanges(gitRepo, headGitCommit, outFile):
-    proc = subprocess.Popen(
-        ['git', 'log',
+def getGitChanges(gitRepo, headGitCommit):
+    """
+    Returns the formatted CHANGELOG lines for the commits since
+    headGitCommit, oldest first, from a single read of `git log -z`.
+    """
+    proc = spawn(
+        ['git', 'log', '-z',
          headGitCommit + ".." + gitRepo.head.object.hexsha,
          "--decorate=no",
          "--reverse",
          "--format=format:%s"],
         stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise Exception("git log exited with code %d" % proc.returncode)
 
-    while True:
-        line = proc.stdout.readline()
-        if line == '':
-            break
-
-        # We shouldn't ever hit this, but just in case...
-        if line.startswith('update latest merged cset file and CHANGELOG'):
-            continue
-
-        outFile.write(formatCommitMessageLine(line) + "\n")
+    return [formatCommitMessageLine(subject) + "\n"
+            for subject in output.split("\0")
+            # We shouldn't ever hit the second case, but just in case...
+            if subject and
+            not subject.startswith('update latest merged cset file and CHANGELOG')]
 
 
-def writeChangeLog(gitRepo, headGitCommit):
-    inFile = open(CHANGELOG_FILE, "r")
-    oldLines = inFile.readlines()
-    inFile.close()
+def spliceChangeLog(inFile, outFile, newLines):
+    """
+    Copies inFile to outFile, inserting newLines at the end of the TBD
+    section.
 
-    outFile = open(CHANGELOG_FILE, "w")
+    We hunt down to the first TBD followed by "---" and then look for the next
+    "---", which underlines the previous release. The new lines go before the
+    blank line and release title that precede it.
+    """
     foundTBD = False
     foundFirstDashes = False
-    outBuffer = []
-
-    continuationIndex = 0
-
-    # Find where to insert the new lines. We hunt down to the first TBD followed
-    # by "---" and then look for the next one. Note that 'i' gets used in the for
-    # statement lower down to finish writing the file.
-    for i in xrange(len(oldLines)):
-        line = oldLines[i]
-        strippedLine = line.rstrip('\n')
+    # The last two lines of the TBD section, held back until we know whether
+    # they are the start of the previous release's heading.
+    heldLines = []
 
+    for line in inFile:
         if foundTBD and foundFirstDashes:
             if line.startswith("---"):
-                # Now we've found the dashes, print the buffer and adjust the index
-                # so that we're ready for later.
-                for bufferLine in outBuffer[:-2]:
-                    outFile.write(bufferLine)
-
-                continuationIndex = i - 2
-                break
-
-            outBuffer.append(line)
-
+                outFile.writelines(newLines)
+                outFile.writelines(heldLines)
+                outFile.write(line)
+                # The rest of the file can be copied as-is.
+                shutil.copyfileobj(inFile, outFile)
+                return
+
+            heldLines.append(line)
+            if len(heldLines) > 2:
+                outFile.write(heldLines.pop(0))
         else:
-            if strippedLine == "TBD":
+            if line.rstrip('\n') == "TBD":
                 foundTBD = True
             elif foundTBD and line.startswith("---"):
                 foundFirstDashes = True
 
             outFile.write(line)
 
-    # Now get the git log entries and add them to the file. If this fails, we
-    # still finish writing the CHANGELOG, so as to not leave the repo in a totally
+    # There's no previous release, so the TBD section runs to the end.
+    outFile.writelines(heldLines)
+    outFile.writelines(newLines)
+
+
+def writeChangeLog(gitRepo, headGitCommit):
+    # Get the git log entries to add to the file first. If this fails, we
+    # still rewrite the CHANGELOG, so as to not leave the repo in a totally
     # bad state.
     try:
-        insertGitChanges(gitRepo, headGitCommit, outFile)
+        newLines = getGitChanges(gitRepo, headGitCommit)
     except Exception, e:
-        print >> sys.stderr, "Running insertGitChanges failed: ", e
-
-    # Finally output the rest of the changelog.
-    for i in xrange(continuationIndex, len(oldLines)):
-        outFile.write(oldLines[i])
-
-    outFile.close()
+        print >> sys.stderr, "Running getGitChanges failed: ", e
+        newLines = []
+
+    # Write to a temporary file alongside the CHANGELOG and rename it over the
+    # top, so the CHANGELOG is never left half-written.
+    directory = os.path.dirname(os.path.abspath(CHANGELOG_FILE))
+    outFile = tempfile.NamedTemporaryFile(dir=directory, prefix=".CHANGELOG.",
+                                          delete=False)
+    try:
+        with open(CHANGELOG_FILE, "r") as inFile:
+            spliceChangeLog(inFile, outFile, newLines)
+        outFile.close()
+        shutil.copymode(CHANGELOG_FILE, outFile.name)
+        os.rename(outFile.name, CHANGELOG_FILE)
+    except:
+        outFile.close()
+        os.remove(outFile.name)
+        raise
 
 
 # Outputs to the lastest revision file
-def writeLatestRevAndChangeLog(gitRepo, headGitCommit, cset):
+def writeLatestRevAndChangeLog(gitRepo, headGitCommit, cset,
+                               revFile=LATEST_REV_FILE):
     writeChangeLog(gitRepo, headGitCommit)
     gitAdd(CHANGELOG_FILE)
 
-    outFile = open(LATEST_REV_FILE, "w")
+    outFile = open(revFile, "w")
     outFile.write(cset.hex() + "\n")
     outFile.close()
 
-    gitAdd(LATEST_REV_FILE)
+    gitAdd(revFile)
     runCommand(['git', 'commit', '-m', 'update latest merged cset file and CHANGELOG'])
 
 
 def pullHg(hgRepo, hgUI, sourceURL, sourceBranch):
-    # And update it
-    if commands.incoming(hgUI, hgRepo, source=sourceURL, bundle=None,
-                         force=None) == 0:
-        commands.pull(hgUI, hgRepo, source=sourceURL)
+    """
+    Pulls new changesets into the repository and updates it if there were
+    any. Returns the number of changesets pulled.
+
+    This doesn't check "hg incoming" first, as that fetches the changesets
+    only for the pull to fetch them all over again.
+    """
+    oldLength = len(hgRepo)
+    commands.pull(hgUI, hgRepo, source=sourceURL)
+    pulled = len(hgRepo) - oldLength
+    if pulled:
         commands.update(hgUI, hgRepo, rev=sourceBranch)
+    return pulled
+
+
+class HgPuller(object):
+    """
+    Pulls the hg repository on a background thread, so that changesets that
+    are already local can be imported while waiting on the network. Reading
+    the revlogs while a pull appends to them is safe, as hg readers don't
+    need the repository lock.
+
+    Keyword arguments:
+    openRepo -- returns a new hg repository object; the puller has its own,
+                as repository objects aren't safe to share between threads
+    sourceURL -- the repository to pull from
+    sourceBranch -- the branch to update to after pulling
+    """
+
+    def __init__(self, openRepo, sourceURL, sourceBranch):
+        self.pulled = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run,
+                                       args=(openRepo, sourceURL, sourceBranch))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, openRepo, sourceURL, sourceBranch):
+        startTime = time.time()
+        try:
+            hgRepo = openRepo()
+            self.pulled = pullHg(hgRepo, hgRepo.ui, sourceURL, sourceBranch)
+        except:
+            self.error = sys.exc_info()
+        metrics.addPhaseTime("pullHg", time.time() - startTime)
+
+    def wait(self):
+        """
+        Waits for the pull to finish, and returns the number of changesets
+        pulled.
+        """
+        with metrics.phase("pullHgWait"):
+            self.thread.join()
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.pulled
 
 
 def pullGit(branch):
@@ -325,6 +1248,164 @@ def pushGit(branch):
     runCommand(['git', 'push', '-q', 'origin', branch])
 
 
+class ImportTarget(object):
+    """
+    One hg branch to import into a git branch, as given to --target in the
+    form HG_BRANCH:GIT_BRANCH[:REV_FILE].
+    """
+
+    def __init__(self, spec):
+        parts = spec.split(":")
+        if len(parts) not in (2, 3) or not all(parts):
+            raise argparse.ArgumentTypeError(
+                "expected HG_BRANCH:GIT_BRANCH[:REV_FILE], got %r" % spec)
+
+        self.hgBranch = parts[0]
+        self.gitBranch = parts[1]
+        self.revFile = parts[2] if len(parts) == 3 else LATEST_REV_FILE
+        # Used for the worktree and metrics file names.
+        self.name = re.sub(r"[^\w.-]+", "_", self.gitBranch)
+        self.worktree = None
+        self.firstRev = None
+        self.headRev = None
+
+
+def prepareWorktree(gitRepo, target, worktreesDir):
+    """
+    Returns the directory to import the target in: the current one if the
+    target's git branch is checked out here, otherwise a git worktree for the
+    branch, which is created the first time and reused after that.
+    """
+    if target.gitBranch == gitRepo.active_branch.name:
+        return os.getcwd()
+
+    path = os.path.join(worktreesDir, target.name)
+    if not os.path.isdir(path):
+        runCommand(['git', 'worktree', 'add', path, target.gitBranch])
+    return path
+
+
+def runTarget(target, indexFile, metricsFile, args):
+    """
+    Imports one target by running this script in the target's worktree with
+    the revisions already found for it. Returns the exit code.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__),
+           '--skip-pull-hg',
+           '--source-clone', os.path.abspath(args.source_clone),
+           '--source-branch', target.hgBranch,
+           '--rev-file', target.revFile,
+           '--relevant-revs', indexFile,
+           '--prefetch-workers', str(args.prefetch_workers),
+           '--prefetch-budget', str(args.prefetch_budget),
+           '--checkpoint-interval', str(args.checkpoint_interval)]
+    if not args.pull_git:
+        cmd.append('--skip-pull-git')
+    if not args.fast_import:
+        cmd.append('--per-file-git')
+    if args.push_result:
+        cmd.append('--push-result')
+    if metricsFile:
+        cmd.extend(['--metrics-json', metricsFile])
+
+    startTime = time.time()
+    proc = spawn(cmd, cwd=target.worktree, stdout=subprocess.PIPE,
+                 stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, ""):
+        sys.stdout.write("[%s] %s" % (target.gitBranch, line))
+        sys.stdout.flush()
+    result = proc.wait()
+    metrics.addPhaseTime("target:" + target.name, time.time() - startTime)
+
+    if metricsFile and os.path.exists(metricsFile):
+        with open(metricsFile) as f:
+            metrics.addTarget(target.gitBranch, json.load(f))
+
+    return result
+
+
+def runTargets(args):
+    """
+    Imports several hg branches into their git branches. The path-filtered
+    scan for relevant changesets is done once for all of them; each target
+    then only needs to pick out the ones on its branch. The targets are
+    imported in parallel, each in its own git worktree and process, so each
+    has its own journal to resume from, and its own metrics.
+    """
+    targets = args.targets
+    gitBranches = [target.gitBranch for target in targets]
+    if len(set(gitBranches)) != len(gitBranches):
+        print >> sys.stderr, "FAIL: Each target needs a different git branch"
+        sys.exit(1)
+
+    gitRepo = Repo(".")
+    assert gitRepo.bare is False
+
+    hgUI = ui.ui()
+    hgRepo = hg.repository(hgUI, args.source_clone)
+
+    if args.pull_hg:
+        with metrics.phase("pullHg"):
+            pullHg(hgRepo, hgUI, args.source_repo, args.source_branch)
+
+    for target in targets:
+        revText = gitShowFile(target.gitBranch, target.revFile).strip()
+        target.firstRev = hgRepo[revText].rev() + 1
+        target.headRev = hgRepo[target.hgBranch].rev()
+
+    firstRev = min(target.firstRev for target in targets)
+    with metrics.phase("scan"):
+        # Checking the targets' heads finds the changes that reach their
+        # branches through changesets the filelogs don't link to, such as
+        # uplifts of changes that first landed elsewhere.
+        revs = relevantRevisions(hgRepo, firstRev,
+                                 [target.headRev for target in targets])
+    metrics.count("changesetsMatched", len(revs))
+
+    worktreesDir = os.path.abspath(args.worktree_dir or
+                                   os.path.join(gitRepo.git_dir,
+                                                TARGET_WORKTREES_DIR))
+    if not os.path.isdir(worktreesDir):
+        os.makedirs(worktreesDir)
+    # Forget about any worktrees that have been deleted.
+    runCommand(['git', 'worktree', 'prune'])
+
+    jobs = []
+    for target in targets:
+        with metrics.phase("scanTarget"):
+            onBranch = set(hgRepo.revs("%d: and ::%d", target.firstRev,
+                                       target.headRev))
+        targetRevs = [rev for rev in revs if rev in onBranch]
+        print "%s: %d changesets to import from %s" % (
+            target.gitBranch, len(targetRevs), target.hgBranch)
+
+        target.worktree = prepareWorktree(gitRepo, target, worktreesDir)
+
+        indexFile = os.path.join(worktreesDir, target.name + ".revs.json")
+        with open(indexFile, "w") as f:
+            json.dump({"revs": targetRevs,
+                       "head": hgRepo[target.headRev].hex()}, f)
+
+        metricsFile = None
+        if args.metrics_json:
+            metricsFile = os.path.abspath("%s.%s.json" % (
+                os.path.splitext(args.metrics_json)[0], target.name))
+        jobs.append((target, indexFile, metricsFile))
+
+    pool = ThreadPool(max(1, min(args.target_jobs, len(jobs))))
+    try:
+        results = pool.map(lambda job: runTarget(job[0], job[1], job[2], args),
+                           jobs)
+    finally:
+        pool.close()
+
+    failed = [target.gitBranch for target, result in zip(targets, results)
+              if result != 0]
+    if failed:
+        print >> sys.stderr, "FAIL: Importing into %s failed" % ", ".join(failed)
+        sys.exit(1)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--push-result', dest='push_result',
@@ -345,70 +1426,227 @@ def main():
     parser.add_argument('--skip-pull-hg', dest='pull_hg',
                         action='store_false', default=True,
                         help='Skips pulling the hg repo. Useful for local testing.')
+    parser.add_argument('--pipeline-pull', dest='pipeline_pull',
+                        action='store_true', default=False,
+                        help='Pull the hg repo in the background while '
+                             'importing the changesets that are already local')
+    parser.add_argument('--rev-file', dest='rev_file',
+                        action='store', default=LATEST_REV_FILE, metavar='PATH',
+                        help='File recording the last imported hg revision '
+                             '(default: %s)' % LATEST_REV_FILE)
+    parser.add_argument('--target', dest='targets',
+                        action='append', type=ImportTarget, default=[],
+                        metavar='HG_BRANCH:GIT_BRANCH[:REV_FILE]',
+                        help='Import an hg branch into a git branch, in its own '
+                             'git worktree. May be given several times to '
+                             'import several branches from one scan')
+    parser.add_argument('--target-jobs', dest='target_jobs',
+                        action='store', type=int,
+                        default=DEFAULT_TARGET_JOBS, metavar='N',
+                        help='Number of targets to import in parallel '
+                             '(default: %d)' % DEFAULT_TARGET_JOBS)
+    parser.add_argument('--worktree-dir', dest='worktree_dir',
+                        action='store', default=None, metavar='PATH',
+                        help='Where to keep the git worktrees for --target '
+                             '(default: %s in the git directory)' % TARGET_WORKTREES_DIR)
+    # Used by --target to hand each target its share of the scan.
+    parser.add_argument('--relevant-revs', dest='relevant_revs',
+                        action='store', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--per-file-git', dest='fast_import',
+                        action='store_false', default=True,
+                        help='Commit via git add/rm/commit per file instead of '
+                             'streaming into git fast-import')
+    parser.add_argument('--prefetch-workers', dest='prefetch_workers',
+                        action='store', type=int,
+                        default=DEFAULT_PREFETCH_WORKERS, metavar='N',
+                        help='Threads reading upcoming changesets from hg, 0 '
+                             'to disable (default: %d)' % DEFAULT_PREFETCH_WORKERS)
+    parser.add_argument('--prefetch-budget', dest='prefetch_budget',
+                        action='store', type=int,
+                        default=DEFAULT_PREFETCH_BUDGET, metavar='MB',
+                        help='Maximum read-ahead file data to hold in memory '
+                             '(default: %d)' % DEFAULT_PREFETCH_BUDGET)
+    parser.add_argument('--checkpoint-interval', dest='checkpoint_interval',
+                        action='store', type=int,
+                        default=DEFAULT_CHECKPOINT_INTERVAL, metavar='N',
+                        help='Number of commits between fast-import '
+                             'checkpoints (default: %d)' % DEFAULT_CHECKPOINT_INTERVAL)
+    parser.add_argument('--metrics-json', dest='metrics_json',
+                        action='store', default=None, metavar='PATH',
+                        help='Write per-phase timings and counts to PATH as JSON')
+    parser.add_argument('--profile', dest='profile',
+                        action='store', default=None, metavar='PATH',
+                        help='Write cProfile statistics for the run to PATH')
 
     args = parser.parse_args()
 
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        with metrics.phase("total"):
+            if args.targets:
+                runTargets(args)
+            else:
+                runImport(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+        if args.metrics_json:
+            metrics.write(args.metrics_json)
+
+
+def importRevisions(hgRepo, openRepo, firstRev, backend, journal,
+                    baseGitCommit, args, knownRevs=None):
+    """
+    Imports the changesets from firstRev onwards that affect loop via the
+    backend. Merges are skipped, as their changes are imported via their
+    parents.
+
+    knownRevs, if given, are the relevant revisions found by an earlier
+    scan, and are used instead of scanning again.
+    """
+    if knownRevs is not None:
+        revs = [rev for rev in knownRevs if rev >= firstRev]
+    else:
+        with metrics.phase("scan"):
+            revs = relevantRevisions(hgRepo, firstRev)
+    metrics.count("changesetsMatched", len(revs))
+
+    if revs and not journal.exists():
+        journal.start(baseGitCommit)
+
+    if args.prefetch_workers > 0:
+        csets = CsetPrefetcher(openRepo, revs, args.prefetch_workers,
+                               args.prefetch_budget * 1024 * 1024)
+    else:
+        csets = ((i, None) for i in revs)
+
+    for i, files in csets:
+        cset = hgRepo[i]
+
+        # Create a new index for the repo (indexes get translated
+        # into commits)
+        # Write the cset, then commit it.
+        with metrics.phase("writeCset"):
+            writeCset(cset, backend, files)
+        with metrics.phase("commit"):
+            backend.commit(cset)
+
+
+def runImport(args):
     # First of all, check we're up to date for the git repo.
     gitRepo = Repo(".")
     assert gitRepo.bare is False
+
+    journal = ImportJournal(os.path.join(gitRepo.git_dir, IMPORT_JOURNAL_FILE))
+    if journal.exists():
+        print "Resuming interrupted import from %s" % journal.filename
+        recoverFromJournal(journal, gitRepo)
+
     assert gitRepo.is_dirty() is False
 
     if args.pull_git:
-        pullGit(gitRepo.active_branch.name)
+        with metrics.phase("pullGit"):
+            pullGit(gitRepo.active_branch.name)
 
     headGitCommit = gitRepo.head.object.hexsha
 
     # Find out the last revision we checked against
-    lastestRevFile = open(LATEST_REV_FILE, "r")
+    lastestRevFile = open(args.rev_file, "r")
     firstRevText = lastestRevFile.read().strip()
     lastestRevFile.close()
 
+    # If we're resuming, carry on from the last changeset that was committed,
+    # and include everything since the original start in the CHANGELOG.
+    if journal.exists():
+        baseGitCommit = journal.baseCommit
+        firstRevText = journal.lastRevision() or firstRevText
+    else:
+        baseGitCommit = headGitCommit
+
     # Open the Mercurial repo...
-    hgUI = ui.ui()
-    hgRepo = hg.repository(hgUI, args.source_clone)
+    openRepo = lambda: hg.repository(ui.ui(), args.source_clone)
+    hgRepo = openRepo()
 
+    puller = None
     if args.pull_hg:
-        pullHg(hgRepo, hgUI, args.source_repo, args.source_branch)
+        if args.pipeline_pull:
+            puller = HgPuller(openRepo, args.source_repo, args.source_branch)
+        else:
+            with metrics.phase("pullHg"):
+                pullHg(hgRepo, hgRepo.ui, args.source_repo, args.source_branch)
+
+    # The last imported changeset is normally local already, but if it isn't
+    # there's nothing to do until the pull brings it in.
+    if puller is not None and firstRevText not in hgRepo:
+        puller.wait()
+        puller = None
+        hgRepo = openRepo()
 
-    committedFiles = False
     firstRev = hgRepo[firstRevText].rev() + 1
 
-    print "Starting at %s" % (hgRepo[firstRev].hex())
+    if firstRev < len(hgRepo):
+        print "Starting at %s" % (hgRepo[firstRev].hex())
 
-    # Now work through any new changesets
-    for i in xrange(firstRev, len(hgRepo)):
-        cset = hgRepo[i]
+    if args.fast_import:
+        backend = GitFastImportBackend(gitRepo.active_branch.name,
+                                       headGitCommit, journal,
+                                       args.checkpoint_interval)
+    else:
+        backend = GitIndexBackend(headGitCommit, journal)
 
-        # Use the very last cset, not the one that affects loop,
-        # to avoid attempting to port the same cset all the time
-        lastCset = cset
+    # Import the changesets that are local now, then, if a pull is running,
+    # wait for it and carry on with the ones it brought in. Pulled changesets
+    # always get higher revision numbers, so they follow on in order.
+    knownRevs = None
+    if args.relevant_revs:
+        with open(args.relevant_revs) as f:
+            index = json.load(f)
+        knownRevs = index["revs"]
 
-        if len(cset.parents()) > 1:
-            continue
+    while True:
+        importRevisions(hgRepo, openRepo, firstRev, backend, journal,
+                        baseGitCommit, args, knownRevs)
+        firstRev = max(firstRev, len(hgRepo))
+
+        if puller is None:
+            break
+        pulled = puller.wait()
+        puller = None
+        if not pulled:
+            break
+        hgRepo = openRepo()
 
-        affectsLoop = False
-        # If one of the files is interesting to loop, then we need to
-        # do the whole changeset
-        for filename in cset.files():
-            if interestingFilename(filename):
-                print filename
-                affectsLoop = True
-                break
-
-        if affectsLoop:
-            # Create a new index for the repo (indexes get translated
-            # into commits)
-            # Write the cset, then commit it.
-            writeCset(cset)
-            commitCset(cset)
-            committedFiles = True
+    # Use the very last cset, not the one that affects loop,
+    # to avoid attempting to port the same cset all the time. When importing
+    # a --target, that's the last cset on its branch.
+    if knownRevs is not None:
+        lastCset = hgRepo[str(index["head"])]
+    else:
+        lastCset = hgRepo[len(hgRepo) - 1]
+
+    with metrics.phase("finishCommits"):
+        backend.finish()
 
     # Only bother committing and pushing if we've updated the files.
+    committedFiles = bool(journal.entries)
     if committedFiles:
-        writeLatestRevAndChangeLog(gitRepo, headGitCommit, lastCset)
+        with metrics.phase("writeLatestRevAndChangeLog"):
+            writeLatestRevAndChangeLog(gitRepo, baseGitCommit, lastCset,
+                                       args.rev_file)
 
-        if args.push_result:
+    # Once the CHANGELOG is committed there's nothing left to resume.
+    journal.remove()
+
+    if committedFiles and args.push_result:
+        with metrics.phase("pushGit"):
             pushGit(gitRepo.active_branch.name)
 
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+
+##
+# This script fingerprints the static assets of the dist build, so that they
+# can be served with far-future cache headers and never need revalidating.
+#
+# Run it after the dist directory has been built (make dist does this). Each
+# file referenced from the index file, and each file those reference from
+# CSS url()s, is copied to a name with a hash of its content in it, e.g.
+# shared/css/common.css -> shared/css/common.0123456789ab.css, and the
+# references are rewritten to match. The original files are kept, so that
+# anything loading them by a computed name (like the OpenTok SDK, or images
+# referenced from JS) still works.
+#
+# The localization link is a template with a {locale} placeholder, so all of
+# its locale files get one combined hash, and the template keeps working for
+# whichever locale gets negotiated at runtime.
+#
+# Text files also get gzip (and brotli if available) compressed siblings,
+# and an asset manifest mapping the original names to the fingerprinted ones
+# is written to the dist directory.
+##
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+from multiprocessing.pool import ThreadPool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEF_DIST_DIR = "dist"
+DEF_INDEX_FILE_NAME = "index.html"
+DEF_MANIFEST_FILE_NAME = "asset-manifest.json"
+DEF_JOBS = 8
+HASH_LENGTH = 12
+LOCALE_PLACEHOLDER = "{locale}"
+COMPRESSIBLE_EXTENSIONS = frozenset([".css", ".html", ".ico", ".js", ".json",
+                                     ".properties", ".svg", ".txt"])
+
+INDEX_REFERENCE_RE = re.compile(
+    r"""(<(?:link|script|img)\b[^>]*?\b(?:href|src)=")([^"]+)(")""", re.I)
+CSS_URL_RE = re.compile(r"""(url\(\s*["']?)([^"')]+?)(["']?\s*\))""")
+FINGERPRINTED_RE = re.compile(r"\.[0-9a-f]{%d}\.[^./]+$" % HASH_LENGTH)
+EXTERNAL_URL_RE = re.compile(r"^(?:[a-z][a-z0-9+.-]*:|/)", re.I)
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()[:HASH_LENGTH]
+
+
+def fingerprinted_name(path, digest):
+    base, ext = os.path.splitext(path)
+    return "%s.%s%s" % (base, digest, ext)
+
+
+def read_file(path):
+    with io.open(path, "rb") as f:
+        return f.read()
+
+
+def write_file(path, data):
+    with io.open(path, "wb") as f:
+        f.write(data)
+
+
+def split_url(url):
+    """
+    Splits the query and fragment off a relative url, returning None for
+    urls that don't refer to a local file.
+    """
+    if EXTERNAL_URL_RE.match(url):
+        return None
+    match = re.match(r"^([^?#]*)(.*)$", url)
+    return match.group(1), match.group(2)
+
+
+class AssetFingerprinter(object):
+    """
+    Fingerprints the files in the dist directory as they're referenced,
+    rewriting the references in CSS files before hashing them.
+    """
+
+    def __init__(self, dist_dir):
+        self.dist_dir = dist_dir
+        # Maps the original paths, relative to dist_dir, to their
+        # fingerprinted ones.
+        self.manifest = {}
+
+    def fingerprint_reference(self, url, base_dir):
+        """
+        Returns url, relative to base_dir, with the file it refers to
+        fingerprinted, or unchanged if it doesn't refer to a dist file.
+        """
+        parts = split_url(url)
+        if parts is None or not parts[0]:
+            return url
+        path, suffix = parts
+
+        rel_path = os.path.normpath(os.path.join(base_dir, path)).replace(os.sep, "/")
+        if LOCALE_PLACEHOLDER in rel_path:
+            new_path = self.fingerprint_template(rel_path)
+        else:
+            new_path = self.fingerprint_file(rel_path)
+        if new_path is None:
+            return url
+
+        new_url = os.path.relpath(new_path, base_dir or ".").replace(os.sep, "/")
+        return new_url + suffix
+
+    def fingerprint_file(self, rel_path):
+        if rel_path in self.manifest:
+            return self.manifest[rel_path]
+
+        path = os.path.join(self.dist_dir, rel_path)
+        if rel_path.startswith("..") or not os.path.isfile(path):
+            return None
+        if FINGERPRINTED_RE.search(rel_path):
+            # Already done by an earlier run.
+            return rel_path
+
+        data = read_file(path)
+        if rel_path.endswith(".css"):
+            data = self.rewrite_css(data, os.path.dirname(rel_path))
+
+        new_path = fingerprinted_name(rel_path, content_hash(data))
+        write_file(os.path.join(self.dist_dir, new_path), data)
+        shutil.copymode(path, os.path.join(self.dist_dir, new_path))
+
+        self.manifest[rel_path] = new_path
+        return new_path
+
+    def fingerprint_template(self, rel_path):
+        """
+        Fingerprints every file that the {locale} template path expands to
+        with the same combined hash, and returns the new template.
+        """
+        if rel_path in self.manifest:
+            return self.manifest[rel_path]
+
+        prefix, suffix = rel_path.split(LOCALE_PLACEHOLDER, 1)
+        locales_dir = os.path.join(self.dist_dir, prefix)
+        if not os.path.isdir(locales_dir):
+            return None
+
+        files = []
+        for locale in sorted(os.listdir(locales_dir)):
+            locale_path = prefix + locale + suffix
+            if os.path.isfile(os.path.join(self.dist_dir, locale_path)):
+                files.append(locale_path)
+        if not files:
+            return None
+
+        combined = hashlib.sha1()
+        for locale_path in files:
+            combined.update(locale_path.encode("utf-8"))
+            combined.update(read_file(os.path.join(self.dist_dir, locale_path)))
+        digest = combined.hexdigest()[:HASH_LENGTH]
+
+        for locale_path in files:
+            new_path = fingerprinted_name(locale_path, digest)
+            shutil.copy2(os.path.join(self.dist_dir, locale_path),
+                         os.path.join(self.dist_dir, new_path))
+            self.manifest[locale_path] = new_path
+
+        new_template = fingerprinted_name(rel_path, digest)
+        self.manifest[rel_path] = new_template
+        return new_template
+
+    def rewrite_css(self, data, base_dir):
+        css = data.decode("utf-8")
+
+        def replace(match):
+            return match.group(1) + \
+                self.fingerprint_reference(match.group(2), base_dir) + \
+                match.group(3)
+
+        return CSS_URL_RE.sub(replace, css).encode("utf-8")
+
+    def rewrite_index(self, index_file_name):
+        base_dir = os.path.dirname(
+            os.path.relpath(index_file_name, self.dist_dir)).replace(os.sep, "/")
+
+        with io.open(index_file_name, "r", encoding="utf-8") as index_file:
+            index_html = index_file.read()
+
+        def replace(match):
+            return match.group(1) + \
+                self.fingerprint_reference(match.group(2), base_dir) + \
+                match.group(3)
+
+        new_content = INDEX_REFERENCE_RE.sub(replace, index_html)
+        if new_content != index_html:
+            with io.open(index_file_name, "w", encoding="utf-8") as index_file:
+                index_file.write(new_content)
+
+
+def compress_file(path):
+    """
+    Writes the gzip and brotli compressed siblings of a file, if they're
+    smaller than it. Returns the sizes of the file and of each sibling.
+    """
+    data = read_file(path)
+    sizes = {"raw": len(data)}
+
+    raw = io.BytesIO()
+    # A fixed mtime keeps the output identical between builds.
+    with gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as f:
+        f.write(data)
+    if raw.tell() < len(data):
+        write_file(path + ".gz", raw.getvalue())
+        sizes["gz"] = raw.tell()
+
+    if brotli:
+        compressed = brotli.compress(data)
+        if len(compressed) < len(data):
+            write_file(path + ".br", compressed)
+            sizes["br"] = len(compressed)
+
+    return sizes
+
+
+def fingerprint_dist(dist_dir, index_file_name, manifest_file_name, jobs=DEF_JOBS):
+    print("fingerprinting assets referenced from", index_file_name)
+    if not brotli:
+        print("brotli module not found, skipping .br files")
+
+    fingerprinter = AssetFingerprinter(dist_dir)
+    fingerprinter.rewrite_index(index_file_name)
+    manifest = fingerprinter.manifest
+
+    to_compress = [os.path.join(dist_dir, new_path)
+                   for original, new_path in sorted(manifest.items())
+                   if LOCALE_PLACEHOLDER not in original and
+                   os.path.splitext(new_path)[1] in COMPRESSIBLE_EXTENSIONS]
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(compress_file, to_compress)
+    finally:
+        pool.close()
+
+    totals = {}
+    for sizes in results:
+        for kind, size in sizes.items():
+            totals[kind] = totals.get(kind, 0) + size
+    print("fingerprinted %d files, compressed %d:" % (len(manifest), len(results)),
+          ", ".join("%s %d bytes" % (kind, totals[kind]) for kind in sorted(totals)))
+
+    with io.open(os.path.join(dist_dir, manifest_file_name), "wb") as f:
+        f.write(json.dumps(manifest, indent=2, sort_keys=True,
+                           separators=(",", ": ")).encode("utf-8"))
+        f.write(b"\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress the dist assets")
+    parser.add_argument('--dist',
+                        default=DEF_DIST_DIR,
+                        metavar="path",
+                        help="Directory of the dist build. Default = " + DEF_DIST_DIR)
+    parser.add_argument('--index-file',
+                        default=None,
+                        metavar="name",
+                        help="Index file referencing the assets. Default = <dist>/" + DEF_INDEX_FILE_NAME)
+    parser.add_argument('--manifest',
+                        default=DEF_MANIFEST_FILE_NAME,
+                        metavar="name",
+                        help="Name of the asset manifest written to the dist directory. "
+                             "Default = " + DEF_MANIFEST_FILE_NAME)
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=DEF_JOBS,
+                        metavar="N",
+                        help="Number of files to compress in parallel. Default = " + str(DEF_JOBS))
+    args = parser.parse_args()
+    fingerprint_dist(args.dist,
+                     args.index_file or os.path.join(args.dist, DEF_INDEX_FILE_NAME),
+                     args.manifest, args.jobs)
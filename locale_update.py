@@ -9,49 +9,907 @@
 # Run this script from the local version of loop-client. It assumes that a local
 # version of loop-client-l10n is in a parallel directory: ../loop-client-l10n.
 # Changes are then pushed back to loop-client.
+#
+# Only files that have been added or changed are copied, and only files and
+# locales that have been removed are deleted, so that unchanged files keep
+# their modification times.
+#
+# With --build-bundles, it instead parses each locale's loop.properties and
+# writes pre-parsed JSON bundles, with the en-US strings already merged in
+# for anything missing, plus gzip (and brotli if available) compressed copies.
+# The index file is updated to load the bundles, so the client needs a single
+# small fetch with no runtime parsing or fallback request.
+#
+# Before updating, every source locale is validated against en-US for broken
+# placeholders, malformed plural forms and encoding problems, and the update
+# fails if any are found. --validate-only checks the destination tree instead.
+# Results are cached by file hash, and a per-locale coverage report can be
+# written as JSON.
+#
+# With --strip-unused as well as --build-bundles, the standalone sources are
+# scanned for the strings they use (mozL10n.get and data-l10n-id), and the
+# bundles, along with pruned loop.properties files, only contain those. The
+# build fails if a string is used that en-US doesn't have, unless it's only
+# used by the sources shared with the desktop client.
+#
+# With --prerender-index, run once the bundles are built (and fingerprinted),
+# a variant of the index file is written for each locale, e.g. index.fr.html,
+# with the locale's bundle inlined and its direction and title set, so the
+# client is localized without fetching anything. A map of the variants
+# is written next to them for the server to pick one by Accept-Language; the
+# index file itself, which negotiates and loads the strings at runtime, is
+# left for anything that doesn't use the map.
 ##
 
 from __future__ import print_function
 
 import argparse
+import gzip
+import hashlib
 import io
+import json
 import os
 import re
 import shutil
 import sys
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    unichr
+except NameError:
+    unichr = chr
 
 #defaults
 DEF_L10N_SRC = os.path.join(os.pardir, "loop-client-l10n", "l10n")
 DEF_L10N_DST = os.path.join("content", "l10n")
 DEF_INDEX_FILE_NAME = os.path.join("content", os.extsep.join(["index", "html"]))
+DEF_JOBS = 8
+DEF_LOCALE = "en-US"
+PROPERTIES_FILE_NAME = "loop.properties"
+BUNDLE_FILE_NAME = "loop.json"
+DEF_VALIDATION_CACHE = ".l10n-validation-cache.json"
+# Bump this whenever the validation checks change, to invalidate the cache.
+VALIDATION_VERSION = 1
+
+LOCALES_META_RE = re.compile(
+    '<meta name=(["|\'])locales\\1.*? content=(["|\'])(.*?)\\2.*? />',
+    re.M | re.S)
+
+
+# These mirror PropertiesParser in vendor/l10n-gaia, so that the bundles
+# contain exactly what the client would have parsed at runtime.
+PROPERTIES_PATTERNS = {
+    "comment": re.compile(r"^\s*#|^\s*$", re.U),
+    "entity": re.compile(r"^([^=\s]+)\s*=\s*(.+)$", re.U),
+    "multiline": re.compile(r"[^\\]\\$", re.U),
+    "index": re.compile(r"\{\[\s*(\w+)(?:\(([^\)]*)\))?\s*\]\}", re.U | re.I),
+    "unicode": re.compile(r"\\u([0-9a-fA-F]{1,4})", re.U),
+    "entries": re.compile(r"[\r\n]+", re.U),
+    "control_chars": re.compile(r"\\([\\\n\r\t\b\f\{\}\"\'])", re.U),
+}
+
+LOCALIZATION_LINK_RE = re.compile(
+    r'(<link rel="localization" href="l10n/\{locale\}/)loop\.properties(">)')
+
+DEF_INDEX_VARIANTS_FILE_NAME = "index-locales.json"
+INDEX_VARIANT_FILE_NAME = "index.%s.html"
+HTML_TAG_RE = re.compile(r"<html\b")
+DEFAULT_LOCALE_META_RE = re.compile(
+    '<meta name=(["|\'])default_locale\\1.*? content=(["|\'])(.*?)\\2.*? />',
+    re.M | re.S)
+ANY_LOCALIZATION_LINK_RE = re.compile(r'([ \t]*)<link rel="localization" href="[^"]*">')
+# The string the client sets as the document title once it's localized.
+TITLE_L10N_KEY = "clientShortname2"
+# These mirror rtlList in vendor/l10n-gaia.
+RTL_LOCALES = frozenset(["ar", "he", "fa", "ps", "qps-plocm", "ur"])
+
+# The sources of the standalone client that are scanned for the strings it
+# uses, and the extensions of the files scanned within directories.
+DEF_L10N_USAGE_SOURCES = [os.path.join("content", "js"),
+                          os.path.join("content", "shared"),
+                          os.path.join("content", "webappEntryPoint.js")]
+L10N_USAGE_EXTENSIONS = frozenset([".html", ".js", ".jsx"])
+
+# The sources shared with the desktop client. It has strings of its own, so
+# those used here that en-US doesn't have are only reported.
+DESKTOP_SHARED_L10N_USAGE_SOURCES = [os.path.join("content", "shared")]
+
+# mozL10n.get(...), whose first argument holds the ids it may look up, e.g.
+# mozL10n.get("id", ...), mozL10n.get(enabled ? "id_a" : "id_b") or
+# mozL10n.get("prefix_" + ...) for ids put together at runtime; and
+# data-l10n-id="id" in markup or "data-l10n-id": "id" in JSX.
+L10N_GET_RE = re.compile(r"mozL10n\.get\(")
+L10N_ID_RE = re.compile(r"""["']?data-l10n-id["']?\s*[=:]\s*(["'])([\w.-]+)\1""")
+# A string literal in the argument of mozL10n.get, followed by "+" when it's
+# the start of an id.
+L10N_ARGUMENT_STRING_RE = re.compile(r"""(["'])([\w.-]+)\1(\s*\+)?""")
+
+# Prefixes of the ids that are put together at runtime out of parts the scan
+# can't see, so the strings starting with them are always kept:
+#
+# - "mute_" and "unmute_": MediaControlButton's titles in shared/js/views.js,
+#   joined from whether it's enabled, its scope, its type and a suffix.
+DYNAMIC_L10N_PREFIXES = frozenset(["mute_", "unmute_"])
+
+
+def unescape_properties_string(value):
+    if "\\" in value:
+        value = PROPERTIES_PATTERNS["control_chars"].sub(r"\1", value)
+    return PROPERTIES_PATTERNS["unicode"].sub(
+        lambda match: unichr(int(match.group(1), 16)), value)
+
+
+def parse_properties_index(value):
+    match = PROPERTIES_PATTERNS["index"].search(value)
+    if not match:
+        raise ValueError("Malformed index: " + value)
+    return [part for part in match.groups() if part]
+
+
+def set_entity_value(ast, name, attr, key, value):
+    obj = ast
+    prop = name
+
+    if attr:
+        if name not in obj:
+            obj[name] = {}
+        if not isinstance(obj[name], dict):
+            obj[name] = {"_": obj[name]}
+        obj = obj[name]
+        prop = attr
+
+    if not key:
+        obj[prop] = value
+        return
+
+    if prop not in obj:
+        obj[prop] = {"_": {}}
+    elif not isinstance(obj[prop], dict):
+        obj[prop] = {"_index": parse_properties_index(obj[prop]), "_": {}}
+    obj[prop]["_"][key] = value
+
+
+def parse_properties(source):
+    """
+    Parses the source of a .properties file into the AST l10n-gaia uses.
+    """
+    ast = {}
+
+    entries = PROPERTIES_PATTERNS["entries"].split(source)
+    i = 0
+    while i < len(entries):
+        line = entries[i]
+        i += 1
+
+        if PROPERTIES_PATTERNS["comment"].search(line):
+            continue
+
+        while PROPERTIES_PATTERNS["multiline"].search(line) and i < len(entries):
+            line = line[:-1] + entries[i].strip()
+            i += 1
+
+        entity_match = PROPERTIES_PATTERNS["entity"].search(line)
+        if not entity_match:
+            continue
+
+        entity_id, value = entity_match.groups()
+        key = None
+        pos = entity_id.find("[")
+        if pos != -1:
+            key = entity_id[pos + 1:-1]
+            entity_id = entity_id[:pos]
+
+        name_elements = entity_id.split(".")
+        if len(name_elements) > 2:
+            raise ValueError('Error in ID: "%s". Nested attributes are not '
+                             'supported.' % entity_id)
+
+        attr = name_elements[1] if len(name_elements) > 1 else None
+        set_entity_value(ast, name_elements[0], attr, key,
+                         unescape_properties_string(value))
+
+    return ast
+
+
+def read_properties(path):
+    with io.open(path, "r", encoding="utf-8") as f:
+        return parse_properties(f.read())
+
+
+def write_file(path, data):
+    with io.open(path, "wb") as f:
+        f.write(data)
+
+
+def get_call_argument(source, start):
+    """
+    Returns the source of the first argument of the call whose arguments
+    start at start.
+    """
+    depth = 0
+    for end in range(start, len(source)):
+        char = source[end]
+        if char in "([{":
+            depth += 1
+        elif char in ")]}":
+            if depth == 0:
+                break
+            depth -= 1
+        elif char == "," and depth == 0:
+            break
+    else:
+        end = len(source)
+    return source[start:end]
+
+
+def find_l10n_usage(sources):
+    """
+    Scans the source files, and the files with L10N_USAGE_EXTENSIONS in the
+    source directories (apart from vendor and hidden ones), for the strings
+    passed to mozL10n.get and set as data-l10n-id.
+
+    Returns a dict of the ids looked up directly to where they're used, and
+    the set of prefixes of ids put together at runtime.
+    """
+    paths = []
+    for source in sources:
+        if os.path.isfile(source):
+            paths.append(source)
+            continue
+        for dir_path, dir_names, file_names in os.walk(source):
+            dir_names[:] = sorted(name for name in dir_names
+                                  if name != "vendor" and not name.startswith("."))
+            paths.extend(os.path.join(dir_path, name) for name in sorted(file_names)
+                         if os.path.splitext(name)[1] in L10N_USAGE_EXTENSIONS)
+
+    references = {}
+    prefixes = set()
+    for path in paths:
+        with io.open(path, "r", encoding="utf-8") as f:
+            source = f.read()
+        for match in L10N_GET_RE.finditer(source):
+            argument = get_call_argument(source, match.end())
+            for string_match in L10N_ARGUMENT_STRING_RE.finditer(argument):
+                if string_match.group(3):
+                    prefixes.add(string_match.group(2))
+                else:
+                    references.setdefault(string_match.group(2), set()).add(path)
+        for match in L10N_ID_RE.finditer(source):
+            references.setdefault(match.group(2), set()).add(path)
+
+    return references, prefixes
+
+
+def used_l10n_keys(reference_ast, references, prefixes):
+    """
+    Returns the ids of the reference (en-US) entities the client uses,
+    including those whose strings the used ones refer to as placeables.
+    """
+    prefixes = tuple(prefixes | DYNAMIC_L10N_PREFIXES)
+    used = set(name for name in reference_ast
+               if name in references or name.startswith(prefixes))
+
+    pending = list(used)
+    while pending:
+        name = pending.pop()
+        for value in flatten_entities({name: reference_ast[name]}).values():
+            for placeable in placeables(value):
+                if placeable in reference_ast and placeable not in used:
+                    used.add(placeable)
+                    pending.append(placeable)
+    return used
+
+
+def strip_properties(source, used):
+    """
+    Returns the source of a .properties file with only the entities in used,
+    dropping comments and blank lines.
+    """
+    kept = []
+    lines = PROPERTIES_PATTERNS["entries"].split(source)
+    i = 0
+    while i < len(lines):
+        entry = [lines[i]]
+        i += 1
+        if PROPERTIES_PATTERNS["comment"].search(entry[0]):
+            continue
+        while PROPERTIES_PATTERNS["multiline"].search(entry[-1]) and i < len(lines):
+            entry.append(lines[i])
+            i += 1
+
+        entity_match = PROPERTIES_PATTERNS["entity"].search(entry[0])
+        if entity_match and re.split(r"[.\[]", entity_match.group(1))[0] in used:
+            kept.extend(entry)
+    return u"\n".join(kept) + u"\n"
+
+
+def build_bundle(args):
+    """
+    Writes the JSON bundle for a locale, along with its compressed copies.
+    If used is given, only the entities it lists are kept, and a pruned
+    properties file is written too. Returns the sizes of the properties file
+    and of each bundle written, and what they would have been unpruned.
+    """
+    locale, properties_path, bundle_dir, fallback, used = args
+
+    with io.open(properties_path, "r", encoding="utf-8") as f:
+        source = f.read()
+    ast = dict(fallback)
+    ast.update(parse_properties(source))
+
+    sizes = {"properties": os.path.getsize(properties_path)}
+    if used is not None:
+        sizes["unstripped json"] = len(json.dumps(ast, ensure_ascii=False, sort_keys=True,
+                                                  separators=(",", ":")).encode("utf-8"))
+        ast = dict((name, value) for name, value in ast.items() if name in used)
+
+    data = json.dumps(ast, ensure_ascii=False, sort_keys=True,
+                      separators=(",", ":")).encode("utf-8")
+
+    locale_dir = os.path.join(bundle_dir, locale)
+    if not os.path.isdir(locale_dir):
+        os.makedirs(locale_dir)
+
+    bundle_path = os.path.join(locale_dir, BUNDLE_FILE_NAME)
+    write_file(bundle_path, data)
+    sizes["json"] = len(data)
+
+    # Don't overwrite the source when building the bundles in place.
+    stripped_path = os.path.join(locale_dir, PROPERTIES_FILE_NAME)
+    if used is not None and \
+            os.path.realpath(stripped_path) != os.path.realpath(properties_path):
+        stripped = strip_properties(source, used).encode("utf-8")
+        write_file(stripped_path, stripped)
+        sizes["unstripped properties"] = sizes["properties"]
+        sizes["properties"] = len(stripped)
+
+    # A fixed mtime keeps the output identical between builds.
+    with io.open(bundle_path + ".gz", "wb") as raw:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as f:
+            f.write(data)
+    sizes["gz"] = os.path.getsize(bundle_path + ".gz")
+
+    if brotli:
+        write_file(bundle_path + ".br", brotli.compress(data))
+        sizes["br"] = os.path.getsize(bundle_path + ".br")
+
+    return locale, sizes
+
+
+def is_desktop_shared_source(path):
+    return any(path.startswith(source + os.sep)
+               for source in DESKTOP_SHARED_L10N_USAGE_SOURCES)
+
+
+def find_used_l10n_keys(reference_ast, sources):
+    """
+    Returns the ids of the entities the client uses, or None if it uses any
+    that the reference (en-US) doesn't have.
+    """
+    references, prefixes = find_l10n_usage(sources)
+
+    missing = []
+    for name in sorted(references):
+        if name in reference_ast:
+            continue
+        if all(is_desktop_shared_source(path) for path in references[name]):
+            print("note: %s is missing from %s, but only used by %s, which "
+                  "the desktop client has the strings for" %
+                  (name, DEF_LOCALE, ", ".join(sorted(references[name]))))
+        else:
+            missing.append(name)
+            print("error: %s is used by %s but missing from %s" %
+                  (name, ", ".join(sorted(references[name])), DEF_LOCALE))
+    if missing:
+        return None
+
+    used = used_l10n_keys(reference_ast, references, prefixes)
+    print("found %d of %d strings in use, stripping %s" %
+          (len(used), len(reference_ast),
+           ", ".join(sorted(set(reference_ast) - used)) or "none"))
+    return used
+
+
+def build_bundles(l10n_dir, bundle_dir, index_file_name, jobs=DEF_JOBS,
+                  strip_sources=None):
+    print("building l10n bundles from", l10n_dir, "in", bundle_dir)
+    if not brotli:
+        print("brotli module not found, skipping .br bundles")
+
+    locales = sorted(existing_locales(l10n_dir))
+    fallback = read_properties(
+        os.path.join(l10n_dir, DEF_LOCALE, PROPERTIES_FILE_NAME))
+
+    used = None
+    if strip_sources:
+        used = find_used_l10n_keys(fallback, strip_sources)
+        if used is None:
+            print("not building bundles as strings are missing")
+            sys.exit(1)
+
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(
+            build_bundle,
+            [(locale, os.path.join(l10n_dir, locale, PROPERTIES_FILE_NAME),
+              bundle_dir, fallback, used)
+             for locale in locales
+             if os.path.isfile(os.path.join(l10n_dir, locale, PROPERTIES_FILE_NAME))])
+    finally:
+        pool.close()
+
+    totals = {}
+    for locale, sizes in results:
+        for kind, size in sizes.items():
+            totals[kind] = totals.get(kind, 0) + size
+        if used is not None:
+            print("%s: saved %s" % (locale, ", ".join(
+                "%d of %d %s bytes" % (sizes["unstripped " + kind] - sizes[kind],
+                                       sizes["unstripped " + kind], kind)
+                for kind in ("json", "properties") if "unstripped " + kind in sizes)))
+    print("bundled %d locales:" % len(results),
+          ", ".join("%s %d bytes" % (kind, totals[kind]) for kind in sorted(totals)
+                    if not kind.startswith("unstripped ")))
+    if used is not None:
+        print("stripping unused strings saved %s" % ", ".join(
+            "%d %s bytes" % (totals["unstripped " + kind] - totals[kind], kind)
+            for kind in ("json", "properties") if "unstripped " + kind in totals))
+
+    with io.open(index_file_name, "r+", encoding="utf-8") as index_file:
+        index_html = index_file.read()
+        new_content = LOCALIZATION_LINK_RE.sub(r"\g<1>" + BUNDLE_FILE_NAME + r"\2",
+                                               index_html, 1)
+        if new_content != index_html:
+            print("loading l10n bundles in", index_file_name)
+            index_file.seek(0)
+            index_file.truncate(0)
+            index_file.write(new_content)
+
+
+def escape_html(text):
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+
+
+def prerender_index_variant(args):
+    """
+    Writes the variant of the index file for a locale, which only offers that
+    locale and has its bundle inlined in place of the localization link.
+    Returns the size of the variant written.
+    """
+    locale, bundle_path, index_html, variant_path = args
+
+    with io.open(bundle_path, "r", encoding="utf-8") as f:
+        ast = json.load(f)
 
-def main(l10n_src, l10n_dst, index_file_name):
-    print("deleting existing l10n content tree:", l10n_dst)
-    shutil.rmtree(l10n_dst, ignore_errors=True)
+    # Escaping "<" keeps the strings from closing the script element early.
+    data = json.dumps(ast, ensure_ascii=False, sort_keys=True,
+                      separators=(",", ":")).replace(u"<", u"\\u003c")
+    inline = [u'<script type="application/l10n" lang="%s">%s</script>' % (locale, data)]
 
-    print("updating l10n tree from", l10n_src)
+    title = ast.get(TITLE_L10N_KEY)
+    if isinstance(title, type(u"")) and u"{{" not in title:
+        inline.insert(0, u"<title>%s</title>" % escape_html(title))
 
-    def create_locale(src_dir):
-        dst_dir = src_dir.replace('_', '-')
-        shutil.copytree(os.path.join(l10n_src, src_dir), os.path.join(l10n_dst, dst_dir))
-        return dst_dir
-    
-    locale_dirs = os.listdir(l10n_src)
-    locale_list = [create_locale(x) for x in locale_dirs if x[0] != "." and x != "templates"]
+    # The language is left for l10n-gaia to set once it has translated the
+    # document: if the html element's lang already matches the browser's
+    # language, it takes the document as pretranslated and skips translating
+    # the static data-l10n-id content.
+    variant = HTML_TAG_RE.sub(
+        u'<html dir="%s"' % ("rtl" if locale in RTL_LOCALES else "ltr"), index_html, 1)
+    variant = LOCALES_META_RE.sub(u'<meta name="locales" content="%s" />' % locale, variant, 1)
+    variant = DEFAULT_LOCALE_META_RE.sub(
+        u'<meta name="default_locale" content="%s" />' % locale, variant, 1)
+    variant = ANY_LOCALIZATION_LINK_RE.sub(
+        lambda match: u"\n".join(match.group(1) + line for line in inline), variant, 1)
 
-    print("updating locales list in", index_file_name)
+    data = variant.encode("utf-8")
+    write_file(variant_path, data)
+    return locale, len(data)
+
+
+def prerender_index(bundle_dir, index_file_name, jobs=DEF_JOBS,
+                    variants_file_name=DEF_INDEX_VARIANTS_FILE_NAME):
+    """
+    Writes a variant of the index file for each locale it offers that has a
+    bundle, and the map of them, next to the index file.
+    """
+    print("prerendering", index_file_name, "for the locales in", bundle_dir)
+
+    with io.open(index_file_name, "r", encoding="utf-8") as index_file:
+        index_html = index_file.read()
+
+    locales_match = LOCALES_META_RE.search(index_html)
+    default_match = DEFAULT_LOCALE_META_RE.search(index_html)
+    if not locales_match or not default_match or \
+            not HTML_TAG_RE.search(index_html) or \
+            not ANY_LOCALIZATION_LINK_RE.search(index_html):
+        print("error: %s doesn't have the html element, locales, default locale "
+              "and localization link to prerender" % index_file_name)
+        sys.exit(1)
+
+    default_locale = default_match.group(3)
+    locales = sorted(locale for locale in locales_match.group(3).split(",")
+                     if os.path.isfile(os.path.join(bundle_dir, locale, BUNDLE_FILE_NAME)))
+    if default_locale not in locales:
+        print("error: no", default_locale, "bundle in", bundle_dir)
+        sys.exit(1)
+
+    index_dir = os.path.dirname(index_file_name)
+    variants = dict((locale, INDEX_VARIANT_FILE_NAME % locale) for locale in locales)
+
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(
+            prerender_index_variant,
+            [(locale, os.path.join(bundle_dir, locale, BUNDLE_FILE_NAME), index_html,
+              os.path.join(index_dir, variants[locale]))
+             for locale in locales])
+    finally:
+        pool.close()
+
+    # The server serves the variant of the first locale in Accept-Language
+    # that has one, which is what the client would negotiate, or the default
+    # locale's if none do. Without the header there's nothing to go on, so
+    # it falls back to the index file.
+    variants_map = {
+        "defaultLocale": default_locale,
+        "fallback": os.path.basename(index_file_name),
+        "variants": variants
+    }
+    write_file(os.path.join(index_dir, variants_file_name),
+               json.dumps(variants_map, indent=2, sort_keys=True,
+                          separators=(",", ": ")).encode("utf-8"))
+
+    sizes = [size for locale, size in results]
+    print("prerendered %d index variants of %d to %d bytes, mapped in %s" %
+          (len(results), min(sizes), max(sizes), variants_file_name))
+
+
+PLACEABLE_RE = re.compile(r"\{\{\s*(.+?)\s*\}\}", re.U)
+# UTF-8 that has been decoded as Latin-1 and then encoded again.
+MOJIBAKE_RE = re.compile(u"[\u00c2\u00c3][\u0080-\u00bf]", re.U)
+PLURAL_FORMS = frozenset(["zero", "one", "two", "few", "many", "other"])
+KNOWN_MACROS = frozenset(["plural"])
+
+
+def flatten_entities(ast):
+    """
+    Returns a dict of "id" or "id.attribute" -> value, where value is
+    either a string or a dict of variant key -> string, plus "_index" for
+    plural forms.
+    """
+    entities = {}
+    for name, value in ast.items():
+        if not isinstance(value, dict) or isinstance(value.get("_"), dict):
+            entities[name] = value
+            continue
+        for attr, attr_value in value.items():
+            entities[name if attr == "_" else name + "." + attr] = attr_value
+    return entities
+
+
+def entity_strings(value):
+    if isinstance(value, dict):
+        return [v for k, v in value.items() if k != "_index"]
+    return [value]
+
+
+def placeables(value):
+    found = set()
+    for string in entity_strings(value):
+        if isinstance(string, dict):
+            for variant in string.values():
+                found.update(PLACEABLE_RE.findall(variant))
+        else:
+            found.update(PLACEABLE_RE.findall(string))
+    return found
+
+
+def check_entity(entity_id, value, reference, errors, warnings):
+    if isinstance(value, dict):
+        variants = value.get("_", {})
+        if "_index" in value:
+            index = value["_index"]
+            if not index or index[0] not in KNOWN_MACROS:
+                errors.append("%s: unknown macro in index %s" % (entity_id, index))
+            if set(variants) - PLURAL_FORMS:
+                errors.append("%s: invalid plural forms %s" %
+                              (entity_id, ", ".join(sorted(set(variants) - PLURAL_FORMS))))
+            if "other" not in variants:
+                errors.append("%s: missing the \"other\" plural form" % entity_id)
+        strings = list(variants.values())
+    else:
+        strings = [value]
+
+    for string in strings:
+        if string.count("{{") != string.count("}}"):
+            errors.append("%s: unbalanced placeholder braces" % entity_id)
+
+    if reference is None:
+        return
+
+    expected = placeables(reference)
+    used = placeables(value)
+    if used - expected:
+        errors.append("%s: unknown placeholders %s" %
+                      (entity_id, ", ".join(sorted(used - expected))))
+    if expected - used:
+        warnings.append("%s: doesn't use placeholders %s" %
+                        (entity_id, ", ".join(sorted(expected - used))))
+
+
+def validate_locale(args):
+    """
+    Validates a locale's properties file against the reference (en-US)
+    entities. Returns the locale's report.
+    """
+    locale, path, reference = args
+    report = {"errors": [], "warnings": [], "missing": [], "obsolete": []}
+
+    with io.open(path, "rb") as f:
+        data = f.read()
+
+    try:
+        source = data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        report["errors"].append("not valid UTF-8: %s" % e)
+        source = None
+
+    entities = {}
+    if source is not None:
+        if source.startswith(u"\ufeff"):
+            report["errors"].append("starts with a byte order mark")
+        for line_number, line in enumerate(source.splitlines(), 1):
+            if u"\ufffd" in line:
+                report["errors"].append("line %d: contains U+FFFD replacement "
+                                        "characters" % line_number)
+            if MOJIBAKE_RE.search(line):
+                report["errors"].append("line %d: looks double-encoded" % line_number)
+
+        try:
+            entities = flatten_entities(parse_properties(source))
+        except ValueError as e:
+            report["errors"].append(str(e))
+
+    for entity_id in sorted(entities):
+        check_entity(entity_id, entities[entity_id], reference.get(entity_id),
+                     report["errors"], report["warnings"])
+        if entity_id not in reference:
+            report["obsolete"].append(entity_id)
+
+    report["missing"] = sorted(entity_id for entity_id in reference
+                               if entity_id not in entities)
+    report["total"] = len(reference)
+    report["translated"] = len(reference) - len(report["missing"])
+    report["coverage"] = (round(float(report["translated"]) / report["total"], 4)
+                          if reference else 1.0)
+    return locale, report
+
+
+def load_validation_cache(cache_file_name):
+    try:
+        with io.open(cache_file_name, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache.get("version") == VALIDATION_VERSION:
+            return cache["results"]
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def save_validation_cache(cache_file_name, results):
+    data = json.dumps({"version": VALIDATION_VERSION, "results": results},
+                      sort_keys=True)
+    with io.open(cache_file_name, "w", encoding="utf-8") as f:
+        f.write(data if isinstance(data, type(u"")) else data.decode("utf-8"))
+
+
+def validate_locales(locale_dirs, jobs=DEF_JOBS,
+                     cache_file_name=DEF_VALIDATION_CACHE, report_file_name=None):
+    """
+    Validates the loop.properties of every locale against en-US using a
+    process pool, reusing cached results for files that haven't changed.
+    Returns the number of errors found.
+
+    locale_dirs maps each locale name to the directory holding its files.
+    """
+    paths = dict((locale, os.path.join(locale_dir, PROPERTIES_FILE_NAME))
+                 for locale, locale_dir in locale_dirs.items()
+                 if os.path.isfile(os.path.join(locale_dir, PROPERTIES_FILE_NAME)))
+
+    reference_path = paths.get(DEF_LOCALE)
+    if not reference_path:
+        print("error: no", DEF_LOCALE, "locale to validate against")
+        return 1
+
+    reference_hash = file_hash(reference_path)
+    cache = load_validation_cache(cache_file_name) if cache_file_name else {}
+    keys = dict((locale, file_hash(path) + ":" + reference_hash)
+                for locale, path in paths.items())
+
+    reports = dict((locale, cache[key]) for locale, key in keys.items()
+                   if key in cache)
+    pending = sorted(locale for locale in paths if locale not in reports)
+
+    if pending:
+        reference = flatten_entities(read_properties(reference_path))
+        pool = Pool(jobs)
+        try:
+            reports.update(pool.map(validate_locale,
+                                    [(locale, paths[locale], reference)
+                                     for locale in pending]))
+        finally:
+            pool.close()
+            pool.join()
+
+    if cache_file_name:
+        save_validation_cache(cache_file_name,
+                              dict((keys[locale], report)
+                                   for locale, report in reports.items()))
+
+    error_count = 0
+    for locale in sorted(reports):
+        for error in reports[locale]["errors"]:
+            print("error: %s: %s" % (locale, error))
+            error_count += 1
+
+    print("validated %d locales (%d cached): %d errors, average coverage %.1f%%" %
+          (len(reports), len(reports) - len(pending), error_count,
+           100 * sum(r["coverage"] for r in reports.values()) / max(len(reports), 1)))
+
+    if report_file_name:
+        with io.open(report_file_name, "wb") as f:
+            f.write(json.dumps({"errors": error_count, "locales": reports},
+                               indent=2, sort_keys=True).encode("utf-8"))
+
+    return error_count
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with io.open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def build_manifest(locale_dirs, jobs):
+    """
+    Hashes every file in the given locale directories.
+
+    locale_dirs maps each destination locale name to the directory holding
+    its files. Returns a dict of "<locale>/<relative path>" -> (hash, path).
+    """
+    paths = {}
+    for locale, locale_dir in locale_dirs.items():
+        for dir_path, dir_names, file_names in os.walk(locale_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                rel_path = os.path.relpath(path, locale_dir).replace(os.sep, "/")
+                paths[locale + "/" + rel_path] = path
+
+    pool = ThreadPool(jobs)
+    try:
+        hashes = pool.map(file_hash, list(paths.values()))
+    finally:
+        pool.close()
+
+    return dict((key, (digest, path))
+                for (key, path), digest in zip(paths.items(), hashes))
+
+
+def source_locales(l10n_src):
+    locales = {}
+    for src_dir in os.listdir(l10n_src):
+        if src_dir[0] != "." and src_dir != "templates":
+            locales[src_dir.replace('_', '-')] = os.path.join(l10n_src, src_dir)
+    return locales
+
+
+def existing_locales(l10n_dst):
+    if not os.path.isdir(l10n_dst):
+        return {}
+
+    return dict((dst_dir, os.path.join(l10n_dst, dst_dir))
+                for dst_dir in os.listdir(l10n_dst)
+                if os.path.isdir(os.path.join(l10n_dst, dst_dir)))
+
+
+def copy_file(args):
+    src_path, dst_path = args
+    dst_dir = os.path.dirname(dst_path)
+    if not os.path.isdir(dst_dir):
+        try:
+            os.makedirs(dst_dir)
+        except OSError:
+            # Another thread may have just created it.
+            if not os.path.isdir(dst_dir):
+                raise
+    shutil.copy2(src_path, dst_path)
+
+
+def update_index_locales(index_file_name, locale_list):
+    """
+    Updates the locales list in the index file, returning True if it
+    needed changing.
+    """
     with io.open(index_file_name, "r+") as index_file:
         index_html = index_file.read()
 
-        new_content = re.sub(
-            '<meta name=(["|\'])locales\\1.*? content=(["|\']).*?\\2.*? />',
+        match = LOCALES_META_RE.search(index_html)
+        if match and match.group(3) == ",".join(locale_list):
+            return False
+
+        new_content = LOCALES_META_RE.sub(
             '<meta name="locales" content="' + ",".join(locale_list) + '" />',
-            index_html, 1, re.M | re.S)
-        
+            index_html, 1)
+
         index_file.seek(0)
         index_file.truncate(0)
         index_file.write(new_content)
 
+    return True
+
+
+def main(l10n_src, l10n_dst, index_file_name, jobs=DEF_JOBS, validate=True,
+         cache_file_name=DEF_VALIDATION_CACHE, report_file_name=None):
+    src_locales = source_locales(l10n_src)
+
+    if validate:
+        print("validating l10n tree", l10n_src)
+        if validate_locales(src_locales, jobs, cache_file_name, report_file_name):
+            print("not updating", l10n_dst, "as validation failed")
+            sys.exit(1)
+
+    print("comparing l10n tree", l10n_dst, "with", l10n_src)
+
+    dst_locales = existing_locales(l10n_dst)
+
+    src_manifest = build_manifest(src_locales, jobs)
+    dst_manifest = build_manifest(dst_locales, jobs)
+
+    added = sorted(key for key in src_manifest if key not in dst_manifest)
+    changed = sorted(key for key in src_manifest if key in dst_manifest and
+                     src_manifest[key][0] != dst_manifest[key][0])
+    removed = sorted(key for key in dst_manifest if key not in src_manifest)
+    removed_locales = sorted(set(dst_locales) - set(src_locales))
+    added_locales = sorted(set(src_locales) - set(dst_locales))
+
+    pool = ThreadPool(jobs)
+    try:
+        pool.map(copy_file,
+                 [(src_manifest[key][1], os.path.join(l10n_dst, *key.split("/")))
+                  for key in added + changed])
+    finally:
+        pool.close()
+
+    for locale in removed_locales:
+        shutil.rmtree(dst_locales[locale])
+
+    for key in removed:
+        if key.split("/", 1)[0] not in removed_locales:
+            os.remove(dst_manifest[key][1])
+
+    locale_list = sorted(src_locales)
+    if update_index_locales(index_file_name, locale_list):
+        print("updated locales list in", index_file_name)
+    else:
+        print("locales list in", index_file_name, "is unchanged")
+
+    print("files: %d added, %d changed, %d removed, %d unchanged" %
+          (len(added), len(changed), len(removed),
+           len(src_manifest) - len(added) - len(changed)))
+    if added_locales:
+        print("added locales:", ", ".join(added_locales))
+    if removed_locales:
+        print("removed locales:", ", ".join(removed_locales))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Loop Stand-alone Client localization update script")
@@ -67,6 +925,48 @@ if __name__ == "__main__":
                         default=DEF_INDEX_FILE_NAME,
                         metavar="name",
                         help="File to be updated with the locales list. Default = " + DEF_INDEX_FILE_NAME)
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=DEF_JOBS,
+                        metavar="N",
+                        help="Number of files to hash and copy in parallel. Default = " + str(DEF_JOBS))
+    parser.add_argument('--build-bundles',
+                        default=None,
+                        metavar="path",
+                        help="Instead of updating, build JSON l10n bundles from the locales in the "
+                             "destination path into this path, and load them from the index file")
+    parser.add_argument('--strip-unused',
+                        action='store_true',
+                        help="With --build-bundles, only keep the strings the standalone sources use")
+    parser.add_argument('--prerender-index',
+                        default=None,
+                        metavar="path",
+                        help="Instead of updating, write a variant of the index file with the "
+                             "strings inlined for each locale bundled in this path")
+    parser.add_argument('--validate-only',
+                        action='store_true',
+                        help="Only validate the locales in the destination path")
+    parser.add_argument('--skip-validation',
+                        action='store_true',
+                        help="Update without validating the source locales first")
+    parser.add_argument('--validation-cache',
+                        default=DEF_VALIDATION_CACHE,
+                        metavar="name",
+                        help="File caching validation results by file hash. Default = " + DEF_VALIDATION_CACHE)
+    parser.add_argument('--report',
+                        default=None,
+                        metavar="name",
+                        help="Write a per-locale validation and coverage report to this JSON file")
     args = parser.parse_args()
-    main(args.src, args.dst, args.index_file)
-
+    if args.build_bundles:
+        build_bundles(args.dst, args.build_bundles, args.index_file, args.jobs,
+                      DEF_L10N_USAGE_SOURCES if args.strip_unused else None)
+    elif args.prerender_index:
+        prerender_index(args.prerender_index, args.index_file, args.jobs)
+    elif args.validate_only:
+        if validate_locales(existing_locales(args.dst), args.jobs,
+                            args.validation_cache, args.report):
+            sys.exit(1)
+    else:
+        main(args.src, args.dst, args.index_file, args.jobs,
+             not args.skip_validation, args.validation_cache, args.report)
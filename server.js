@@ -17,6 +17,7 @@ var app = express();
 var compression = require("compression");
 app.use(compression());
 
+var fs = require("fs");
 var path = require("path");
 
 var port = process.env.PORT || 3000;
@@ -77,6 +78,60 @@ app.use("/ui/shared/", express.static(path.join(__dirname, "..", "content",
 // whole loop/ directory structure and expect some files in the standalone directory.
 app.use("/standalone/content", express.static(path.join(__dirname, "content")));
 
+// Files fingerprinted by fingerprint_dist.py have a hash of their content in
+// their name, so they never change and can be cached forever without being
+// revalidated. Most also have precompressed siblings that can be sent as is.
+var FINGERPRINTED_RE = /\.[0-9a-f]{12}\.[^.\/]+$/;
+var PRECOMPRESSED_EXTENSIONS = { br: ".br", gzip: ".gz" };
+var ONE_YEAR_MS = 365 * 24 * 60 * 60 * 1000;
+
+function serveFingerprinted(req, res, next) {
+  "use strict";
+
+  if (!FINGERPRINTED_RE.test(req.path)) {
+    next();
+    return;
+  }
+
+  // Like express.static, refuse anything that would resolve outside the
+  // content directory.
+  var contentDir = path.resolve(__dirname, standaloneContentDir);
+  var requestPath;
+  try {
+    requestPath = decodeURIComponent(req.path);
+  } catch (ex) {
+    res.sendStatus(400);
+    return;
+  }
+  var filePath = path.resolve(contentDir, "." + requestPath);
+  if (requestPath.indexOf("\0") !== -1 ||
+      filePath.indexOf(contentDir + path.sep) !== 0) {
+    res.sendStatus(403);
+    return;
+  }
+  if (!fs.existsSync(filePath)) {
+    next();
+    return;
+  }
+
+  res.set("Cache-Control", "public, max-age=31536000, immutable");
+  res.vary("Accept-Encoding");
+
+  var encoding = req.acceptsEncodings("br", "gzip");
+  var extension = PRECOMPRESSED_EXTENSIONS[encoding];
+  if (extension && fs.existsSync(filePath + extension)) {
+    res.set("Content-Encoding", encoding);
+    res.type(path.extname(filePath));
+    filePath += extension;
+  }
+
+  res.sendFile(filePath, { maxAge: ONE_YEAR_MS });
+}
+
+app.use("/", serveFingerprinted);
+app.use("/content", serveFingerprinted);
+app.use("/content/c", serveFingerprinted);
+
 // We load /content this from  both /content *and* /../content. The first one
 // does what we need for running in the github loop-client context, the second one
 // handles running in the hg repo under mozilla-central and is used so that the shared
@@ -98,12 +153,79 @@ app.use("/test/shared/shared", express.static(path.join(__dirname, "..", "conten
 app.use("/test/desktop-local/shared", express.static(path.join(__dirname, "..", "content/shared")));
 
 
-// As we don't have hashes on the urls, the best way to serve the index files
-// appears to be to be to closely filter the url and match appropriately.
+// The dist build has a variant of the index file per locale with its strings
+// inlined, so the client doesn't need to fetch them before it can render, and
+// a map of them written by locale_update.py --prerender-index.
+var INDEX_VARIANTS_FILE_NAME = "index-locales.json";
+
+function loadIndexVariants() {
+  "use strict";
+
+  var mapPath = path.join(__dirname, standaloneContentDir,
+                          INDEX_VARIANTS_FILE_NAME);
+  if (!fs.existsSync(mapPath)) {
+    return null;
+  }
+
+  var map = JSON.parse(fs.readFileSync(mapPath, "utf8"));
+  var variants = {};
+  Object.keys(map.variants).forEach(function(locale) {
+    variants[locale.toLowerCase()] = {
+      locale: locale,
+      file: map.variants[locale]
+    };
+  });
+
+  return {
+    variants: variants,
+    defaultVariant: variants[map.defaultLocale.toLowerCase()],
+    fallback: map.fallback
+  };
+}
+
+var indexVariants = loadIndexVariants();
+
+// Picks the variant the same way l10n-gaia negotiates at runtime: the first
+// requested language that has one, or else the default locale's. Without an
+// Accept-Language header, the plain index file negotiates on the client.
+function getIndexVariant(req) {
+  "use strict";
+
+  if (!req.get("Accept-Language")) {
+    return null;
+  }
+
+  var requested = req.acceptsLanguages();
+  for (var i = 0; i < requested.length; i++) {
+    var variant = indexVariants.variants[requested[i].toLowerCase()];
+    if (variant) {
+      return variant;
+    }
+  }
+  return indexVariants.defaultVariant;
+}
+
+// The index files can't have hashes on their urls, so the best way to serve
+// them appears to be to be to closely filter the url and match appropriately.
+// They always need revalidating, as they refer to the fingerprinted assets.
 function serveIndex(req, res) {
   "use strict";
 
-  return res.sendFile(path.join(__dirname, standaloneContentDir, "index.html"));
+  res.set("Cache-Control", "no-cache");
+
+  var fileName = "index.html";
+  if (indexVariants) {
+    res.vary("Accept-Language");
+    var variant = getIndexVariant(req);
+    if (variant) {
+      res.set("Content-Language", variant.locale);
+      fileName = variant.file;
+    } else {
+      fileName = indexVariants.fallback;
+    }
+  }
+
+  return res.sendFile(path.join(__dirname, standaloneContentDir, fileName));
 }
 
 app.get(/^\/[\w\-]+$/, serveIndex);
@@ -0,0 +1,736 @@
+#!/usr/bin/python
+
+##
+# Benchmarks and regression tests extract_from_hg.py without needing a
+# mozilla-central clone or network access.
+#
+# It builds a synthetic hg repository containing N changesets, a fraction of
+# which touch the Loop directories (always including merges, deletions,
+# executable files and locale edits to index.html), and a release branch
+# with uplifts and flag changes, plus a scratch git repository set up like
+# loop-client. The importer is then run end-to-end
+# against a fresh copy of the git repository for each variant of the
+# importer's options, and the throughput of each run is reported.
+#
+# As the committer identity and date are fixed, every variant importing the
+# default branch must produce byte-identical git history; if not, this exits
+# with a failure. That includes the variants that are interrupted part way
+# through and then resumed. The history must also match what the original
+# importer, kept in reference_extract_from_hg.py, produces from the same
+# repositories. The original importer only handles the default branch;
+# importing every branch, or the release branch into its own git branch
+# with --target, must bring in the changesets hg's file() revset finds.
+#
+# Requires the same modules as extract_from_hg.py, and hg and git on the
+# path.
+##
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        os.pardir, os.pardir))
+IMPORTER = os.path.join(ROOT_DIR, "extract_from_hg.py")
+REFERENCE_IMPORTER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "reference_extract_from_hg.py")
+
+DEFAULT_CHANGESETS = 200
+DEFAULT_LOOP_FRACTION = 0.3
+DEFAULT_SEED = 1
+
+# Each variant is a name and the extra arguments passed to the importer.
+DEFAULT_VARIANTS = [
+    ("fast-import", []),
+    ("fast-import-no-prefetch", ["--prefetch-workers", "0"]),
+    ("per-file-git", ["--per-file-git", "--prefetch-workers", "0"]),
+]
+
+# Variants run against the whole repository, including its release branch,
+# rather than just the default branch. They're checked against the
+# changesets hg's file() revset finds, rather than the original importer.
+BRANCH_VARIANTS = [
+    ("fast-import-all-branches", []),
+]
+
+# Variants that are interrupted by an exception part way through the import
+# and then run again to resume it: the name, the importer arguments, the
+# function to raise from and the call that raises.
+INTERRUPTED_VARIANTS = [
+    # Dies in the middle of a changeset, with commits sent to fast-import
+    # since the last checkpoint.
+    ("fast-import-interrupted", ["--checkpoint-interval", "4"],
+     "writeCset", 10),
+    # Dies after a checkpoint has landed, before all of it is in the journal.
+    ("fast-import-interrupted-journal", ["--checkpoint-interval", "4"],
+     "record", 6),
+    ("per-file-git-interrupted", ["--per-file-git", "--prefetch-workers", "0"],
+     "writeCset", 10),
+]
+
+INTERRUPTED_EXIT_CODE = 3
+
+# Runs the importer, raising from a function in it on a given call. Whatever
+# it has spawned is then left to see the end of its input, as it would if
+# the importer had been killed.
+INTERRUPT_SCRIPT = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import extract_from_hg
+
+functionName, calls = sys.argv[2], [int(sys.argv[3])]
+sys.argv = [extract_from_hg.__file__] + sys.argv[4:]
+
+class Interrupted(Exception):
+    pass
+
+def interrupting(function):
+    def wrapper(*args, **kwargs):
+        calls[0] -= 1
+        if calls[0] == 0:
+            raise Interrupted(functionName)
+        return function(*args, **kwargs)
+    return wrapper
+
+if functionName == "record":
+    extract_from_hg.ImportJournal.record = interrupting(
+        extract_from_hg.ImportJournal.record)
+else:
+    setattr(extract_from_hg, functionName,
+            interrupting(getattr(extract_from_hg, functionName)))
+
+procs = []
+spawn = extract_from_hg.spawn
+def trackingSpawn(cmd, **kwargs):
+    proc = spawn(cmd, **kwargs)
+    procs.append(proc)
+    return proc
+extract_from_hg.spawn = trackingSpawn
+
+try:
+    extract_from_hg.main()
+except Interrupted:
+    for proc in procs:
+        if proc.stdin:
+            proc.stdin.close()
+        proc.wait()
+    sys.exit(%d)
+""" % INTERRUPTED_EXIT_CODE
+
+LOOP_DIRS = [
+    "browser/extensions/loop/standalone/content/js",
+    "browser/extensions/loop/standalone/content/css",
+    "browser/extensions/loop/content/shared/js",
+    "browser/extensions/loop/content/shared/css",
+    "browser/extensions/loop/test/standalone",
+    "browser/extensions/loop/test/shared",
+]
+OTHER_DIRS = [
+    "browser/base/content",
+    "browser/extensions/loop/chrome/content/panels",
+    "dom/media",
+    "toolkit/components",
+]
+INDEX_FILE = "browser/extensions/loop/standalone/content/index.html"
+# Created executable in each Loop directory.
+EXECUTABLE_FILE = "run.sh"
+RELEASE_BRANCH = "release"
+LOCALES = ["en-US", "fr", "de", "es-ES", "it", "ja", "pt-BR", "zh-CN"]
+# Covers the CHANGELOG formatting rules.
+COMMIT_MESSAGES = [
+    "Bug %d: Change %s files, r=reviewer",
+    "Bug %d - Change %s files for h264-encoded video. r=reviewer",
+    "Bug %d-Change %s files [r=reviewer]",
+    "Bug %d - Part 2 - Change %s files,",
+]
+
+GIT_LOCALES = "en-US,fr,de"
+CHANGELOG_TEMPLATE = """Changelog
+=========
+
+TBD
+-------------------
+
+0.1.0 (2015-01-01)
+-------------------
+
+- Initial release.
+"""
+
+# Keeps git output identical between runs, so history can be compared.
+FIXED_ENV = {
+    "GIT_COMMITTER_NAME": "Loop Importer",
+    "GIT_COMMITTER_EMAIL": "importer@example.com",
+    "GIT_COMMITTER_DATE": "1450000000 +0000",
+    "GIT_AUTHOR_NAME": "Loop Importer",
+    "GIT_AUTHOR_EMAIL": "importer@example.com",
+    "GIT_AUTHOR_DATE": "1450000000 +0000",
+    "HGUSER": "Loop Importer <importer@example.com>",
+    "HGPLAIN": "1",
+}
+
+
+def runCommand(cmd, cwd, env=None):
+    p = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE)
+    output = p.communicate()[0]
+    if p.returncode != 0:
+        print >> sys.stderr, "FAIL: Unable to run %s, exit code: %d" % (cmd, p.returncode)
+        sys.exit(p.returncode)
+    return output
+
+
+def fixedEnv():
+    env = dict(os.environ)
+    env.update(FIXED_ENV)
+    return env
+
+
+def indexFileData(locales, version):
+    return ('<!DOCTYPE html>\n<html>\n<head>\n'
+            '<meta name="locales" content="%s" />\n'
+            '</head>\n<body data-version="%d"></body>\n</html>\n' %
+            (",".join(locales), version))
+
+
+def writeFile(repoDir, filename, fileData):
+    path = os.path.join(repoDir, filename)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    outFile = open(path, "w")
+    outFile.write(fileData)
+    outFile.close()
+
+
+class SyntheticHgRepo(object):
+    """
+    Builds the synthetic mozilla-central stand-in. Everything is derived
+    from the seed, so the same arguments always give the same repository.
+
+    A quarter of the way through, a release branch is started. Some of the
+    later Loop changes are uplifted to it: the same change is committed there
+    too, so its file revisions are shared with the default branch. It also
+    gets changes of its own, including changes to just the flags of a file.
+
+    Each kind of Loop change in stats happens at random, and is also forced
+    half way through if it hasn't happened by then, so that every build
+    covers all of them.
+    """
+
+    def __init__(self, repoDir, seed, loopFraction):
+        self.repoDir = repoDir
+        self.random = random.Random(seed)
+        self.loopFraction = loopFraction
+        self.env = fixedEnv()
+        self.date = 1440000000
+        self.count = 0
+        self.changesets = 0
+        self.stats = {
+            "merges": 0,
+            "deletions": 0,
+            "executableEdits": 0,
+            "modeChanges": 0,
+            "uplifts": 0,
+            "flagChanges": 0,
+        }
+        self.loopFiles = ["%s/%s" % (directory, filename)
+                          for directory in LOOP_DIRS
+                          for filename in (["file%d.js" % i for i in xrange(6)] +
+                                           [EXECUTABLE_FILE])]
+        self.otherFiles = ["%s/file%d.js" % (directory, i)
+                           for directory in OTHER_DIRS for i in xrange(6)]
+        self.branch = "default"
+        # The Loop files with the same file revision on both branches, which
+        # can be uplifted as a shared file revision. None until the release
+        # branch is started.
+        self.inSync = None
+        # What the changeset being built writes, as filename -> content, and
+        # None for the files it deletes.
+        self.changes = {}
+
+        runCommand(["hg", "init", repoDir], None, self.env)
+
+    def hg(self, *args):
+        return runCommand(["hg"] + list(args), self.repoDir, self.env)
+
+    def happens(self, stat, probability):
+        """
+        Returns True if a change of kind stat should be made now, counting it.
+        """
+        if (self.random.random() < probability or
+                (not self.stats[stat] and self.count >= self.changesets // 2)):
+            self.stats[stat] += 1
+            return True
+        return False
+
+    def commit(self, message):
+        self.count += 1
+        self.date += 3600
+        # Use a range of timezones to check the offsets are translated.
+        offset = self.random.choice([-3600, 0, 18000, 28800])
+        self.hg("commit", "-A", "-q", "-m", message,
+                "-u", "Author %d <author%d@example.com>" % (self.count % 7, self.count % 7),
+                "-d", "%d %d" % (self.date, offset))
+
+    def tip(self):
+        return self.hg("log", "-r", "tip", "--template", "{node}").strip()
+
+    def checkout(self, branch):
+        if branch != self.branch:
+            self.hg("update", "-q", branch)
+            self.branch = branch
+
+    def createBase(self):
+        for filename in self.loopFiles + self.otherFiles:
+            writeFile(self.repoDir, filename, "// %s\n" % filename)
+            if filename.endswith(EXECUTABLE_FILE):
+                os.chmod(os.path.join(self.repoDir, filename), 0755)
+        writeFile(self.repoDir, INDEX_FILE, indexFileData(LOCALES[:2], 0))
+        writeFile(self.repoDir, "browser/extensions/loop/standalone/package.json",
+                  '{\n"eslint-plugin-mozilla": "../../../../testing/eslint-plugin-mozilla",\n}\n')
+        for directory in ("standalone", "shared"):
+            writeFile(self.repoDir,
+                      "browser/extensions/loop/test/%s/index.html" % directory,
+                      '<script src="../../standalone/content/js/file0.js"></script>\n')
+        self.commit("Base import")
+
+    def startReleaseBranch(self):
+        self.hg("branch", "-q", RELEASE_BRANCH)
+        self.branch = RELEASE_BRANCH
+        self.commit("Start the %s branch" % RELEASE_BRANCH)
+        self.checkout("default")
+        self.inSync = set(filename for filename in self.loopFiles + [INDEX_FILE]
+                          if os.path.exists(os.path.join(self.repoDir, filename)))
+
+    def write(self, filename, fileData):
+        writeFile(self.repoDir, filename, fileData)
+        self.changes[filename] = fileData
+
+    def changeLoopFiles(self, canDelete):
+        for filename in self.random.sample(self.loopFiles, self.random.randint(1, 4)):
+            path = os.path.join(self.repoDir, filename)
+            exists = os.path.exists(path)
+            if exists and canDelete and self.happens("deletions", 0.05):
+                os.remove(path)
+                self.changes[filename] = None
+                continue
+
+            self.writeRevision(filename)
+            if filename.endswith(EXECUTABLE_FILE):
+                if exists:
+                    self.stats["executableEdits"] += 1
+                else:
+                    os.chmod(path, 0755)
+            # Only ever change the mode along with the content on the default
+            # branch, as the original importer can't commit a changeset
+            # that doesn't change anything in git.
+            elif self.happens("modeChanges", 0.02):
+                os.chmod(path, 0755)
+
+        if not self.stats["executableEdits"] and self.count >= self.changesets // 2:
+            for filename in self.loopFiles:
+                if (filename.endswith(EXECUTABLE_FILE) and
+                        os.path.exists(os.path.join(self.repoDir, filename))):
+                    self.writeRevision(filename)
+                    self.stats["executableEdits"] += 1
+                    break
+
+    def writeRevision(self, filename):
+        self.write(filename,
+                   "// %s\n// revision %d, %s\n" %
+                   (filename, self.count, "x" * self.random.randint(10, 5000)))
+
+    def addChangeset(self, canDelete=True, canUplift=True):
+        self.changes = {}
+        touchesLoop = self.random.random() < self.loopFraction
+        if touchesLoop:
+            self.changeLoopFiles(canDelete)
+        else:
+            for filename in self.random.sample(self.otherFiles,
+                                               self.random.randint(1, 4)):
+                self.writeRevision(filename)
+
+        if touchesLoop and self.random.random() < 0.1:
+            locales = self.random.sample(LOCALES, self.random.randint(1, 5))
+            self.write(INDEX_FILE, indexFileData(locales, self.count))
+
+        message = (self.random.choice(COMMIT_MESSAGES) %
+                   (100000 + self.count, "loop" if touchesLoop else "other"))
+        self.commit(message)
+
+        if self.inSync is None:
+            return
+        # Only changes to files that have the same file revision on both
+        # branches give the same file revisions when uplifted.
+        if (canUplift and touchesLoop and
+                all(fileData is not None and filename in self.inSync
+                    for filename, fileData in self.changes.items()) and
+                self.happens("uplifts", 0.2)):
+            self.uplift(message)
+        else:
+            self.inSync.difference_update(self.changes)
+
+    def uplift(self, message):
+        self.checkout(RELEASE_BRANCH)
+        for filename, fileData in sorted(self.changes.items()):
+            writeFile(self.repoDir, filename, fileData)
+        self.commit(message + " a=release")
+        self.checkout("default")
+
+    def addReleaseChangeset(self):
+        self.checkout(RELEASE_BRANCH)
+        files = [filename for filename in self.loopFiles
+                 if os.path.exists(os.path.join(self.repoDir, filename))]
+        notExecutable = [filename for filename in files
+                         if not os.access(os.path.join(self.repoDir, filename),
+                                          os.X_OK)]
+        # Flags are only ever set, so they're never changed back before the
+        # file next changes, which relevantRevisions can't detect.
+        if notExecutable and self.happens("flagChanges", 0.3):
+            filename = self.random.choice(notExecutable)
+            os.chmod(os.path.join(self.repoDir, filename), 0755)
+            message = "Bug %d - Make a %s file executable. r=reviewer"
+        else:
+            self.changes = {}
+            for filename in self.random.sample(files, self.random.randint(1, 2)):
+                self.writeRevision(filename)
+            self.inSync.difference_update(self.changes)
+            message = "Bug %d - Change %s files on the release branch. r=reviewer"
+
+        self.commit(message % (100000 + self.count, "loop"))
+        self.checkout("default")
+
+    def addMerge(self):
+        # Branch off a couple of revisions back, commit there and merge it in.
+        head = self.hg("log", "-r", "default", "--template", "{node}").strip()
+        self.hg("update", "-q", "-r", "p1(p1(default))")
+        # The importers apply this on top of the mainline, where a file it
+        # deletes may already be gone.
+        self.addChangeset(canDelete=False, canUplift=False)
+        # Conflicts are resolved in favour of the mainline.
+        self.hg("merge", "-q", "-y", "--tool", "internal:local", "-r", head)
+        self.commit("Merge into loop")
+
+    def build(self, changesets):
+        self.changesets = changesets
+        self.createBase()
+        base = self.tip()
+
+        while self.count <= changesets:
+            if self.inSync is None and self.count >= changesets // 4:
+                self.startReleaseBranch()
+            elif self.inSync is not None and self.random.random() < 0.1:
+                self.addReleaseChangeset()
+            elif self.count > 3 and self.happens("merges", 0.05):
+                self.addMerge()
+            else:
+                self.addChangeset()
+
+        return base
+
+
+def createGitRepo(gitDir, hgDir, baseRevision):
+    """
+    Creates a loop-client style git repository, with the content of the base
+    hg revision mapped across.
+    """
+    sys.path.insert(0, ROOT_DIR)
+    from extract_from_hg import IMPORT_RULES
+
+    env = fixedEnv()
+    runCommand(["git", "init", "-q", gitDir], None, env)
+
+    # Lines are the permissions, a flag ("*" for executable) and the path.
+    manifest = runCommand(["hg", "manifest", "-v", "-r", baseRevision],
+                          hgDir, env)
+    for line in manifest.splitlines():
+        flag, filename = line[4], line[6:]
+        rule = IMPORT_RULES.match(filename)
+        if rule is None:
+            continue
+        fileData = runCommand(["hg", "cat", "-r", baseRevision, filename],
+                              hgDir, env)
+        newFilename = rule.translatePath(filename)
+        writeFile(gitDir, newFilename, fileData)
+        if flag == "*":
+            os.chmod(os.path.join(gitDir, newFilename), 0755)
+
+    writeFile(gitDir, "content/index.html",
+              indexFileData(GIT_LOCALES.split(","), 0))
+    writeFile(gitDir, "CHANGELOG", CHANGELOG_TEMPLATE)
+    writeFile(gitDir, "last_m_c_import_rev.txt", baseRevision + "\n")
+
+    runCommand(["git", "add", "-A"], gitDir, env)
+    runCommand(["git", "commit", "-q", "-m", "Initial loop-client"], gitDir, env)
+    runCommand(["git", "branch", RELEASE_BRANCH], gitDir, env)
+
+
+def runVariant(name, extraArgs, gitTemplateDir, hgDir, workDir,
+               interrupt=None):
+    """
+    Runs the importer on a fresh copy of the git repository. If interrupt
+    is given, as (function name, call), the importer is first run with that
+    call raising, and is then expected to resume the import.
+    """
+    gitDir = os.path.join(workDir, name)
+    shutil.copytree(gitTemplateDir, gitDir, symlinks=True)
+    metricsFile = os.path.join(workDir, name + ".json")
+    importerArgs = ["--skip-pull-git", "--skip-pull-hg",
+                    "--source-clone", hgDir,
+                    "--metrics-json", metricsFile] + extraArgs
+
+    if interrupt:
+        functionName, call = interrupt
+        p = subprocess.Popen([sys.executable, "-c", INTERRUPT_SCRIPT, ROOT_DIR,
+                              functionName, str(call)] + importerArgs,
+                             cwd=gitDir, env=fixedEnv(),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        errors = p.communicate()[1]
+        if p.returncode != INTERRUPTED_EXIT_CODE:
+            print >> sys.stderr, errors
+            print >> sys.stderr, ("FAIL: %s wasn't interrupted at call %d of %s, "
+                                  "exit code: %d" % (name, call, functionName,
+                                                     p.returncode))
+            sys.exit(1)
+
+    startTime = time.time()
+    output = runCommand([sys.executable, IMPORTER] + importerArgs,
+                        gitDir, fixedEnv())
+    elapsed = time.time() - startTime
+
+    if interrupt and "Resuming interrupted import" not in output:
+        print >> sys.stderr, "FAIL: %s didn't resume the interrupted import" % name
+        sys.exit(1)
+
+    inFile = open(metricsFile, "r")
+    counters = json.load(inFile)["counters"]
+    inFile.close()
+
+    result = {
+        "name": name,
+        "seconds": elapsed,
+        "revisions": importedRevisions(gitDir),
+        "changesets": counters.get("changesetsMatched", 0),
+        "files": (counters.get("filesWritten", 0) +
+                  counters.get("filesDeleted", 0)),
+        "subprocesses": counters.get("subprocessesSpawned", 0),
+        "head": runCommand(["git", "rev-parse", "HEAD"], gitDir).strip(),
+    }
+    result.update(importedHistory(gitDir))
+    return result
+
+
+def runTargetsVariant(gitTemplateDir, hgDir, workDir, baseRevision):
+    """
+    Imports the default and release branches into their own git branches in
+    one run, with --target. The release branch must have the changesets hg's
+    file() revset finds in its history, uplifts included. Returns the result
+    for the default branch's import, which must match the other variants.
+    """
+    name = "fast-import-targets"
+    mainBranch = runCommand(["git", "rev-parse", "--abbrev-ref", "HEAD"],
+                            gitTemplateDir).strip()
+    result = runVariant(name, ["--target", "default:" + mainBranch,
+                               "--target", "%s:%s" % (RELEASE_BRANCH,
+                                                      RELEASE_BRANCH)],
+                        gitTemplateDir, hgDir, workDir)
+
+    gitDir = os.path.join(workDir, name)
+    releaseHead = runCommand(["hg", "log", "-r", RELEASE_BRANCH,
+                              "--template", "{node}"], hgDir, fixedEnv())
+    revFile = runCommand(["git", "show",
+                          RELEASE_BRANCH + ":last_m_c_import_rev.txt"], gitDir)
+    if (importedRevisions(gitDir, RELEASE_BRANCH) !=
+            expectedRevisions(hgDir, baseRevision, RELEASE_BRANCH) or
+            revFile != releaseHead + "\n"):
+        print >> sys.stderr, ("FAIL: %s didn't import the changesets on the "
+                              "%s branch" % (name, RELEASE_BRANCH))
+        sys.exit(1)
+
+    return result
+
+
+def importedHistory(gitDir):
+    """
+    Returns what an import must have in common with the reference importer:
+    the last imported commit, which covers the history, trees and modes up to
+    it, and the content of the final commit.
+    """
+    changeLog = runCommand(["git", "show", "HEAD:CHANGELOG"], gitDir)
+    return {
+        "imported": runCommand(["git", "rev-parse", "HEAD~1"], gitDir).strip(),
+        "commits": int(runCommand(["git", "rev-list", "--count", "HEAD"],
+                                  gitDir).strip()),
+        "revFile": runCommand(["git", "show", "HEAD:last_m_c_import_rev.txt"],
+                              gitDir),
+        # The reference importer leaves a blank line after each entry.
+        "changeLog": [line for line in changeLog.splitlines() if line],
+    }
+
+
+HG_REVISION_RE = re.compile(r"^mozilla-central hg revision: ([0-9a-f]{40})$",
+                            re.MULTILINE)
+
+
+def importedRevisions(gitDir, ref="HEAD"):
+    """
+    Returns the hg revisions imported into ref, oldest first.
+    """
+    log = runCommand(["git", "log", "--reverse", "--format=%B", ref], gitDir)
+    return HG_REVISION_RE.findall(log)
+
+
+def expectedRevisions(hgDir, baseRevision, branch=None):
+    """
+    Returns the hg revisions an import after baseRevision should bring in,
+    oldest first: the non-merge changesets that touch Loop files, as hg's
+    file() revset finds them by reading every changeset. If branch is given,
+    only those in the history of its head.
+    """
+    sys.path.insert(0, ROOT_DIR)
+    from extract_from_hg import IMPORT_RULES
+
+    pattern = "|".join(re.escape(rule.source) + ("" if rule.isPrefix() else "$")
+                       for rule in IMPORT_RULES.rules)
+    revset = "%s: and not %s and not merge() and file(r're:%s')" % (
+        baseRevision, baseRevision, pattern)
+    if branch:
+        revset += " and ::%s" % branch
+    return runCommand(["hg", "log", "-r", revset, "--template", "{node}\n"],
+                      hgDir, fixedEnv()).split()
+
+
+def runReference(gitTemplateDir, hgDir, workDir):
+    gitDir = os.path.join(workDir, "reference")
+    shutil.copytree(gitTemplateDir, gitDir, symlinks=True)
+
+    startTime = time.time()
+    runCommand([sys.executable, REFERENCE_IMPORTER,
+                "--skip-pull-git", "--skip-pull-hg",
+                "--source-clone", hgDir],
+               gitDir, fixedEnv())
+    result = {"seconds": time.time() - startTime}
+    result.update(importedHistory(gitDir))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark and regression test for extract_from_hg.py")
+    parser.add_argument('--changesets', dest='changesets', type=int,
+                        default=DEFAULT_CHANGESETS,
+                        help='Number of synthetic changesets (default: %d)' % DEFAULT_CHANGESETS)
+    parser.add_argument('--loop-fraction', dest='loop_fraction', type=float,
+                        default=DEFAULT_LOOP_FRACTION,
+                        help='Fraction of changesets touching Loop files (default: %s)' % DEFAULT_LOOP_FRACTION)
+    parser.add_argument('--seed', dest='seed', type=int, default=DEFAULT_SEED,
+                        help='Random seed for the synthetic history (default: %d)' % DEFAULT_SEED)
+    parser.add_argument('--variant', dest='variants', action='append',
+                        default=None, metavar='NAME:ARGS',
+                        help='An importer variant to run, e.g. '
+                             '"slow:--per-file-git --prefetch-workers 0". '
+                             'May be repeated. Defaults to the built-in variants.')
+    parser.add_argument('--json', dest='json_output', default=None,
+                        metavar='PATH', help='Also write the results to PATH as JSON')
+    parser.add_argument('--keep', dest='keep', action='store_true',
+                        default=False,
+                        help='Keep the temporary repositories for inspection')
+    args = parser.parse_args()
+
+    if args.variants:
+        variants = [(variant.split(":", 1)[0], variant.split(":", 1)[1].split())
+                    for variant in args.variants]
+    else:
+        variants = DEFAULT_VARIANTS
+
+    workDir = tempfile.mkdtemp(prefix="loop-import-bench-")
+    try:
+        hgDir = os.path.join(workDir, "mozilla-central")
+        gitTemplateDir = os.path.join(workDir, "loop-client")
+
+        print "Building %d synthetic changesets in %s" % (args.changesets, workDir)
+        hgRepo = SyntheticHgRepo(hgDir, args.seed, args.loop_fraction)
+        baseRevision = hgRepo.build(args.changesets)
+        print "Loop changes: %s" % ", ".join(
+            "%d %s" % (hgRepo.stats[stat], stat) for stat in sorted(hgRepo.stats))
+        createGitRepo(gitTemplateDir, hgDir, baseRevision)
+
+        # The original importer fails on a changeset that doesn't change
+        # anything in git, which an uplift imported after the change it
+        # uplifts, or a change of flags, is. So it's compared with imports of
+        # just the default branch.
+        defaultDir = os.path.join(workDir, "mozilla-central-default")
+        runCommand(["hg", "clone", "-q", "-U", "-r", "default", hgDir,
+                    defaultDir], None, fixedEnv())
+
+        reference = runReference(gitTemplateDir, defaultDir, workDir)
+
+        results = [runVariant(name, extraArgs, gitTemplateDir, defaultDir,
+                              workDir)
+                   for name, extraArgs in variants]
+        branchResults = []
+        if not args.variants:
+            results += [runVariant(name, extraArgs, gitTemplateDir, defaultDir,
+                                   workDir, (functionName, call))
+                        for name, extraArgs, functionName, call
+                        in INTERRUPTED_VARIANTS]
+            results.append(runTargetsVariant(gitTemplateDir, hgDir, workDir,
+                                             baseRevision))
+            branchResults = [runVariant(name, extraArgs, gitTemplateDir, hgDir,
+                                        workDir)
+                             for name, extraArgs in BRANCH_VARIANTS]
+        expected = expectedRevisions(hgDir, baseRevision)
+    finally:
+        if args.keep:
+            print "Repositories kept in %s" % workDir
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    print "reference importer: %.2f seconds" % reference["seconds"]
+    print "%-28s %8s %10s %10s %8s  %s" % ("variant", "seconds", "csets/s",
+                                           "files/s", "spawns", "head")
+    for result in results + branchResults:
+        print "%-28s %8.2f %10.1f %10.1f %8d  %s" % (
+            result["name"], result["seconds"],
+            result["changesets"] / result["seconds"],
+            result["files"] / result["seconds"],
+            result["subprocesses"], result["head"][:12])
+
+    if args.json_output:
+        outFile = open(args.json_output, "w")
+        json.dump({"reference": reference, "variants": results + branchResults},
+                  outFile, indent=2, sort_keys=True)
+        outFile.close()
+
+    if results[0]["changesets"] == 0:
+        print >> sys.stderr, "FAIL: no changesets were imported"
+        sys.exit(1)
+
+    if len(set(result["head"] for result in results)) != 1:
+        print >> sys.stderr, "FAIL: variants produced different git history"
+        sys.exit(1)
+
+    for result in results:
+        for key in ("imported", "commits", "revFile", "changeLog"):
+            if result[key] != reference[key]:
+                print >> sys.stderr, ("FAIL: %s doesn't match the reference "
+                                      "importer's %s" % (result["name"], key))
+                sys.exit(1)
+
+    for result in branchResults:
+        if result["revisions"] != expected:
+            print >> sys.stderr, ("FAIL: %s doesn't import the changesets hg's "
+                                  "file() revset finds" % result["name"])
+            sys.exit(1)
+
+    print "All variants produced identical git history, matching the reference importer"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+##
+# Unit tests for the import rules of extract_from_hg.py: how mozilla-central
+# paths are mapped into loop-client, which rule wins when several match, and
+# that each content transform gives the same result when run again.
+#
+# Requires the same modules as extract_from_hg.py. Run with:
+#   python test/importer/test_import_rules.py
+##
+
+import os
+import re
+import sys
+import unittest
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        os.pardir, os.pardir))
+sys.path.insert(0, ROOT_DIR)
+
+import extract_from_hg
+from extract_from_hg import IMPORT_RULES, ImportRule, ImportRules
+
+LOOP_DIR = "browser/extensions/loop/"
+
+ESLINT_PLUGIN_LINE = \
+    '"eslint-plugin-mozilla": "../../../../testing/eslint-plugin-mozilla",'
+
+
+def readRepoFile(filename):
+    with open(os.path.join(ROOT_DIR, filename), "rb") as f:
+        return f.read()
+
+
+def importFile(hgPath, fileData, existingData):
+    """
+    Returns the loop-client path and data of hgPath, as the importer writes
+    them when existingData is in the repo.
+    """
+    rule = IMPORT_RULES.match(hgPath)
+    filename = rule.translatePath(hgPath)
+    return filename, rule.transform(filename, fileData, lambda: existingData)
+
+
+class TestImportRuleMapping(unittest.TestCase):
+
+    def assertMaps(self, hgPath, filename):
+        rule = IMPORT_RULES.match(hgPath)
+        self.assertIsNotNone(rule, hgPath)
+        self.assertEqual(rule.translatePath(hgPath), filename)
+
+    def test_standalone(self):
+        self.assertMaps(LOOP_DIR + "standalone/content/js/webapp.js",
+                        "content/js/webapp.js")
+        self.assertMaps(LOOP_DIR + "standalone/server.js", "server.js")
+
+    def test_shared(self):
+        self.assertMaps(LOOP_DIR + "content/shared/js/utils.js",
+                        "content/shared/js/utils.js")
+        self.assertMaps(LOOP_DIR + "test/shared/utils_test.js",
+                        "test/shared/utils_test.js")
+        self.assertMaps(LOOP_DIR + "test/standalone/webapp_test.js",
+                        "test/standalone/webapp_test.js")
+
+    def test_exact_files(self):
+        self.assertMaps(LOOP_DIR + "standalone/content/index.html",
+                        "content/index.html")
+        self.assertMaps(LOOP_DIR + "standalone/package.json", "package.json")
+        self.assertMaps(LOOP_DIR + "test/shared/index.html",
+                        "test/shared/index.html")
+
+    def test_other_files(self):
+        for hgPath in [LOOP_DIR + "chrome/content/panels/js/panel.js",
+                       LOOP_DIR + "content/panels/index.html",
+                       LOOP_DIR + "standalone",
+                       LOOP_DIR + "test/mochitest/head.js",
+                       "browser/base/content/browser.js",
+                       "other/" + LOOP_DIR + "standalone/server.js"]:
+            self.assertIsNone(IMPORT_RULES.match(hgPath), hgPath)
+
+
+class TestImportRulePrecedence(unittest.TestCase):
+
+    def test_exact_file_over_prefix(self):
+        # The standalone/ prefix rule comes first in IMPORT_RULES.
+        rule = IMPORT_RULES.match(LOOP_DIR + "standalone/content/index.html")
+
+        self.assertFalse(rule.isPrefix())
+        self.assertEqual(rule.transforms, (extract_from_hg.keepLocaleList,))
+
+    def test_exact_file_only_matches_itself(self):
+        rule = IMPORT_RULES.match(LOOP_DIR + "standalone/content/index.html.orig")
+
+        self.assertTrue(rule.isPrefix())
+        self.assertEqual(rule.transforms, ())
+
+    def test_longest_prefix_whatever_the_order(self):
+        shortRule = ImportRule("a/", "short/")
+        longRule = ImportRule("a/b/", "long/")
+
+        for rules in ([shortRule, longRule], [longRule, shortRule]):
+            importRules = ImportRules(rules)
+
+            self.assertIs(importRules.match("a/b/c.js"), longRule)
+            self.assertIs(importRules.match("a/bc.js"), shortRule)
+            self.assertIs(importRules.match("a/c/b/d.js"), shortRule)
+            self.assertIsNone(importRules.match("b/c.js"))
+
+    def test_sources_are_literal(self):
+        importRules = ImportRules([ImportRule("a.b/", ""),
+                                   ImportRule("c+d.js", "e.js")])
+
+        self.assertIsNone(importRules.match("aXb/c.js"))
+        self.assertIsNone(importRules.match("ccd.js"))
+        self.assertIsNotNone(importRules.match("c+d.js"))
+
+
+class TestImportRuleTransforms(unittest.TestCase):
+
+    def assertImports(self, hgPath, fileData, expected, existingData=None):
+        if existingData is None:
+            existingData = expected
+        filename, imported = importFile(hgPath, fileData, existingData)
+        self.assertEqual(imported, expected)
+
+        # Importing the result again, e.g. when a later changeset doesn't
+        # touch the lines a transform changes, leaves it as it is.
+        filename, reimported = importFile(hgPath, imported, imported)
+        self.assertEqual(reimported, expected)
+
+    def test_keep_locale_list(self):
+        existing = readRepoFile("content/index.html")
+        upstream = re.sub(r'(<meta name="locales" content=")[^"]*', r"\1en-US",
+                          existing, 1)
+        self.assertNotEqual(upstream, existing)
+
+        self.assertImports(LOOP_DIR + "standalone/content/index.html",
+                           upstream, existing)
+
+    def test_update_paths_in_test_files(self):
+        for directory in ("shared", "standalone"):
+            existing = readRepoFile("test/%s/index.html" % directory)
+            upstream = existing.replace('src="../../content/',
+                                        'src="../../standalone/content/')
+            self.assertNotEqual(upstream, existing)
+
+            self.assertImports(LOOP_DIR + "test/%s/index.html" % directory,
+                               upstream, existing)
+
+    def test_strip_package_json(self):
+        existing = readRepoFile("package.json")
+        upstream = existing.replace('"eslint": "1.10.x",\n    \n',
+                                    '"eslint": "1.10.x",\n    %s\n' %
+                                    ESLINT_PLUGIN_LINE)
+        self.assertNotEqual(upstream, existing)
+
+        self.assertImports(LOOP_DIR + "standalone/package.json",
+                           upstream, existing)
+
+    def test_other_files_unchanged(self):
+        fileData = 'src="../../standalone/content/js/webapp.js"\n'
+
+        self.assertImports(LOOP_DIR + "test/shared/utils_test.js",
+                           fileData, fileData)
+
+
+if __name__ == "__main__":
+    unittest.main()
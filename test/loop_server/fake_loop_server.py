@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+
+##
+# A local stand-in for the loop-server, implementing the room endpoints that
+# the standalone client (content/js/standaloneMozLoop.js) uses:
+#
+#   GET  /v0/rooms/<token>                      room information
+#   POST /v0/rooms/<token> {"action": "join"}    join, returns a session
+#   POST /v0/rooms/<token> {"action": "refresh"} extends the membership
+#   POST /v0/rooms/<token> {"action": "leave"}   leaves the room
+#   POST /v0/rooms/<token> {"action": "status"}  connection status updates
+#
+# Rooms are created the first time a token is used, and hold at most
+# ROOM_MAX_CLIENTS participants, who are dropped if they don't refresh before
+# their membership expires. Errors are returned in the loop-server format
+# (code, errno, error), so the client's error handling can be exercised too.
+#
+# The time taken to handle each request is recorded per endpoint (with POSTs
+# split by action), and is available as JSON from GET /__stats__. Delays can
+# be added to each endpoint to see how the client copes with a slow server.
+#
+# To use it with the development server:
+#
+#   $ python3 test/loop_server/fake_loop_server.py
+#   $ LOOP_SERVER_URL=http://localhost:5000 make runserver
+#
+# The room URLs printed on the console then work for any token, e.g.
+# http://localhost:3000/content/abcdef.
+#
+# Requires Python 3.7 or later, and nothing outside the standard library.
+##
+
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+import re
+import secrets
+import signal
+import sys
+import time
+from email.utils import formatdate
+from http import HTTPStatus
+
+DEF_HOST = "localhost"
+DEF_PORT = 5000
+DEF_EXPIRES = 300
+DEF_CLIENT_URL = "http://localhost:3000/content/"
+
+# These match the values used by the standalone client and the loop-server.
+API_PREFIX = "/v0"
+ROOM_MAX_CLIENTS = 2
+ERRNO_INVALID_PARAMETERS = 107
+ERRNO_INVALID_TOKEN = 105
+ERRNO_EXPIRED = 111
+ERRNO_ROOM_FULL = 202
+
+CORS_MAX_AGE = 600
+MAX_BODY_SIZE = 64 * 1024
+ROOM_PATH_RE = re.compile(r"^" + API_PREFIX + r"/rooms/([A-Za-z0-9_-]{1,64})$")
+STATUS_FIELDS = ("event", "state", "connections", "sendStreams", "recvStreams")
+
+
+class HTTPError(Exception):
+    """
+    An error response in the format the loop-server uses.
+    """
+    def __init__(self, status, errno, message):
+        super().__init__(message)
+        self.status = status
+        self.errno = errno
+        self.message = message
+
+    def to_json(self):
+        return {
+            "code": self.status,
+            "errno": self.errno,
+            "error": self.message
+        }
+
+
+class Request(object):
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def json(self):
+        try:
+            data = json.loads(self.body.decode("utf-8") or "null")
+        except ValueError:
+            raise HTTPError(400, ERRNO_INVALID_PARAMETERS, "Invalid JSON body")
+        if not isinstance(data, dict):
+            raise HTTPError(400, ERRNO_INVALID_PARAMETERS, "Expected a JSON object")
+        return data
+
+    def session_token(self):
+        """
+        Returns the session token from the Basic Authorization header, as
+        sent by the client once it has joined a room, or None.
+        """
+        auth = self.headers.get("authorization", "")
+        if not auth.startswith("Basic "):
+            return None
+        try:
+            return base64.b64decode(auth[6:], validate=True).decode("utf-8")
+        except (binascii.Error, UnicodeDecodeError):
+            raise HTTPError(401, ERRNO_INVALID_TOKEN, "Invalid authorization header")
+
+
+async def read_request(reader):
+    """
+    Reads one HTTP/1.1 request, returning None if the connection was closed
+    before a request started.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, version = request_line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, ERRNO_INVALID_PARAMETERS, "Malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length") or 0)
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(413, ERRNO_INVALID_PARAMETERS, "Request body too large")
+    body = await reader.readexactly(length) if length else b""
+
+    return Request(method, path.split("?", 1)[0], version, headers, body)
+
+
+class EndpointStats(object):
+    """
+    Counts and server side latencies (in milliseconds) for one endpoint.
+    """
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+
+    def add(self, status, latency):
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def to_json(self):
+        return dict(latency_summary(self.latencies),
+                    statuses={str(status): count
+                              for status, count in sorted(self.statuses.items())})
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def latency_summary(latencies):
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3) if values else 0,
+        "p50": round(percentile(values, 0.5), 3),
+        "p90": round(percentile(values, 0.9), 3),
+        "p99": round(percentile(values, 0.99), 3),
+        "max": round(values[-1], 3) if values else 0
+    }
+
+
+class Room(object):
+    def __init__(self, token, client_url):
+        self.token = token
+        self.room_url = client_url + token
+        self.room_name = "Room " + token
+        self.created = int(time.time())
+        # Maps session tokens to the monotonic time their membership expires.
+        self.participants = {}
+        # Maps session tokens to what other clients see of the participant.
+        self.participant_info = {}
+
+    def expire_participants(self, now):
+        for session_token, expiry in list(self.participants.items()):
+            if expiry <= now:
+                self.remove(session_token)
+
+    def remove(self, session_token):
+        self.participants.pop(session_token, None)
+        self.participant_info.pop(session_token, None)
+
+    def to_json(self):
+        return {
+            "roomToken": self.token,
+            "roomUrl": self.room_url,
+            "roomName": self.room_name,
+            "roomOwner": "Fake Loop Server",
+            "maxSize": ROOM_MAX_CLIENTS,
+            "creationTime": self.created,
+            "participants": [self.participant_info[session_token]
+                             for session_token in sorted(self.participants)]
+        }
+
+
+class FakeLoopServer(object):
+    """
+    Handles the room requests, keeping all state in memory.
+
+    :param expires:    Seconds a membership lasts without being refreshed.
+    :param delays:     Dict of endpoint name to seconds to wait before
+                       responding, see endpoint_name for the names.
+    :param client_url: Base of the room urls returned to the client.
+    """
+    def __init__(self, expires=DEF_EXPIRES, delays=None, client_url=DEF_CLIENT_URL):
+        self.expires = expires
+        self.delays = delays or {}
+        self.client_url = client_url
+        self.rooms = {}
+        self.stats = {}
+        self.started = time.monotonic()
+        self.connections = 0
+        self.max_connections = 0
+        self.server = None
+        # The writer of each open connection, keyed by the task handling it.
+        self.handlers = {}
+
+    async def start(self, host=DEF_HOST, port=DEF_PORT):
+        self.server = await asyncio.start_server(self.handle_connection, host, port,
+                                                 backlog=4096)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            # Closing the idle keep-alive connections ends their handlers.
+            for writer in self.handlers.values():
+                writer.close()
+            await asyncio.gather(*self.handlers, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    def reset_stats(self):
+        self.stats = {}
+        self.started = time.monotonic()
+        self.max_connections = self.connections
+
+    def stats_json(self):
+        elapsed = time.monotonic() - self.started
+        total = sum(len(stats.latencies) for stats in self.stats.values())
+        return {
+            "elapsed": round(elapsed, 3),
+            "requests": total,
+            "requestsPerSecond": round(total / elapsed, 1) if elapsed else 0,
+            "maxConnections": self.max_connections,
+            "rooms": len(self.rooms),
+            "participants": sum(len(room.participants) for room in self.rooms.values()),
+            "endpoints": {name: stats.to_json()
+                          for name, stats in sorted(self.stats.items())}
+        }
+
+    async def handle_connection(self, reader, writer):
+        self.handlers[asyncio.current_task()] = writer
+        self.connections += 1
+        self.max_connections = max(self.max_connections, self.connections)
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as e:
+                    await self.write_response(writer, None, e.status, e.to_json(), False)
+                    break
+                if request is None:
+                    break
+
+                keep_alive = request.keep_alive
+                start = time.perf_counter()
+                name = endpoint_name(request)
+                status, body = await self.dispatch(name, request)
+                await self.write_response(writer, request, status, body, keep_alive)
+
+                if name != "stats":
+                    self.stats.setdefault(name, EndpointStats()).add(
+                        status, (time.perf_counter() - start) * 1000)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            del self.handlers[asyncio.current_task()]
+            writer.close()
+
+    async def dispatch(self, name, request):
+        delay = self.delays.get(name, self.delays.get("*", 0))
+        if delay:
+            await asyncio.sleep(delay)
+
+        try:
+            if request.method == "OPTIONS":
+                return 204, None
+            if request.path == "/__stats__":
+                if request.method == "POST":
+                    self.reset_stats()
+                return 200, self.stats_json()
+
+            match = ROOM_PATH_RE.match(request.path)
+            if not match:
+                raise HTTPError(404, 999, "Not Found")
+
+            room = self.rooms.get(match.group(1))
+            if room is None:
+                room = self.rooms[match.group(1)] = Room(match.group(1), self.client_url)
+            room.expire_participants(time.monotonic())
+
+            if request.method == "GET":
+                return self.get_room(room, request)
+            if request.method == "POST":
+                return self.post_room(room, request)
+            raise HTTPError(405, 999, "Method Not Allowed")
+        except HTTPError as e:
+            return e.status, e.to_json()
+
+    def get_room(self, room, request):
+        session_token = request.session_token()
+        if session_token is not None and session_token not in room.participants:
+            raise HTTPError(401, ERRNO_INVALID_TOKEN, "Invalid session token")
+        return 200, room.to_json()
+
+    def post_room(self, room, request):
+        data = request.json()
+        action = data.get("action")
+
+        if action == "join":
+            if len(room.participants) >= min(ROOM_MAX_CLIENTS,
+                                             data.get("clientMaxSize") or ROOM_MAX_CLIENTS):
+                raise HTTPError(400, ERRNO_ROOM_FULL, "The room is full.")
+            session_token = secrets.token_urlsafe(16)
+            room.participants[session_token] = time.monotonic() + self.expires
+            room.participant_info[session_token] = {
+                "roomConnectionId": secrets.token_hex(8),
+                "displayName": data.get("displayName") or "Guest"
+            }
+            return 200, {
+                "apiKey": "fake-api-key",
+                "sessionId": "fake-session-" + room.token,
+                "sessionToken": session_token,
+                "expires": self.expires
+            }
+
+        if action not in ("refresh", "leave", "status"):
+            raise HTTPError(400, ERRNO_INVALID_PARAMETERS, "Unknown action")
+
+        session_token = data.get("sessionToken") or request.session_token()
+        if session_token not in room.participants:
+            raise HTTPError(410, ERRNO_EXPIRED, "Participation has expired")
+
+        if action == "refresh":
+            room.participants[session_token] = time.monotonic() + self.expires
+            return 200, {"expires": self.expires}
+        if action == "leave":
+            room.remove(session_token)
+            return 204, None
+
+        missing = [field for field in STATUS_FIELDS if field not in data]
+        if missing:
+            raise HTTPError(400, ERRNO_INVALID_PARAMETERS,
+                            "Missing: " + ", ".join(missing))
+        return 204, None
+
+    async def write_response(self, writer, request, status, body, keep_alive):
+        headers = [
+            "HTTP/1.1 %d %s" % (status, HTTPStatus(status).phrase),
+            "Date: " + formatdate(usegmt=True),
+            "Connection: " + ("keep-alive" if keep_alive else "close")
+        ]
+        origin = request and request.headers.get("origin")
+        if origin:
+            headers += [
+                "Access-Control-Allow-Origin: " + origin,
+                "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+                "Access-Control-Allow-Headers: Authorization, Content-Type",
+                "Access-Control-Max-Age: %d" % CORS_MAX_AGE,
+                "Vary: Origin"
+            ]
+
+        payload = b""
+        if body is not None:
+            payload = json.dumps(body).encode("utf-8")
+            headers.append("Content-Type: application/json; charset=utf-8")
+        headers.append("Content-Length: %d" % len(payload))
+
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+
+
+def endpoint_name(request):
+    """
+    Returns the name the request's latency is recorded under: "GET room",
+    "POST <action>", "OPTIONS" or "stats".
+    """
+    if request.method == "OPTIONS":
+        return "OPTIONS"
+    if request.path == "/__stats__":
+        return "stats"
+    if request.method == "POST":
+        try:
+            action = json.loads(request.body.decode("utf-8") or "null")["action"]
+        except (ValueError, TypeError, KeyError):
+            action = None
+        return "POST " + (action if isinstance(action, str) else "unknown")
+    return request.method + " room"
+
+
+def parse_delay(value):
+    """
+    Parses an --delay argument of the form "ENDPOINT=MILLISECONDS", where the
+    endpoint is a name like "POST join", or "*" for every endpoint.
+    """
+    name, sep, delay = value.rpartition("=")
+    try:
+        if not sep or not name:
+            raise ValueError
+        return name, float(delay) / 1000
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected ENDPOINT=MILLISECONDS, e.g. 'POST join=200'")
+
+
+async def serve(args):
+    server = FakeLoopServer(expires=args.expires, delays=dict(args.delay),
+                            client_url=args.client_url)
+    host, port = await server.start(args.host, args.port)
+    print("Fake loop server listening on http://%s:%d%s" % (host, port, API_PREFIX))
+    print("Stats are available from http://%s:%d/__stats__" % (host, port))
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    await stopped.wait()
+    await server.stop()
+
+    stats = server.stats_json()
+    if args.stats_file:
+        with open(args.stats_file, "w") as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+            f.write("\n")
+    print(format_endpoint_stats(stats["endpoints"]))
+
+
+def format_endpoint_stats(endpoints):
+    lines = ["%-14s %8s %9s %9s %9s %9s" % ("endpoint", "count", "p50 ms",
+                                              "p90 ms", "p99 ms", "max ms")]
+    for name, stats in sorted(endpoints.items()):
+        lines.append("%-14s %8d %9.2f %9.2f %9.2f %9.2f" % (
+            name, stats["count"], stats["p50"], stats["p90"], stats["p99"], stats["max"]))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake loop-server for the standalone client")
+    parser.add_argument('--host',
+                        default=DEF_HOST,
+                        help="Address to listen on. Default = " + DEF_HOST)
+    parser.add_argument('--port',
+                        type=int,
+                        default=DEF_PORT,
+                        help="Port to listen on. Default = " + str(DEF_PORT))
+    parser.add_argument('--expires',
+                        type=float,
+                        default=DEF_EXPIRES,
+                        metavar="seconds",
+                        help="How long a room membership lasts between refreshes. "
+                             "Default = " + str(DEF_EXPIRES))
+    parser.add_argument('--delay',
+                        type=parse_delay,
+                        action="append",
+                        default=[],
+                        metavar="ENDPOINT=MS",
+                        help="Delay the responses of an endpoint, e.g. 'POST join=200'. "
+                             "'*' applies to all endpoints. Can be given more than once.")
+    parser.add_argument('--client-url',
+                        default=DEF_CLIENT_URL,
+                        metavar="url",
+                        help="Base of the room urls. Default = " + DEF_CLIENT_URL)
+    parser.add_argument('--stats-file',
+                        default=None,
+                        metavar="name",
+                        help="Write the endpoint stats to this file when stopped")
+    args = parser.parse_args()
+
+    if sys.version_info < (3, 7):
+        sys.exit("fake_loop_server.py requires Python 3.7 or later")
+    asyncio.run(serve(args))
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+##
+# Replays the requests that many concurrent standalone guests make to the
+# loop-server, to benchmark the client's request volume and polling
+# behaviour without a real server or browser.
+#
+# Each guest follows the sequence of content/js/standaloneMozLoop.js and
+# activeRoomStore.js: it fetches the room information, joins the room, sends
+# the connection status updates the SDK driver would send as it and the
+# other participant of the room connect and start streaming, refreshes its
+# membership every expires * EXPIRES_TIME_FACTOR seconds, and finally leaves.
+# Like a browser, each guest sends a CORS preflight request before its first
+# request to the room url, and again whenever the preflight cache expires.
+#
+# By default the guests run against a FakeLoopServer started in this
+# process, whose membership expiry (--expires) is shortened so that a run
+# covers several refresh cycles. Use --server to point them at another
+# server, e.g. a fake_loop_server.py running elsewhere, instead.
+#
+# The request counts, client side latencies and errors of each endpoint are
+# reported at the end, along with the server's own stats if it has any.
+#
+#   $ python3 test/loop_server/guest_load.py --guests 4000 --stay 30
+#
+# Requires Python 3.7 or later, and nothing outside the standard library.
+##
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import sys
+import time
+from urllib.parse import urlsplit
+
+from fake_loop_server import (API_PREFIX, DEF_HOST, ERRNO_ROOM_FULL,
+                              FakeLoopServer, format_endpoint_stats,
+                              latency_summary, parse_delay)
+
+DEF_GUESTS = 1000
+DEF_RAMP_UP = 10
+DEF_STAY = 30
+DEF_EXPIRES = 10
+DEF_CONNECTIONS = 256
+DEF_SEED = 1
+DEF_ORIGIN = "http://localhost:3000"
+
+# From activeRoomStore.js, the fraction of the membership expiry time after
+# which the client refreshes.
+EXPIRES_TIME_FACTOR = 0.9
+DISPLAY_NAME = "Guest"
+
+
+class HTTPConnection(object):
+    """
+    A minimal keep-alive HTTP/1.1 client connection.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, headers, body=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        lines = ["%s %s HTTP/1.1" % (method, path),
+                 "Host: %s:%d" % (self.host, self.port),
+                 "Content-Length: %d" % len(payload)]
+        lines.extend("%s: %s" % header for header in headers.items())
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + payload)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by the server")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        length = int(response_headers.get("content-length") or 0)
+        data = await self.reader.readexactly(length) if length else b""
+        if response_headers.get("connection", "").lower() == "close":
+            self.close()
+
+        return status, response_headers, json.loads(data.decode("utf-8")) if data else None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+class Client(object):
+    """
+    Sends the guests' requests over a fixed size pool of connections, and
+    records the latency and outcome of each, per endpoint.
+    """
+    def __init__(self, server_url, connections):
+        parts = urlsplit(server_url)
+        self.base_path = parts.path.rstrip("/")
+        self.pool = asyncio.Queue()
+        for i in range(connections):
+            self.pool.put_nowait(HTTPConnection(parts.hostname, parts.port or 80))
+        self.latencies = {}
+        self.errors = {}
+
+    async def request(self, endpoint, method, path, headers, body=None):
+        connection = await self.pool.get()
+        start = time.perf_counter()
+        try:
+            status, response_headers, data = await connection.request(
+                method, self.base_path + path, headers, body)
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError) as e:
+            connection.close()
+            self.add_error(endpoint, type(e).__name__)
+            raise
+        finally:
+            self.pool.put_nowait(connection)
+
+        self.latencies.setdefault(endpoint, []).append((time.perf_counter() - start) * 1000)
+        if status >= 400:
+            errno = data.get("errno") if isinstance(data, dict) else None
+            self.add_error(endpoint, "HTTP %d errno %s" % (status, errno))
+        return status, response_headers, data
+
+    def add_error(self, endpoint, description):
+        errors = self.errors.setdefault(endpoint, {})
+        errors[description] = errors.get(description, 0) + 1
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+
+class SdkMetrics(object):
+    """
+    Tracks the connection counts the way otSdkDriver's _notifyMetricsEvent
+    does, returning the status update that the client sends for each event.
+    """
+    def __init__(self):
+        self.connections = 0
+        self.send_streams = 0
+        self.recv_streams = 0
+
+    def event(self, event_name, client_type=None):
+        state = None
+        if event_name == "Session.connectionCreated":
+            self.connections += 1
+            if client_type == "local":
+                state = "waiting"
+        elif event_name == "Session.connectionDestroyed":
+            self.connections -= 1
+            if client_type == "local":
+                return None
+            elif not self.connections:
+                state = "waiting"
+        elif event_name == "Publisher.streamCreated":
+            self.send_streams += 1
+        elif event_name == "Session.streamCreated":
+            self.recv_streams += 1
+        elif event_name == "Session.streamDestroyed":
+            self.recv_streams -= 1
+
+        if not state:
+            if self.send_streams:
+                state = "sendrecv" if self.recv_streams else "sending"
+            elif self.recv_streams:
+                state = "receiving"
+            else:
+                state = "starting"
+
+        return {
+            "action": "status",
+            "event": event_name,
+            "state": state,
+            "connections": self.connections,
+            "sendStreams": self.send_streams,
+            "recvStreams": self.recv_streams
+        }
+
+
+class Guest(object):
+    def __init__(self, client, room, origin, start_delay, stay):
+        self.client = client
+        self.room = room
+        self.origin = origin
+        self.start_delay = start_delay
+        self.stay = stay
+        self.session_token = None
+        self.preflight_expires = 0
+        self.metrics = SdkMetrics()
+        # Events from the other participant, as the SDK would report them.
+        self.peer_events = asyncio.Queue()
+        self.outcome = None
+
+    async def send(self, endpoint, method, body=None):
+        path = "/rooms/" + self.room.token
+        if time.monotonic() >= self.preflight_expires:
+            status, headers, data = await self.client.request(
+                "OPTIONS", "OPTIONS", path, {
+                    "Origin": self.origin,
+                    "Access-Control-Request-Method": method,
+                    "Access-Control-Request-Headers": "authorization,content-type"
+                })
+            self.preflight_expires = time.monotonic() + \
+                int(headers.get("access-control-max-age") or 0)
+
+        headers = {"Origin": self.origin, "Content-Type": "application/json"}
+        if self.session_token:
+            headers["Authorization"] = "Basic " + \
+                base64.b64encode(self.session_token.encode("utf-8")).decode("ascii")
+        return await self.client.request(endpoint, method, path, headers, body)
+
+    async def send_status(self, event_name, client_type=None):
+        status = self.metrics.event(event_name, client_type)
+        if status:
+            await self.send("POST status", "POST", status)
+
+    async def run(self):
+        try:
+            await asyncio.sleep(self.start_delay)
+            self.outcome = await self.run_sequence()
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError):
+            self.outcome = "connection error"
+        finally:
+            self.room.remove(self)
+
+    async def run_sequence(self):
+        status, headers, data = await self.send("GET room", "GET")
+        if status != 200:
+            return "room unavailable"
+
+        status, headers, data = await self.send("POST join", "POST", {
+            "action": "join",
+            "displayName": DISPLAY_NAME,
+            "clientMaxSize": 2
+        })
+        if status != 200:
+            return "room full" if data and data.get("errno") == ERRNO_ROOM_FULL \
+                else "join failed"
+        self.session_token = data["sessionToken"]
+        refresh_at = time.monotonic() + data["expires"] * EXPIRES_TIME_FACTOR
+        leave_at = time.monotonic() + self.stay
+
+        await self.send_status("Session.connectionCreated", "local")
+        await self.send_status("Publisher.streamCreated")
+        for _ in self.room.join(self):
+            await self.send_status("Session.connectionCreated", "peer")
+            await self.send_status("Session.streamCreated")
+
+        while True:
+            now = time.monotonic()
+            if now >= leave_at:
+                break
+            if now >= refresh_at:
+                status, headers, data = await self.send("POST refresh", "POST", {
+                    "action": "refresh",
+                    "sessionToken": self.session_token
+                })
+                if status != 200:
+                    return "refresh failed"
+                refresh_at = time.monotonic() + data["expires"] * EXPIRES_TIME_FACTOR
+                continue
+
+            try:
+                events = await asyncio.wait_for(self.peer_events.get(),
+                                                min(refresh_at, leave_at) - now)
+            except asyncio.TimeoutError:
+                continue
+            for event_name, client_type in events:
+                await self.send_status(event_name, client_type)
+
+        self.room.leave(self)
+        await self.send("POST leave", "POST", {
+            "action": "leave",
+            "sessionToken": self.session_token
+        })
+        return "completed"
+
+
+class GuestRoom(object):
+    """
+    Lets the guests in the same room see each other join and leave.
+    """
+    def __init__(self, token):
+        self.token = token
+        self.joined = []
+
+    def join(self, guest):
+        peers = list(self.joined)
+        for peer in peers:
+            peer.peer_events.put_nowait([("Session.connectionCreated", "peer"),
+                                         ("Session.streamCreated", None)])
+        self.joined.append(guest)
+        return peers
+
+    def leave(self, guest):
+        self.remove(guest)
+        for peer in self.joined:
+            peer.peer_events.put_nowait([("Session.streamDestroyed", None),
+                                         ("Session.connectionDestroyed", "peer")])
+
+    def remove(self, guest):
+        if guest in self.joined:
+            self.joined.remove(guest)
+
+
+async def fetch_server_stats(client, reset=False):
+    """
+    Fetches (or resets) the stats of a fake loop server, returning None if
+    the server doesn't have any.
+    """
+    connection = await client.pool.get()
+    try:
+        path = "/__stats__"
+        status, headers, data = await connection.request("POST" if reset else "GET",
+                                                         path, {})
+    except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError):
+        return None
+    finally:
+        client.pool.put_nowait(connection)
+    return data if status == 200 else None
+
+
+def format_report(report):
+    lines = ["%d guests in %d rooms, %.1fs, %d requests (%.1f/s)" % (
+        report["guests"], report["rooms"], report["elapsed"], report["requests"],
+        report["requestsPerSecond"])]
+    lines.append("%.2f requests per guest, %.2f per guest-minute in a room" % (
+        report["requestsPerGuest"], report["requestsPerGuestMinute"]))
+    lines.append("Outcomes: " + ", ".join("%s %d" % item
+                                          for item in sorted(report["outcomes"].items())))
+    lines.append("Client side latencies:")
+    lines.append(format_endpoint_stats(report["endpoints"]))
+    for endpoint, errors in sorted(report["errors"].items()):
+        for description, count in sorted(errors.items()):
+            lines.append("Error: %s: %s x%d" % (endpoint, description, count))
+    if report.get("server"):
+        lines.append("Server side latencies:")
+        lines.append(format_endpoint_stats(report["server"]["endpoints"]))
+    return "\n".join(lines)
+
+
+async def run_load(args):
+    server = None
+    server_url = args.server
+    if not server_url:
+        server = FakeLoopServer(expires=args.expires, delays=dict(args.delay))
+        host, port = await server.start(DEF_HOST, 0)
+        server_url = "http://%s:%d%s" % (host, port, API_PREFIX)
+    print("Replaying %d guests against %s" % (args.guests, server_url))
+
+    client = Client(server_url, args.connections)
+    await fetch_server_stats(client, reset=True)
+
+    rng = random.Random(args.seed)
+    rooms = [GuestRoom("loadtest%05d" % i) for i in range(args.rooms or (args.guests + 1) // 2)]
+    guests = [Guest(client, rooms[i % len(rooms)], args.origin,
+                    rng.uniform(0, args.ramp_up), args.stay * rng.uniform(0.5, 1.5))
+              for i in range(args.guests)]
+
+    start = time.monotonic()
+    await asyncio.gather(*(guest.run() for guest in guests))
+    elapsed = time.monotonic() - start
+
+    server_stats = await fetch_server_stats(client)
+    client.close()
+    if server:
+        await server.stop()
+
+    outcomes = {}
+    for guest in guests:
+        outcomes[guest.outcome] = outcomes.get(guest.outcome, 0) + 1
+    requests = sum(len(latencies) for latencies in client.latencies.values())
+    report = {
+        "server": server_stats,
+        "guests": args.guests,
+        "rooms": len(rooms),
+        "elapsed": round(elapsed, 3),
+        "requests": requests,
+        "requestsPerSecond": round(requests / elapsed, 1),
+        "requestsPerGuest": round(requests / args.guests, 2),
+        "requestsPerGuestMinute": round(requests / (args.guests * args.stay / 60.0), 2),
+        "outcomes": outcomes,
+        "endpoints": {endpoint: latency_summary(latencies)
+                      for endpoint, latencies in client.latencies.items()},
+        "errors": client.errors
+    }
+
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    return outcomes.get("connection error", 0) == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay concurrent standalone guests "
+                                                 "against a loop server")
+    parser.add_argument('--server',
+                        default=None,
+                        metavar="url",
+                        help="Loop server to use, e.g. http://localhost:5000/v0. "
+                             "Default = a fake server started in this process")
+    parser.add_argument('--guests',
+                        type=int,
+                        default=DEF_GUESTS,
+                        help="Number of guests. Default = " + str(DEF_GUESTS))
+    parser.add_argument('--rooms',
+                        type=int,
+                        default=None,
+                        help="Number of rooms the guests are spread over. "
+                             "Default = one for every two guests")
+    parser.add_argument('--ramp-up',
+                        type=float,
+                        default=DEF_RAMP_UP,
+                        metavar="seconds",
+                        help="Period over which the guests arrive. Default = " + str(DEF_RAMP_UP))
+    parser.add_argument('--stay',
+                        type=float,
+                        default=DEF_STAY,
+                        metavar="seconds",
+                        help="Average time a guest stays in the room. Default = " + str(DEF_STAY))
+    parser.add_argument('--expires',
+                        type=float,
+                        default=DEF_EXPIRES,
+                        metavar="seconds",
+                        help="Membership expiry of the fake server, which sets how often the "
+                             "guests refresh. Default = " + str(DEF_EXPIRES))
+    parser.add_argument('--delay',
+                        type=parse_delay,
+                        action="append",
+                        default=[],
+                        metavar="ENDPOINT=MS",
+                        help="Delay the fake server's responses of an endpoint, "
+                             "e.g. 'POST join=200'")
+    parser.add_argument('--connections',
+                        type=int,
+                        default=DEF_CONNECTIONS,
+                        help="Number of connections the requests are sent over. "
+                             "Default = " + str(DEF_CONNECTIONS))
+    parser.add_argument('--origin',
+                        default=DEF_ORIGIN,
+                        help="Origin the guests send. Default = " + DEF_ORIGIN)
+    parser.add_argument('--seed',
+                        type=int,
+                        default=DEF_SEED,
+                        help="Seed for the guests' arrival and stay times. "
+                             "Default = " + str(DEF_SEED))
+    parser.add_argument('--json',
+                        default=None,
+                        metavar="name",
+                        help="Also write the report to this file as JSON")
+    args = parser.parse_args()
+
+    if sys.version_info < (3, 7):
+        sys.exit("guest_load.py requires Python 3.7 or later")
+    if not asyncio.run(run_load(args)):
+        sys.exit(1)
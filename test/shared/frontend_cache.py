@@ -0,0 +1,162 @@
+"""
+Caches the results of the frontend unit tests by the content of what they
+load, so that test files whose dependencies haven't changed since a green
+run don't need running again.
+
+The tests of each test file (a script named *_test.js) on a test page depend
+on the page itself, every other script and stylesheet it loads, and the test
+file. The key of a test file is the hash of all of those, so editing a
+source file reruns every test file on the pages loading it, editing a test
+file only reruns that one, and changing anything the pages don't load (like
+an l10n file or an image) reruns nothing.
+
+The cache is a JSON file holding, for each page, the key and the results of
+each test file whose tests all passed the last time they ran.
+"""
+from HTMLParser import HTMLParser
+import frontend_shards
+import hashlib
+import json
+import os
+import re
+
+# Bump when the format of the cache or what the keys cover changes.
+CACHE_VERSION = 1
+
+TEST_FILE_SUFFIX = "_test.js"
+
+EXTERNAL_URL_RE = re.compile(r"^(?:[a-z][a-z0-9+.-]*:|//)", re.I)
+
+
+class PageDependencyParser(HTMLParser):
+    """
+    Collects the urls of the scripts and stylesheets a page loads, in order.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "script" and attrs.get("src"):
+            self.urls.append(attrs["src"])
+        elif tag == "link" and attrs.get("href"):
+            self.urls.append(attrs["href"])
+
+
+def get_page_dependencies(page_path):
+    """
+    Returns the paths of the local files the page loads.
+    """
+    parser = PageDependencyParser()
+    with open(page_path) as f:
+        # As served, with the scripts the test server adds.
+        parser.feed(frontend_shards.add_shards_script(f.read()).decode("utf-8"))
+    parser.close()
+
+    page_dir = os.path.dirname(page_path)
+    return [os.path.normpath(os.path.join(page_dir, url.split("?")[0].split("#")[0]))
+            for url in parser.urls if not EXTERNAL_URL_RE.match(url)]
+
+
+def hash_file(path):
+    if not os.path.isfile(path):
+        return "missing"
+
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_test_file_keys(page_path, extra=""):
+    """
+    Returns a dict of the name of each test file the page loads to its key.
+    extra is added to every key, e.g. to tell browser versions apart.
+    """
+    page_dir = os.path.dirname(page_path)
+    dependencies = get_page_dependencies(page_path)
+
+    common = hashlib.sha1()
+    common.update("%d\n%s\n" % (CACHE_VERSION, extra))
+    for path in [page_path] + dependencies:
+        if not path.endswith(TEST_FILE_SUFFIX):
+            common.update("%s %s\n" % (os.path.relpath(path, page_dir), hash_file(path)))
+
+    keys = {}
+    for path in dependencies:
+        if path.endswith(TEST_FILE_SUFFIX):
+            key = common.copy()
+            key.update("%s %s\n" % (os.path.relpath(path, page_dir), hash_file(path)))
+            keys[os.path.basename(path)] = key.hexdigest()
+    return keys
+
+
+def load_cache(filename):
+    if not os.path.isfile(filename):
+        return {"version": CACHE_VERSION, "pages": {}}
+
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+    except ValueError:
+        cache = None
+
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return {"version": CACHE_VERSION, "pages": {}}
+    return cache
+
+
+def save_cache(filename, cache):
+    with open(filename, "w") as f:
+        json.dump(cache, f, sort_keys=True)
+        f.write("\n")
+
+
+def get_cached_results(cache, page, keys):
+    """
+    Returns a dict of test file name to its cached results, for each of the
+    test files whose key matches the one it was cached with.
+    """
+    entries = cache["pages"].get(page, {})
+    return dict((test_file, entries[test_file]) for test_file, key in keys.items()
+                if test_file in entries and entries[test_file]["key"] == key)
+
+
+def update_cache(cache, page, keys, results, cached):
+    """
+    Replaces the page's entries in the cache with the still valid cached
+    ones, plus those of the test files whose tests all passed in results.
+    Nothing new is cached if a test that isn't in a test file (such as the
+    error checks, which cover all the test files) failed.
+    """
+    entries = dict(cached)
+
+    failed_files = set(test.get("file") for test in results["tests"]
+                       if test["state"] == "failed")
+    if None not in failed_files:
+        for test_file, key in keys.items():
+            tests = [test for test in results["tests"]
+                     if test.get("file") == test_file and not test.get("cached")]
+            if not tests or test_file in failed_files:
+                continue
+            entries[test_file] = {
+                "key": key,
+                "tests": tests,
+                "suites": [suite for suite in results.get("suites", [])
+                           if suite.get("file") == test_file]
+            }
+
+    cache["pages"][page] = entries
+
+
+def add_cached_results(results, cached):
+    """
+    Adds the cached results of the test files to the results of a run,
+    marking each of their tests as cached.
+    """
+    for test_file in sorted(cached):
+        for test in cached[test_file]["tests"]:
+            test = dict(test, cached=True)
+            results["tests"].append(test)
+            results[test["state"]] += 1
+        results["suites"].extend(cached[test_file]["suites"])
+    return results
@@ -0,0 +1,127 @@
+"""
+Timing reports for the frontend unit tests.
+
+The results handled here are the ones gathered by LoopMochaUtils.runTests
+and merged by BaseTestFrontendUnits.check_page: a dict with the overall
+counts and duration, plus a "tests" list with the title, suite, name, test
+file, state, duration (in milliseconds), error and stack of each test, and a
+"suites" list with the title, test file and duration of each suite. Tests
+whose results were reused from frontend_cache are marked as cached.
+"""
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+
+
+def write_json_report(filename, page, results):
+    report = dict(results)
+    report["page"] = page
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def write_junit_report(filename, page, results):
+    tests = results["tests"]
+    testsuite = ElementTree.Element("testsuite", {
+        "name": page,
+        "tests": str(len(tests)),
+        "failures": str(results["failed"]),
+        "skipped": str(results["pending"]),
+        "errors": "0",
+        "time": "%.3f" % (results["duration"] / 1000.0)
+    })
+
+    for test in tests:
+        testcase = ElementTree.SubElement(testsuite, "testcase", {
+            "classname": test.get("suite") or page,
+            "name": test.get("name") or test["title"],
+            "time": "%.3f" % (test["duration"] / 1000.0)
+        })
+        if test["state"] == "failed":
+            failure = ElementTree.SubElement(testcase, "failure", {
+                "message": (test["error"] or "").split("\n")[0]
+            })
+            failure.text = "\n".join(filter(None, [test["error"], test["stack"]]))
+        elif test["state"] == "pending":
+            ElementTree.SubElement(testcase, "skipped")
+
+    testsuites = ElementTree.Element("testsuites")
+    testsuites.append(testsuite)
+    ElementTree.ElementTree(testsuites).write(filename, encoding="utf-8")
+
+
+def get_test_durations(results):
+    """
+    Returns a dict of test title to duration. A test that's listed more than
+    once keeps its longest time.
+    """
+    durations = {}
+    for test in results["tests"]:
+        if test["state"] == "pending":
+            continue
+        durations[test["title"]] = max(durations.get(test["title"], 0),
+                                       test["duration"])
+    return durations
+
+
+def load_baseline(filename):
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename) as f:
+        return json.load(f)
+
+
+def find_regressions(results, baseline, threshold, min_duration):
+    """
+    Returns (title, baseline duration, duration) for the tests that take more
+    than threshold times as long as they did in the baseline, slowest first.
+    Tests that take less than min_duration milliseconds are left out, as
+    their times are mostly noise.
+    """
+    old_durations = get_test_durations(baseline)
+    regressions = []
+
+    for title, duration in get_test_durations(results).items():
+        old_duration = old_durations.get(title)
+        if old_duration is None or duration < min_duration:
+            continue
+        if duration > max(old_duration, 1) * threshold:
+            regressions.append((title, old_duration, duration))
+
+    return sorted(regressions, key=lambda regression: -regression[2])
+
+
+def slowest_tests(results, count):
+    durations = get_test_durations(results)
+    return sorted(durations.items(), key=lambda item: (-item[1], item[0]))[:count]
+
+
+def slowest_suites(results, count):
+    suites = [(suite["title"], suite["duration"]) for suite in results.get("suites", [])]
+    return sorted(suites, key=lambda item: (-item[1], item[0]))[:count]
+
+
+def format_timing_summary(page, results, count, regressions=None, threshold=None):
+    lines = ["%s: %d tests in %.1fs" % (page, len(results["tests"]),
+                                        results["duration"] / 1000.0)]
+
+    slowest = slowest_tests(results, count)
+    if slowest:
+        lines.append("Slowest tests:")
+        lines.extend("  %6dms  %s" % (duration, title)
+                     for title, duration in slowest)
+
+    slowest = slowest_suites(results, count)
+    if slowest:
+        lines.append("Slowest suites:")
+        lines.extend("  %6dms  %s" % (duration, title)
+                     for title, duration in slowest)
+
+    if regressions:
+        lines.append("Tests more than %gx slower than the baseline:" % threshold)
+        lines.extend("  %6dms -> %6dms  %s" % (old_duration, duration, title)
+                     for title, old_duration, duration in regressions)
+
+    return "\n".join(lines)
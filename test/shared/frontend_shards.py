@@ -0,0 +1,170 @@
+"""
+Runs a frontend unit test page split into shards by test file, and merges
+the results of the shards into a single report.
+
+The shards are selected with the page's query string, which needs the page
+to load loop_test_shards.js. The test pages are imported from
+mozilla-central, so the test server adds it to them as it serves them (see
+add_shards_script). The shards run concurrently, each in a browser window of
+its own. With dom.ipc.processCount set above the number of shards, each
+window's tab gets a content process of its own, so the shards spread the
+tests over the cores.
+"""
+from marionette_driver import Wait
+import re
+
+SHARDS_SCRIPT = '<script src="../shared/loop_test_shards.js"></script>'
+
+# The inline script that calls mocha.setup, and its indentation.
+MOCHA_SETUP_SCRIPT_RE = re.compile(
+    r"^([ \t]*)<script>(?:(?!</script>).)*?mocha\.setup\(.*?</script>\n",
+    re.MULTILINE | re.DOTALL)
+
+# Opens a browser window loading the url passed, from the chrome context.
+OPEN_WINDOW_SCRIPT = """
+window.openDialog("chrome://browser/content/browser.xul", "_blank",
+                  "chrome,all,dialog=no", arguments[0]);
+"""
+
+# How long to wait for a shard's window to open, in seconds.
+OPEN_WINDOW_TIMEOUT = 30
+
+
+def add_shards_script(page_data):
+    """
+    Returns the page with loop_test_shards.js loaded straight after mocha is
+    set up, before the test files. Pages that don't set up mocha, or that
+    already load the script, are returned unchanged.
+    """
+    if SHARDS_SCRIPT in page_data:
+        return page_data
+
+    match = MOCHA_SETUP_SCRIPT_RE.search(page_data)
+    if match is None:
+        return page_data
+
+    return (page_data[:match.end()] + match.group(1) + SHARDS_SCRIPT + "\n" +
+            page_data[match.end():])
+
+
+def get_shard_pages(page, query, shards):
+    """
+    Returns the page, with query parameters, for each of the shards the
+    tests on the page are split into. query selects the tests to run.
+    """
+    if shards <= 1:
+        if query:
+            return ["%s?%s" % (page, query)]
+        return [page]
+
+    pages = []
+    for shard in range(shards):
+        shard_query = "shard=%d&shards=%d" % (shard, shards)
+        if query:
+            shard_query += "&" + query
+        pages.append("%s?%s" % (page, shard_query))
+    return pages
+
+
+def open_window(marionette, url):
+    """
+    Opens a browser window loading url, and returns the handle of its tab.
+    """
+    handles = set(marionette.window_handles)
+
+    marionette.set_context(marionette.CONTEXT_CHROME)
+    try:
+        marionette.execute_script(OPEN_WINDOW_SCRIPT, script_args=[url])
+    finally:
+        marionette.set_context(marionette.CONTEXT_CONTENT)
+
+    new_handles = Wait(marionette, timeout=OPEN_WINDOW_TIMEOUT).until(
+        lambda m: set(m.window_handles) - handles)
+    return new_handles.pop()
+
+
+def run_shards(marionette, urls, get_results):
+    """
+    Runs the shard pages at urls concurrently, each in a browser window of
+    its own, and returns their results in the same order. get_results is
+    called with each shard's window selected, and returns its results, or
+    None if the shard doesn't complete in time.
+    """
+    original_handle = marionette.current_window_handle
+    handles = [open_window(marionette, url) for url in urls]
+
+    shard_results = []
+    try:
+        # The shards keep running while the harness waits for the first
+        # ones, so this takes as long as the slowest of them.
+        for handle in handles:
+            marionette.switch_to_window(handle)
+            shard_results.append(get_results())
+    finally:
+        for handle in handles:
+            marionette.switch_to_window(handle)
+            marionette.close()
+        marionette.switch_to_window(original_handle)
+
+    return shard_results
+
+
+def merge_results(pages, shard_results):
+    """
+    Merges the results of the shards into one report. Each test is tagged
+    with the page it ran on, and a shard that didn't complete is reported
+    as a failure.
+
+    The tests and suites that aren't in a test file, like the error checks,
+    run in every shard, so they're only reported once: a test fails if it
+    failed in any shard.
+    """
+    merged = {"complete": True, "duration": 0, "suites": [], "tests": []}
+    shared_suites = {}
+    shared_tests = {}
+
+    for page, results in zip(pages, shard_results):
+        if results is None:
+            merged["complete"] = False
+            merged["tests"].append({
+                "title": "Waiting for Completion",
+                "state": "failed",
+                "duration": 0,
+                "error": "Could not find the test complete indicator",
+                "stack": None,
+                "page": page
+            })
+            continue
+
+        merged["complete"] = merged["complete"] and results["complete"]
+        # The shards run concurrently, so the slowest one sets the time.
+        merged["duration"] = max(merged["duration"], results["duration"])
+
+        for suite in results.get("suites", []):
+            existing = shared_suites.get(suite["title"])
+            if suite.get("file"):
+                merged["suites"].append(suite)
+            elif existing is None:
+                shared_suites[suite["title"]] = suite
+                merged["suites"].append(suite)
+            else:
+                existing["duration"] = max(existing["duration"],
+                                           suite["duration"])
+
+        for test in results["tests"]:
+            test["page"] = page
+            existing = shared_tests.get(test["title"])
+            if test.get("file"):
+                merged["tests"].append(test)
+            elif existing is None:
+                shared_tests[test["title"]] = test
+                merged["tests"].append(test)
+            elif test["state"] == "failed" and existing["state"] != "failed":
+                merged["tests"][merged["tests"].index(existing)] = test
+                shared_tests[test["title"]] = test
+
+    for state in ("passed", "failed", "pending"):
+        merged[state] = len([test for test in merged["tests"]
+                             if test["state"] == state])
+
+    return merged
@@ -1,16 +1,107 @@
 from marionette import MarionetteTestCase
-from marionette_driver.errors import NoSuchElementException
+from marionette_driver.errors import ScriptTimeoutException
+import frontend_cache
+import frontend_report
+import frontend_shards
 import threading
 import SimpleHTTPServer
 import SocketServer
 import BaseHTTPServer
+import Queue
+import gzip
+import hashlib
+import json
 import socket
+import StringIO
 import urllib
 import urlparse
 import os
+import re
 
 DEBUG = False
 
+# Set LOOP_TEST_SIMPLE_SERVER=1 in the environment to serve the tests with
+# the plain SimpleHTTPServer rather than the in-memory caching one.
+USE_SIMPLE_SERVER = os.environ.get("LOOP_TEST_SIMPLE_SERVER") == "1"
+
+CACHING_SERVER_WORKERS = 16
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript",
+                      "application/x-javascript", "application/json",
+                      "image/svg+xml")
+
+# Number of shards to split each test page into, by test file (see
+# frontend_shards.py). The shards run concurrently in windows of their own,
+# each with a content process of its own.
+TEST_SHARDS = max(int(os.environ.get("LOOP_TEST_SHARDS", "2")), 1)
+
+# Prefs the browser needs for the tests. They're enforced once per browser
+# session (see ensure_gecko_prefs).
+#
+# Note: when e10s is enabled by default, this pref can go away, and so will
+# the restart if this is still the only pref set here.
+REQUIRED_PREFS = {
+    "browser.tabs.remote.autostart": True
+}
+if TEST_SHARDS > 1:
+    # One content process for the harness' own tab, and one for each shard.
+    REQUIRED_PREFS["dom.ipc.processCount"] = TEST_SHARDS + 1
+
+# Browser sessions that REQUIRED_PREFS have been enforced in.
+_enforced_sessions = set()
+
+# How long to wait for a test page to finish running, in milliseconds.
+TEST_RUN_TIMEOUT = 120000
+
+# Query parameters to add to every test page to only run some of the tests,
+# e.g. "file=models_test.js,utils_test.js" or "grep=ActiveRoomStore".
+TEST_FILTER = os.environ.get("LOOP_TEST_FILTER", "")
+
+# Set LOOP_TEST_REPORT_DIR to write a JSON and a JUnit XML report with the
+# time taken by each test to that directory, for every test page.
+TEST_REPORT_DIR = os.environ.get("LOOP_TEST_REPORT_DIR")
+
+# Set LOOP_TEST_BASELINE_DIR to a directory of JSON reports from an earlier
+# run to list the tests that became more than LOOP_TEST_REGRESSION_THRESHOLD
+# times slower, ignoring those that take less than
+# LOOP_TEST_REGRESSION_MIN_MS. Set LOOP_TEST_FAIL_ON_REGRESSION=1 to fail the
+# page when there are any.
+TEST_BASELINE_DIR = os.environ.get("LOOP_TEST_BASELINE_DIR")
+TEST_REGRESSION_THRESHOLD = float(os.environ.get("LOOP_TEST_REGRESSION_THRESHOLD", "1.5"))
+TEST_REGRESSION_MIN_MS = int(os.environ.get("LOOP_TEST_REGRESSION_MIN_MS", "50"))
+FAIL_ON_REGRESSION = os.environ.get("LOOP_TEST_FAIL_ON_REGRESSION") == "1"
+
+# Number of the slowest tests and suites to list after each page.
+SLOWEST_TESTS_COUNT = int(os.environ.get("LOOP_TEST_SLOWEST", "10"))
+
+# The results of test files that passed are cached in LOOP_TEST_CACHE_FILE,
+# keyed by the content of the page's scripts, and the test files are only
+# run again once a script they depend on changes (see frontend_cache.py).
+# Set LOOP_TEST_NO_CACHE=1 to run all of them regardless. The cache isn't
+# used when LOOP_TEST_FILTER is set.
+TEST_CACHE_FILE = os.environ.get("LOOP_TEST_CACHE_FILE", ".frontend-test-cache.json")
+USE_TEST_CACHE = os.environ.get("LOOP_TEST_NO_CACHE") != "1"
+
+# Waits for LoopMochaUtils.runTests to finish and returns the JSON encoded
+# results. The page's objects are only reachable through wrappedJSObject from
+# the script sandbox; listening for the event needs no such unwrapping.
+WAIT_FOR_RESULTS_SCRIPT = """
+var pageWindow = window.wrappedJSObject || window;
+var utils = pageWindow.LoopMochaUtils;
+
+function finish() {
+  marionetteScriptFinished(utils.getTestResults());
+}
+
+if (!utils || !utils.getTestResults) {
+  marionetteScriptFinished(null);
+} else if (JSON.parse(utils.getTestResults()).complete) {
+  finish();
+} else {
+  document.addEventListener("loop-tests-complete", finish);
+}
+"""
+
 # XXX Once we're on a branch with bug 993478 landed, we may want to get
 # rid of this HTTP server and just use the built-in one from Marionette,
 # since there will less code to maintain, and it will be faster.  We'll
@@ -22,7 +113,176 @@ class ThreadingSimpleServer(SocketServer.ThreadingMixIn,
     pass
 
 
-class QuietHttpRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+class TestPageHttpRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Adds loop_test_shards.js to the test pages it serves (see
+    frontend_shards.add_shards_script).
+    """
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not path.endswith(".html") or not os.path.isfile(path):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+        with open(path, "rb") as f:
+            data = frontend_shards.add_shards_script(f.read())
+        self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        return StringIO.StringIO(data)
+
+
+class QuietHttpRequestHandler(TestPageHttpRequestHandler):
+    def log_message(self, format, *args, **kwargs):
+        pass
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Returns whether an Accept-Encoding header allows a gzip response: gzip,
+    or else *, must be listed with a non-zero q-value.
+    """
+    qvalues = {}
+    for coding in accept_encoding.split(","):
+        params = coding.split(";")
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        qvalue = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name] = qvalue
+
+    for name in ("gzip", "x-gzip", "*"):
+        if name in qvalues:
+            return qvalues[name] > 0
+    return False
+
+
+class CachedFile(object):
+    def __init__(self, path, content_type):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        if content_type == "text/html":
+            self.data = frontend_shards.add_shards_script(self.data)
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.sha1(self.data).hexdigest()
+        self.gzip_data = None
+
+        if content_type.startswith(COMPRESSIBLE_TYPES):
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as f:
+                f.write(self.data)
+            if buf.tell() < len(self.data):
+                self.gzip_data = buf.getvalue()
+
+
+class CachingHttpServer(BaseHTTPServer.HTTPServer):
+    """
+    Serves the files from memory, reading each one from disk only the first
+    time it is requested. Requests are handled on a fixed pool of worker
+    threads rather than a new thread per connection.
+    """
+    def __init__(self, server_address, handler, workers=CACHING_SERVER_WORKERS):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler)
+        self.file_cache = {}
+        self.requests = Queue.Queue()
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def get_file(self, path, content_type):
+        cached = self.file_cache.get(path)
+        if cached is None:
+            cached = self.file_cache[path] = CachedFile(path, content_type)
+        return cached
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        # Each worker stops once it's done with its connection. They're
+        # daemon threads, so there's no need to wait for those on idle
+        # keep-alive connections.
+        for worker in self.workers:
+            self.requests.put(None)
+
+
+class CachingHttpRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serves files from the server's in-memory cache over keep-alive
+    connections, with ETag revalidation and gzip where the client accepts
+    it. Anything that isn't a plain file falls back to SimpleHTTPServer.
+    """
+    protocol_version = "HTTP/1.1"
+    # Don't hold a worker forever on an idle keep-alive connection.
+    timeout = 30
+
+    def do_GET(self):
+        self.send_cached(True)
+
+    def do_HEAD(self):
+        self.send_cached(False)
+
+    def send_cached(self, include_body):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.close_connection = 1
+            if include_body:
+                SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            else:
+                SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+            return
+
+        cached = self.server.get_file(path, self.guess_type(path))
+
+        if self.headers.get("If-None-Match") == cached.etag:
+            self.send_response(304)
+            self.send_header("ETag", cached.etag)
+            self.end_headers()
+            return
+
+        data = cached.data
+        self.send_response(200)
+        self.send_header("Content-Type", cached.content_type)
+        if cached.gzip_data is not None:
+            self.send_header("Vary", "Accept-Encoding")
+            if accepts_gzip(self.headers.get("Accept-Encoding", "")):
+                data = cached.gzip_data
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", cached.etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        if include_body:
+            self.wfile.write(data)
+
+
+class QuietCachingHttpRequestHandler(CachingHttpRequestHandler):
     def log_message(self, format, *args, **kwargs):
         pass
 
@@ -33,13 +293,21 @@ class BaseTestFrontendUnits(MarionetteTestCase):
     def setUpClass(cls):
         super(BaseTestFrontendUnits, cls).setUpClass()
 
-        if DEBUG:
-            handler = SimpleHTTPServer.SimpleHTTPRequestHandler
+        # Port 0 means to select an arbitrary unused port
+        if USE_SIMPLE_SERVER:
+            if DEBUG:
+                handler = TestPageHttpRequestHandler
+            else:
+                handler = QuietHttpRequestHandler
+
+            cls.server = ThreadingSimpleServer(('', 0), handler)
         else:
-            handler = QuietHttpRequestHandler
+            if DEBUG:
+                handler = CachingHttpRequestHandler
+            else:
+                handler = QuietCachingHttpRequestHandler
 
-        # Port 0 means to select an arbitrary unused port
-        cls.server = ThreadingSimpleServer(('', 0), handler)
+            cls.server = CachingHttpServer(('', 0), handler)
         cls.ip, cls.port = cls.server.server_address
 
         cls.server_thread = threading.Thread(target=cls.server.serve_forever)
@@ -49,6 +317,7 @@ class BaseTestFrontendUnits(MarionetteTestCase):
     @classmethod
     def tearDownClass(cls):
         cls.server.shutdown()
+        cls.server.server_close()
         cls.server_thread.join()
 
         # make sure everything gets GCed so it doesn't interfere with the next
@@ -60,22 +329,37 @@ class BaseTestFrontendUnits(MarionetteTestCase):
     def setUp(self):
         super(BaseTestFrontendUnits, self).setUp()
 
-        # Unfortunately, enforcing preferences currently comes with the side
-        # effect of launching and restarting the browser before running the
-        # real functional tests.  Bug 1048554 has been filed to track this.
-        #
-        # Note: when e10s is enabled by default, this pref can go away. The automatic
-        # restart will also go away if this is still the only pref set here.
-        self.marionette.enforce_gecko_prefs({
-            "browser.tabs.remote.autostart": True
-        })
+        self.ensure_gecko_prefs()
 
-        # This extends the timeout for find_element. We need this as the tests
-        # take an amount of time to run after loading, which we have to wait for.
-        self.marionette.set_search_timeout(120000)
+        # The tests take an amount of time to run after loading, which we have
+        # to wait for.
+        self.marionette.set_script_timeout(TEST_RUN_TIMEOUT)
 
         self.marionette.timeouts("page load", 120000)
 
+    def tearDown(self):
+        # Leave a blank page behind, so that the next test class or shard
+        # starts from a clean tab in the same browser session.
+        self.marionette.navigate("about:blank")
+
+        super(BaseTestFrontendUnits, self).tearDown()
+
+    def ensure_gecko_prefs(self):
+        """
+        Enforces REQUIRED_PREFS once per browser session.
+
+        enforce_gecko_prefs checks the prefs itself, and only restarts the
+        browser (bug 1048554) when one of them is wrong. Once they're set,
+        calling it again only repeats that check, so skip it for the rest of
+        the session.
+        """
+        if self.marionette.session_id in _enforced_sessions:
+            return
+
+        self.marionette.enforce_gecko_prefs(REQUIRED_PREFS)
+        # A restart starts a new session.
+        _enforced_sessions.add(self.marionette.session_id)
+
     # srcdir_path should be the directory relative to this file.
     def set_server_prefix(self, srcdir_path):
         # We may be run from a different path than topsrcdir, e.g. in the case
@@ -90,29 +374,55 @@ class BaseTestFrontendUnits(MarionetteTestCase):
 
         self.relPath = urllib.pathname2url(os.path.join(self.relPath, srcdir_path))
 
+        # The directory of the pages on disk, for working out what they load.
+        self.srcdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), srcdir_path)
+
         # Finally join the relative path with the given src path
         self.server_prefix = urlparse.urljoin("http://localhost:" + str(self.port),
                                               self.relPath)
 
     def check_page(self, page):
 
-        self.marionette.navigate(urlparse.urljoin(self.server_prefix, page))
-        try:
-            self.marionette.find_element("id", 'complete')
-        except NoSuchElementException:
-            fullPageUrl = urlparse.urljoin(self.relPath, page)
-
-            details = "%s: 1 failure encountered\n%s" % \
-                      (fullPageUrl,
-                       self.get_failure_summary(
-                           fullPageUrl, "Waiting for Completion",
-                           "Could not find the test complete indicator"))
-
-            raise AssertionError(details)
-
-        fail_node = self.marionette.find_element("css selector",
-                                                 '.failures > em')
-        if fail_node.text == "0":
+        query = TEST_FILTER
+        fullPageUrl = urlparse.urljoin(self.relPath, page)
+        use_cache = USE_TEST_CACHE and not TEST_FILTER
+        cached = {}
+        if use_cache:
+            keys = frontend_cache.get_test_file_keys(os.path.join(self.srcdir, page),
+                                                     self.get_browser_version())
+            cache = frontend_cache.load_cache(TEST_CACHE_FILE)
+            cached = frontend_cache.get_cached_results(cache, fullPageUrl, keys)
+            if cached:
+                query = "file=" + ",".join(sorted(set(keys) - set(cached)))
+                print "%s: reusing the results of %d of %d test files" % (
+                    fullPageUrl, len(cached), len(keys))
+
+        if cached and len(cached) == len(keys):
+            pages = []
+            shard_results = []
+        else:
+            pages = frontend_shards.get_shard_pages(page, query, TEST_SHARDS)
+            urls = [urlparse.urljoin(self.server_prefix, shard_page)
+                    for shard_page in pages]
+            if len(urls) == 1:
+                self.marionette.navigate(urls[0])
+                shard_results = [self.get_test_results()]
+            else:
+                shard_results = frontend_shards.run_shards(
+                    self.marionette, urls, self.get_test_results)
+
+        results = frontend_shards.merge_results(pages, shard_results)
+        if use_cache:
+            frontend_cache.add_cached_results(results, cached)
+            frontend_cache.update_cache(cache, fullPageUrl, keys, results, cached)
+            frontend_cache.save_cache(TEST_CACHE_FILE, cache)
+
+        regressions = self.report_timings(page, results)
+        if results["failed"] == 0:
+            if regressions and FAIL_ON_REGRESSION:
+                raise AssertionError(
+                    "%d test(s) became more than %gx slower than the baseline" %
+                    (len(regressions), TEST_REGRESSION_THRESHOLD))
             return
 
         # This may want to be in a more general place triggerable by an env
@@ -125,30 +435,88 @@ class BaseTestFrontendUnits(MarionetteTestCase):
         #from ipdb import set_trace
         #set_trace()
 
-        raise AssertionError(self.get_failure_details(page))
+        raise AssertionError(self.get_failure_details(page, results))
+
+    def get_browser_version(self):
+        """
+        Returns the name and version of the browser, so that results aren't
+        reused across browser versions.
+        """
+        capabilities = getattr(self.marionette, "session_capabilities", None) or {}
+        return "%s %s" % (capabilities.get("browserName"),
+                          capabilities.get("browserVersion", capabilities.get("version")))
+
+    def get_test_results(self):
+        """
+        Waits for the tests on the current page to complete and fetches all
+        of their results in a single call. Returns None if the page doesn't
+        complete in time, or doesn't report results.
+        """
+        try:
+            results = self.marionette.execute_async_script(
+                WAIT_FOR_RESULTS_SCRIPT)
+        except ScriptTimeoutException:
+            return None
+
+        if results is None:
+            return None
+
+        return json.loads(results)
+
+    def report_timings(self, page, results):
+        """
+        Writes the timing reports for the page, prints its slowest tests, and
+        returns the tests that regressed against the baseline.
+        """
+        fullPageUrl = urlparse.urljoin(self.relPath, page)
+        report_name = re.sub(r"[^\w.-]+", "-",
+                             os.path.splitext(fullPageUrl)[0]).strip("-")
+
+        if TEST_REPORT_DIR:
+            if not os.path.isdir(TEST_REPORT_DIR):
+                os.makedirs(TEST_REPORT_DIR)
+            report_file = os.path.join(TEST_REPORT_DIR, report_name)
+            frontend_report.write_json_report(report_file + ".json",
+                                              fullPageUrl, results)
+            frontend_report.write_junit_report(report_file + ".xml",
+                                               fullPageUrl, results)
+
+        regressions = []
+        if TEST_BASELINE_DIR:
+            baseline = frontend_report.load_baseline(
+                os.path.join(TEST_BASELINE_DIR, report_name + ".json"))
+            if baseline is not None:
+                regressions = frontend_report.find_regressions(
+                    results, baseline, TEST_REGRESSION_THRESHOLD,
+                    TEST_REGRESSION_MIN_MS)
+
+        if SLOWEST_TESTS_COUNT > 0 or regressions:
+            print frontend_report.format_timing_summary(
+                fullPageUrl, results, SLOWEST_TESTS_COUNT, regressions,
+                TEST_REGRESSION_THRESHOLD)
+
+        return regressions
 
     def get_failure_summary(self, fullPageUrl, testName, testError):
         return "TEST-UNEXPECTED-FAIL | %s | %s - %s" % (fullPageUrl, testName, testError)
 
-    def get_failure_details(self, page):
-        fail_nodes = self.marionette.find_elements("css selector",
-                                                   '.test.fail')
+    def get_failure_details(self, page, results):
+        failed = [test for test in results["tests"] if test["state"] == "failed"]
         fullPageUrl = urlparse.urljoin(self.relPath, page)
 
-        details = ["%s: %d failure(s) encountered:" % (fullPageUrl, len(fail_nodes))]
+        details = ["%s: %d failure(s) encountered:" % (fullPageUrl, len(failed))]
 
-        for node in fail_nodes:
-            errorText = node.find_element("css selector", '.error').text
+        for test in failed:
+            errorText = test["error"] or ""
 
             # We have to work our own failure message here, as we could be reporting multiple failures.
-            # XXX Ideally we'd also give the full test tree for <test name> - that requires walking
-            # up the DOM tree.
 
             # Format: TEST-UNEXPECTED-FAIL | <filename> | <test name> - <test error>
             details.append(
-                self.get_failure_summary(page,
-                                         node.find_element("tag name", 'h2').text.split("\n")[0],
+                self.get_failure_summary(urlparse.urljoin(self.relPath, test["page"]),
+                                         test["title"],
                                          errorText.split("\n")[0]))
-            details.append(
-                errorText)
+            details.append(errorText)
+            if test["stack"]:
+                details.append(test["stack"])
         return "\n".join(details)
@@ -10,6 +10,17 @@ var LoopMochaUtils = (function(global, _) {
   var gOldAddMessageListener, gOldSendAsyncMessage;
   var gUncaughtError;
   var gCaughtIssues = [];
+  // Tests may fake out Date, so keep hold of the real clock for timing the run.
+  var gNow = Date.now.bind(Date);
+  var gTestResults = {
+    complete: false,
+    duration: 0,
+    passed: 0,
+    failed: 0,
+    pending: 0,
+    suites: [],
+    tests: []
+  };
 
 
   /**
@@ -289,22 +300,99 @@ var LoopMochaUtils = (function(global, _) {
     });
   }
 
+  /**
+   * Returns the test file that declared a suite or test, as tagged by
+   * loop_test_shards.js, or null if it wasn't declared by a test file.
+   *
+   * @param  {Object} runnable The mocha suite or test object.
+   * @return {String}          The test file name, or null.
+   */
+  function getTestFile(runnable) {
+    for (var node = runnable; node; node = node.parent) {
+      if (node.loopTestFile) {
+        return node.loopTestFile;
+      }
+    }
+    return null;
+  }
+
+  /**
+   * Records the outcome of a single test (or hook) in `gTestResults`.
+   *
+   * @param {Object} test  The mocha test object.
+   * @param {String} state One of "passed", "failed" or "pending".
+   * @param {Error}  [err] The error the test failed with, if any.
+   */
+  function recordTestResult(test, state, err) {
+    gTestResults.tests.push({
+      title: test.fullTitle(),
+      name: test.title,
+      suite: test.parent ? test.parent.fullTitle() : "",
+      file: getTestFile(test),
+      state: state,
+      duration: test.duration || 0,
+      error: err ? String(err.message || err) : null,
+      stack: err && err.stack ? String(err.stack) : null
+    });
+    gTestResults[state]++;
+  }
+
+  /**
+   * Returns the results of the test run as a JSON string, so that the test
+   * harness can fetch all of them in a single call.
+   *
+   * @return {String} JSON encoded results, see `gTestResults`.
+   */
+  function getTestResults() {
+    return JSON.stringify(gTestResults);
+  }
+
   /**
    * Utility function for starting the mocha test run. Adds a marker for when
-   * the tests have completed.
+   * the tests have completed, and dispatches a "loop-tests-complete" event on
+   * the document once the results are available from `getTestResults`.
    */
   function runTests() {
-    mocha.run(function() {
+    var startTime = gNow();
+    var runner = mocha.run(function() {
+      gTestResults.duration = gNow() - startTime;
+      gTestResults.complete = true;
+
       var completeNode = document.createElement("p");
       completeNode.setAttribute("id", "complete");
       completeNode.appendChild(document.createTextNode("Complete"));
       document.getElementById("mocha").appendChild(completeNode);
+
+      document.dispatchEvent(new CustomEvent("loop-tests-complete"));
+    });
+
+    runner.on("suite", function(suite) {
+      suite.loopStartTime = gNow();
+    });
+    runner.on("suite end", function(suite) {
+      if (!suite.root) {
+        gTestResults.suites.push({
+          title: suite.fullTitle(),
+          file: getTestFile(suite),
+          duration: gNow() - suite.loopStartTime
+        });
+      }
+    });
+    runner.on("pass", function(test) {
+      recordTestResult(test, "passed");
+    });
+    runner.on("fail", function(test, err) {
+      recordTestResult(test, "failed", err);
+    });
+    runner.on("pending", function(test) {
+      recordTestResult(test, "pending");
     });
   }
 
   return {
     addErrorCheckingTests: addErrorCheckingTests,
     createSandbox: createSandbox,
+    getTestResults: getTestResults,
     publish: publish,
     restore: restore,
     runTests: runTests,
@@ -0,0 +1,91 @@
+/* Any copyright is dedicated to the Public Domain.
+ * http://creativecommons.org/publicdomain/zero/1.0/ */
+
+/**
+ * Lets a test page run a subset of its test files, selected by the page's
+ * query string:
+ *
+ * - file=a_test.js,b_test.js only runs the tests from those files.
+ * - shard=i&shards=n only runs the files in shard i (counting from 0) of n.
+ *
+ * Mocha's own grep parameter can be combined with these.
+ *
+ * This is only in loop-client, so the test pages don't load it in
+ * mozilla-central. The test server adds it to the pages as it serves them
+ * (see frontend_shards.py). It must be loaded after `mocha.setup` and before
+ * the test files.
+ */
+(function(_) {
+  "use strict";
+
+  /**
+   * Spreads the test files over a number of shards, balancing them by their
+   * number of tests. The assignment only depends on the loaded files, so
+   * every shard of a page works out the same one.
+   *
+   * @param  {Object} fileTotals Map of file name to number of tests.
+   * @param  {Number} shards     The number of shards.
+   * @return {Object}            Map of file name to shard index.
+   */
+  function assignShards(fileTotals, shards) {
+    var shardTotals = _.fill(new Array(shards), 0);
+    var files = _.sortBy(Object.keys(fileTotals).sort(), function(file) {
+      return -fileTotals[file];
+    });
+
+    return _.reduce(files, function(assignment, file) {
+      var shard = shardTotals.indexOf(_.min(shardTotals));
+      shardTotals[shard] += fileTotals[file];
+      assignment[file] = shard;
+      return assignment;
+    }, {});
+  }
+
+  /**
+   * Removes the top-level suites not selected by the page's query string.
+   * Suites declared from inline scripts (such as those added by
+   * `LoopMochaUtils.addErrorCheckingTests`) have no file and are always run.
+   */
+  function filterSuites() {
+    var query = Mocha.utils.parseQuery(location.search || "");
+    var files = query.file ? query.file.split(",") : null;
+    var shards = Math.max(parseInt(query.shards, 10) || 1, 1);
+    var shard = parseInt(query.shard, 10) || 0;
+
+    if (!files && shards === 1) {
+      return;
+    }
+
+    var selected = mocha.suite.suites.filter(function(suite) {
+      return !suite.loopTestFile || !files ||
+        files.indexOf(suite.loopTestFile) !== -1;
+    });
+
+    var fileTotals = {};
+    selected.forEach(function(suite) {
+      if (suite.loopTestFile) {
+        fileTotals[suite.loopTestFile] =
+          (fileTotals[suite.loopTestFile] || 0) + suite.total();
+      }
+    });
+    var assignment = assignShards(fileTotals, shards);
+
+    mocha.suite.suites = selected.filter(function(suite) {
+      return !suite.loopTestFile || assignment[suite.loopTestFile] === shard;
+    });
+  }
+
+  // Tag each top-level suite with the name of the test file that declares
+  // it, for filtering here and for `LoopMochaUtils`' results.
+  mocha.suite.on("suite", function(suite) {
+    var script = document.currentScript;
+    suite.loopTestFile = script && script.src ?
+      script.src.split("/").pop() : null;
+  });
+
+  var run = mocha.run;
+  mocha.run = function() {
+    filterSuites();
+    return run.apply(this, arguments);
+  };
+})(_);
@@ -0,0 +1,418 @@
+"""
+Page load benchmarks for the standalone client.
+
+BaseTestPageLoad loads the standalone room page many times from a local
+server.js, serving either content/ or the dist/ build, with a fake
+loop-server (test/loop_server/fake_loop_server.py) behind it so that the
+room view renders. For each load it collects, from the Navigation, Resource
+and User Timing APIs:
+
+- the number of requests and the bytes transferred,
+- the time to the first paint, DOMContentLoaded and the load event,
+- the time at which the strings were localized ("loop-l10n-ready") and the
+  webapp first rendered ("loop-webapp-init"), as marked by a frame script
+  the benchmark loads, so that index.html isn't changed for it,
+- the time at which the room view became interactive (its join button
+  appeared).
+
+The page is loaded with an empty cache ("cold") and then again with the
+cache filled ("warm"). The median of each metric is reported, and compared
+to the reports of an earlier run when LOOP_TEST_BASELINE_DIR is set; any
+metric that regressed by more than LOOP_PAGE_LOAD_THRESHOLD fails the test.
+"""
+from distutils.spawn import find_executable
+import frontend_tester
+from frontend_tester import BaseTestFrontendUnits
+import json
+import os
+import socket
+import subprocess
+import time
+import urllib
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        os.pardir, os.pardir))
+FAKE_LOOP_SERVER = os.path.join(ROOT_DIR, "test", "loop_server",
+                                "fake_loop_server.py")
+
+# Number of cold and of warm loads of each build.
+PAGE_LOAD_RUNS = int(os.environ.get("LOOP_PAGE_LOAD_RUNS", "10"))
+
+# A median more than this many times its baseline value is a regression,
+# as long as it also changed by more than the metric's minimum.
+PAGE_LOAD_THRESHOLD = float(os.environ.get("LOOP_PAGE_LOAD_THRESHOLD", "1.2"))
+
+SERVER_START_TIMEOUT = 30
+ROOM_READY_TIMEOUT = 30000
+ROOM_TOKEN = "pageLoadBenchmark"
+
+# The join button is shown once the room information has been fetched, in
+# either of the views a guest may get.
+ROOM_READY_SELECTOR = "#main .btn-join, #main .handle-user-agent-view button"
+
+# The metrics collected for each load, with the smallest change in each that
+# counts as a regression, and whether the change must also exceed
+# PAGE_LOAD_THRESHOLD. Any extra request is a regression.
+PAGE_LOAD_METRICS = [
+    ("requests", 0, False),
+    ("transferBytes", 1024, True),
+    ("decodedBytes", 1024, True),
+    ("firstPaint", 20, True),
+    ("domContentLoaded", 20, True),
+    ("load", 20, True),
+    ("l10nReady", 20, True),
+    ("webappInit", 20, True),
+    ("roomReady", 20, True),
+]
+
+# The metrics that come from performance marks made by
+# MARK_MILESTONES_FRAME_SCRIPT, and the marks.
+PAGE_LOAD_MARKS = [
+    ("l10nReady", "loop-l10n-ready"),
+    ("webappInit", "loop-webapp-init"),
+]
+
+# Runs in the content process of the benchmark's tab, and marks the page's
+# milestones in its performance timeline: when l10n-gaia has localized it,
+# and when loop.webapp.init has rendered the webapp into #main. The listener
+# is added before the page's scripts run, so it's called before the page's
+# own "localized" listener, which may init the webapp straight away.
+MARK_MILESTONES_FRAME_SCRIPT = """
+function onWindowCreated(event) {
+  var win = event.target.defaultView;
+  if (!win || win.parent !== win) {
+    return;
+  }
+
+  win.addEventListener("localized", function onLocalized() {
+    win.removeEventListener("localized", onLocalized);
+    win.performance.mark("loop-l10n-ready");
+
+    var main = win.document.getElementById("main");
+    if (!main) {
+      return;
+    }
+    var observer = new win.MutationObserver(function() {
+      observer.disconnect();
+      win.performance.mark("loop-webapp-init");
+    });
+    observer.observe(main, {childList: true});
+  });
+}
+
+addEventListener("DOMWindowCreated", onWindowCreated);
+addMessageListener("LoopPageLoad:Stop", function onStop() {
+  removeEventListener("DOMWindowCreated", onWindowCreated);
+  removeMessageListener("LoopPageLoad:Stop", onStop);
+});
+"""
+
+MARK_MILESTONES_FRAME_SCRIPT_URL = "data:application/javascript," + \
+    urllib.quote(MARK_MILESTONES_FRAME_SCRIPT)
+
+# Loads the frame script into the selected tab, or stops it when arguments[1]
+# is false.
+SET_MARK_MILESTONES_SCRIPT = """
+let messageManager = gBrowser.selectedBrowser.messageManager;
+if (arguments[1]) {
+  messageManager.loadFrameScript(arguments[0], true);
+} else {
+  messageManager.removeDelayedFrameScript(arguments[0]);
+  messageManager.sendAsyncMessage("LoopPageLoad:Stop");
+}
+"""
+
+# Don't let the tracking scripts in index.html add requests to the
+# benchmark. Returns the previous value of the pref.
+SET_DO_NOT_TRACK_SCRIPT = """
+let prefs = Components.classes["@mozilla.org/preferences-service;1"]
+                      .getService(Components.interfaces.nsIPrefBranch);
+let previous = prefs.getBoolPref("privacy.donottrackheader.enabled");
+prefs.setBoolPref("privacy.donottrackheader.enabled", arguments[0]);
+return previous;
+"""
+
+CLEAR_CACHE_SCRIPT = """
+Components.classes["@mozilla.org/netwerk/cache-storage-service;1"]
+          .getService(Components.interfaces.nsICacheStorageService)
+          .clear();
+"""
+
+# Waits for the room view to be ready, then returns the JSON encoded timings
+# of the current page load, in milliseconds since the navigation started.
+COLLECT_TIMINGS_SCRIPT = """
+var selector = arguments[0];
+var timeout = arguments[1];
+var performance = window.performance;
+var started = performance.now();
+
+function firstEntry(type, name) {
+  var entries = performance.getEntriesByName(name, type);
+  return entries.length ? entries[0].startTime : null;
+}
+
+function collect(roomReady) {
+  var timing = performance.timing;
+  var start = timing.navigationStart;
+  var navigation = performance.getEntriesByType("navigation")[0] || {};
+  var resources = performance.getEntriesByType("resource").filter(function(entry) {
+    return entry.name.indexOf(location.origin + "/") === 0;
+  });
+
+  var firstPaint = firstEntry("paint", "first-contentful-paint") ||
+                   firstEntry("paint", "first-paint");
+  if (firstPaint === null && timing.timeToNonBlankPaint) {
+    firstPaint = timing.timeToNonBlankPaint - start;
+  }
+
+  function total(property) {
+    return resources.reduce(function(sum, entry) {
+      return sum + (entry[property] || 0);
+    }, navigation[property] || 0);
+  }
+
+  marionetteScriptFinished(JSON.stringify({
+    requests: resources.length + 1,
+    transferBytes: total("transferSize"),
+    decodedBytes: total("decodedBodySize"),
+    firstPaint: firstPaint,
+    domContentLoaded: timing.domContentLoadedEventEnd - start,
+    load: timing.loadEventEnd - start,
+    l10nReady: firstEntry("mark", "loop-l10n-ready"),
+    webappInit: firstEntry("mark", "loop-webapp-init"),
+    roomReady: roomReady,
+    resources: resources.map(function(entry) {
+      return {
+        name: entry.name.substr(location.origin.length),
+        duration: entry.duration,
+        transferSize: entry.transferSize || 0
+      };
+    })
+  }));
+}
+
+function check() {
+  if (document.querySelector(selector)) {
+    collect(performance.now());
+  } else if (performance.now() - started > timeout) {
+    collect(null);
+  } else {
+    setTimeout(check, 5);
+  }
+}
+
+check();
+"""
+
+
+def find_free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def wait_for_port(process, port, timeout=SERVER_START_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server on port %d exited with %d" %
+                               (port, process.returncode))
+        try:
+            socket.create_connection(("localhost", port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Server on port %d didn't start in %ds" % (port, timeout))
+
+
+def median(values):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize_loads(loads):
+    """
+    Returns the median of each metric over the loads.
+    """
+    return dict((name, median(load[name] for load in loads))
+                for name, min_change, relative in PAGE_LOAD_METRICS)
+
+
+def find_page_load_regressions(summary, baseline, threshold):
+    """
+    Returns (mode, metric, baseline value, value) for each median that
+    regressed against the baseline's.
+    """
+    regressions = []
+    for mode in sorted(summary):
+        for name, min_change, relative in PAGE_LOAD_METRICS:
+            value = summary[mode].get(name)
+            old_value = baseline.get(mode, {}).get(name)
+            if value is None or old_value is None:
+                continue
+            if value - old_value > min_change and \
+                    (not relative or value > old_value * threshold):
+                regressions.append((mode, name, old_value, value))
+    return regressions
+
+
+def format_page_load_summary(build, summary, regressions):
+    modes = sorted(summary)
+    lines = ["Page load of %s, medians:" % build,
+             "  %-18s%s" % ("", "".join("%10s" % mode for mode in modes))]
+    for name, min_change, relative in PAGE_LOAD_METRICS:
+        values = []
+        for mode in modes:
+            value = summary[mode][name]
+            values.append("%10s" % ("-" if value is None else "%.0f" % value))
+        lines.append("  %-18s%s" % (name, "".join(values)))
+
+    for mode, name, old_value, value in regressions:
+        lines.append("Regressed: %s %s %.0f -> %.0f" % (mode, name, old_value, value))
+    return "\n".join(lines)
+
+
+class BaseTestPageLoad(BaseTestFrontendUnits):
+    """
+    Benchmarks loading the standalone page of a build. Subclasses call
+    check_page_load with the directory to serve, relative to the top of the
+    repository.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(BaseTestPageLoad, cls).setUpClass()
+        cls.loop_server = None
+
+        python3 = find_executable("python3")
+        if python3 is None or not os.path.isfile(FAKE_LOOP_SERVER):
+            return
+
+        cls.loop_server_port = find_free_port()
+        cls.loop_server = subprocess.Popen(
+            [python3, FAKE_LOOP_SERVER, "--port", str(cls.loop_server_port)],
+            stdout=open(os.devnull, "w"))
+        wait_for_port(cls.loop_server, cls.loop_server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.loop_server is not None:
+            cls.loop_server.terminate()
+            cls.loop_server.wait()
+            cls.loop_server = None
+
+        super(BaseTestPageLoad, cls).tearDownClass()
+
+    def setUp(self):
+        super(BaseTestPageLoad, self).setUp()
+
+        if self.loop_server is None:
+            self.skipTest("python3 is needed to run the fake loop server")
+        self.node = find_executable("node")
+        if self.node is None:
+            self.skipTest("node is needed to run server.js")
+
+        self.previous_do_not_track = self.run_chrome_script(
+            SET_DO_NOT_TRACK_SCRIPT, [True])
+        self.run_chrome_script(SET_MARK_MILESTONES_SCRIPT,
+                               [MARK_MILESTONES_FRAME_SCRIPT_URL, True])
+
+    def tearDown(self):
+        self.run_chrome_script(SET_MARK_MILESTONES_SCRIPT,
+                               [MARK_MILESTONES_FRAME_SCRIPT_URL, False])
+        self.run_chrome_script(SET_DO_NOT_TRACK_SCRIPT, [self.previous_do_not_track])
+
+        super(BaseTestPageLoad, self).tearDown()
+
+    def run_chrome_script(self, script, script_args=None):
+        self.marionette.set_context(self.marionette.CONTEXT_CHROME)
+        try:
+            return self.marionette.execute_script(script, script_args=script_args or [])
+        finally:
+            self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
+
+    def start_content_server(self, content_dir):
+        port = find_free_port()
+        env = dict(os.environ,
+                   PORT=str(port),
+                   LOOP_CONTENT_DIR=content_dir,
+                   LOOP_SERVER_URL="http://localhost:%d" % self.loop_server_port)
+        server = subprocess.Popen([self.node, "server.js"], cwd=ROOT_DIR, env=env,
+                                  stdout=open(os.devnull, "w"))
+        try:
+            wait_for_port(server, port)
+        except RuntimeError:
+            server.kill()
+            raise
+        return server, "http://localhost:%d/content/%s" % (port, ROOM_TOKEN)
+
+    def load_page(self, url):
+        self.marionette.navigate("about:blank")
+        self.marionette.navigate(url)
+        timings = self.marionette.execute_async_script(
+            COLLECT_TIMINGS_SCRIPT, script_args=[ROOM_READY_SELECTOR, ROOM_READY_TIMEOUT])
+        return json.loads(timings)
+
+    def check_page_load(self, content_dir):
+        if not os.path.isfile(os.path.join(ROOT_DIR, content_dir, "index.html")):
+            self.skipTest("%s hasn't been built" % content_dir)
+
+        server, url = self.start_content_server(content_dir)
+        loads = {"cold": [], "warm": []}
+        try:
+            for run in range(PAGE_LOAD_RUNS):
+                self.run_chrome_script(CLEAR_CACHE_SCRIPT)
+                loads["cold"].append(self.load_page(url))
+                loads["warm"].append(self.load_page(url))
+        finally:
+            server.terminate()
+            server.wait()
+
+        not_ready = [load for load in loads["cold"] + loads["warm"]
+                     if load["roomReady"] is None]
+        self.assertFalse(not_ready, "The room view didn't become ready in %d of %d loads" %
+                         (len(not_ready), PAGE_LOAD_RUNS * 2))
+
+        missing_marks = sorted(set(mark for load in loads["cold"] + loads["warm"]
+                                   for metric, mark in PAGE_LOAD_MARKS
+                                   if load[metric] is None))
+        self.assertFalse(missing_marks, "%s/index.html didn't reach the %s "
+                         "milestone(s)" % (content_dir, ", ".join(missing_marks)))
+
+        summary = dict((mode, summarize_loads(mode_loads))
+                       for mode, mode_loads in loads.items())
+        report_name = "page-load-" + content_dir
+
+        if frontend_tester.TEST_REPORT_DIR:
+            if not os.path.isdir(frontend_tester.TEST_REPORT_DIR):
+                os.makedirs(frontend_tester.TEST_REPORT_DIR)
+            with open(os.path.join(frontend_tester.TEST_REPORT_DIR,
+                                   report_name + ".json"), "w") as f:
+                json.dump({"build": content_dir, "summary": summary, "loads": loads},
+                          f, indent=2, sort_keys=True)
+                f.write("\n")
+
+        regressions = []
+        if frontend_tester.TEST_BASELINE_DIR:
+            baseline_file = os.path.join(frontend_tester.TEST_BASELINE_DIR,
+                                         report_name + ".json")
+            if os.path.isfile(baseline_file):
+                with open(baseline_file) as f:
+                    baseline = json.load(f)["summary"]
+                regressions = find_page_load_regressions(summary, baseline,
+                                                         PAGE_LOAD_THRESHOLD)
+
+        print format_page_load_summary(content_dir, summary, regressions)
+
+        if regressions:
+            raise AssertionError(
+                "%d page load metric(s) of %s became more than %gx worse than "
+                "the baseline" % (len(regressions), content_dir, PAGE_LOAD_THRESHOLD))
@@ -0,0 +1,62 @@
+"""
+Checks that the test server adds loop_test_shards.js to the test pages where
+it needs to be. These don't need a browser, so they can be run with
+python -m unittest as well as through marionette.
+"""
+# need to get this dir in the path so that we make the import work
+import os
+import sys
+sys.path.append(os.path.dirname(__file__))
+
+import unittest
+
+import frontend_shards
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+TEST_PAGES = [os.path.join(TEST_DIR, "shared", "index.html"),
+              os.path.join(TEST_DIR, "standalone", "index.html")]
+
+
+class TestAddShardsScript(unittest.TestCase):
+
+    def read_page(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_adds_script_once(self):
+        for path in TEST_PAGES:
+            page = frontend_shards.add_shards_script(self.read_page(path))
+
+            self.assertEqual(page.count(frontend_shards.SHARDS_SCRIPT), 1, path)
+
+    def test_is_idempotent(self):
+        for path in TEST_PAGES:
+            page = frontend_shards.add_shards_script(self.read_page(path))
+
+            self.assertEqual(frontend_shards.add_shards_script(page), page, path)
+
+    def test_loads_after_mocha_setup_and_before_test_files(self):
+        for path in TEST_PAGES:
+            page = frontend_shards.add_shards_script(self.read_page(path))
+            position = page.index(frontend_shards.SHARDS_SCRIPT)
+
+            # The script uses lodash, and hooks into mocha's suites.
+            self.assertLess(page.index("vendor/lodash-"), position, path)
+            self.assertLess(page.index("mocha.setup("), position, path)
+            self.assertLess(position, page.index("_test.js"), path)
+
+    def test_keeps_indentation(self):
+        page = frontend_shards.add_shards_script(
+            self.read_page(TEST_PAGES[0]))
+
+        self.assertIn("\n  " + frontend_shards.SHARDS_SCRIPT + "\n", page)
+
+    def test_leaves_other_pages_alone(self):
+        page = "<!DOCTYPE html>\n<script>\n  init();\n</script>\n"
+
+        self.assertEqual(frontend_shards.add_shards_script(page), page)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,15 @@
+# need to get this dir in the path so that we make the import work
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'shared'))
+
+from page_load_benchmark import BaseTestPageLoad
+
+
+class TestStandalonePageLoad(BaseTestPageLoad):
+
+    def test_content(self):
+        self.check_page_load("content")
+
+    def test_dist(self):
+        self.check_page_load("dist")
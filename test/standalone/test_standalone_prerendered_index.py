@@ -0,0 +1,122 @@
+# need to get this dir in the path so that we make the import work
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'shared'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from frontend_tester import BaseTestFrontendUnits
+import io
+import json
+import shutil
+import tempfile
+import urllib
+import urlparse
+
+import locale_update
+
+# The minimum locale_update.prerender_index needs, plus a static string for
+# l10n-gaia to translate when the page loads.
+INDEX_HTML = u"""<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8">
+    <meta name="locales" content="%(locales)s" />
+    <meta name="default_locale" content="%(default_locale)s" />
+    <link rel="localization" href="l10n/{locale}/loop.properties">
+  </head>
+  <body>
+    <p id="prerendered" data-l10n-id="testString"></p>
+    <script type="text/javascript" src="%(l10n_gaia)s"></script>
+  </body>
+</html>
+"""
+
+# Returns the html element's attributes and the text of the static string
+# once l10n-gaia has localized the page.
+LOCALIZED_SCRIPT = """
+function getState() {
+  return {
+    lang: document.documentElement.getAttribute("lang"),
+    dir: document.documentElement.getAttribute("dir"),
+    text: document.getElementById("prerendered").textContent
+  };
+}
+
+if (document.getElementById("prerendered").textContent) {
+  marionetteScriptFinished(getState());
+} else {
+  window.addEventListener("localized", function() {
+    marionetteScriptFinished(getState());
+  });
+}
+"""
+
+OTHER_LOCALE = "ar"
+
+
+class TestStandalonePrerenderedIndex(BaseTestFrontendUnits):
+
+    def setUp(self):
+        super(TestStandalonePrerenderedIndex, self).setUp()
+        self.set_server_prefix("../../content/")
+
+        self.navigator_language = self.marionette.execute_script(
+            "return navigator.language;")
+        self.locales = sorted(set([self.navigator_language, OTHER_LOCALE]))
+
+        self.index_dir = tempfile.mkdtemp()
+        for locale in self.locales:
+            os.makedirs(os.path.join(self.index_dir, "l10n", locale))
+            with open(os.path.join(self.index_dir, "l10n", locale,
+                                   locale_update.BUNDLE_FILE_NAME), "wb") as f:
+                json.dump({"testString": "Prerendered %s" % locale}, f)
+
+        self.index_file_name = os.path.join(self.index_dir, "index.html")
+        with io.open(self.index_file_name, "w", encoding="utf-8") as f:
+            f.write(INDEX_HTML % {
+                "locales": ",".join(self.locales),
+                "default_locale": self.locales[0],
+                "l10n_gaia": urlparse.urljoin(self.server_prefix,
+                                              "vendor/l10n-gaia-02ca67948fe8.js")
+            })
+
+        locale_update.prerender_index(os.path.join(self.index_dir, "l10n"),
+                                      self.index_file_name, jobs=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+        super(TestStandalonePrerenderedIndex, self).tearDown()
+
+    def load_variant(self, locale):
+        with io.open(os.path.join(self.index_dir,
+                                  locale_update.INDEX_VARIANT_FILE_NAME % locale),
+                     "r", encoding="utf-8") as f:
+            variant = f.read()
+
+        # l10n-gaia skips translating the document if its language is
+        # already set to the browser's.
+        self.assertNotIn(u"lang=", variant.split(u"<head>")[0])
+
+        self.marionette.navigate("data:text/html;charset=utf-8," +
+                                 urllib.quote(variant.encode("utf-8")))
+        return self.marionette.execute_async_script(LOCALIZED_SCRIPT)
+
+    def test_browser_locale(self):
+        # Translated from the inlined bundle as soon as the page is
+        # interactive.
+        state = self.load_variant(self.navigator_language)
+
+        self.assertEqual(state["text"], "Prerendered %s" % self.navigator_language)
+        self.assertEqual(state["lang"], self.navigator_language)
+
+    def test_other_locale(self):
+        if self.navigator_language == OTHER_LOCALE:
+            self.skipTest("the browser's language is %s" % OTHER_LOCALE)
+
+        # Translated once the inlined bundle is registered and negotiated.
+        state = self.load_variant(OTHER_LOCALE)
+
+        self.assertEqual(state["text"], "Prerendered %s" % OTHER_LOCALE)
+        self.assertEqual(state["lang"], OTHER_LOCALE)
+        self.assertEqual(state["dir"], "rtl")